@@ -0,0 +1,159 @@
+"""
+Бенчмарк фиксированных и адаптивных настроек воркера (конкурентность и prefetch).
+
+Воркер моделируется симуляцией с шагом dt: задания приходят в очередь брокера,
+брокер доставляет не больше prefetch_count неподтверждённых сообщений (при
+task_acks_late=True сюда входят и выполняемые задачи), доставка занимает один RTT,
+свободные процессы пула берут задания из резерва воркера, а память процесса растёт
+с размером обрабатываемого задания. Адаптивный режим каждые ADAPTIVE_INTERVAL секунд
+вызывает ту же политику compute_scaling, что и services.autoscaler.AdaptiveAutoscaler,
+и выставляет prefetch_count = concurrency × multiplier.
+
+Запуск из папки ml_service:
+    python benchmarks/bench_concurrency.py [--duration 120] [--seed 42]
+"""
+import argparse
+import os
+import random
+import sys
+from collections import deque
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.autoscaler import compute_scaling, ADAPTIVE_INTERVAL, RSS_WINDOW
+
+BROKER_RTT = 0.004  # Получение задания из брокера, с
+TASK_OVERHEAD = 0.003  # Фиксированные накладные расходы задачи, с
+ROW_COST = 0.00002  # Время обработки одной строки, с
+PROCESS_BASE_MB = 300.0  # RSS процесса с загруженными моделями
+ROW_MB = 0.004  # Дополнительная память на строку задания
+MEMORY_BUDGET_MB = 4096.0
+
+# Сценарии: (название, интенсивность заданий в секунду, доля крупных, диапазон мелких, диапазон крупных)
+WORKLOADS = [
+    ("tiny-flood", 400.0, 0.0, (1, 50), (0, 0)),
+    ("mixed", 60.0, 0.02, (1, 500), (50_000, 200_000)),
+    ("bulk-heavy", 2.0, 0.6, (100, 1_000), (100_000, 400_000)),
+]
+
+def generate_jobs(rate, large_share, small_rows, large_rows, duration, rng):
+    jobs = []
+    t = 0.0
+    while True:
+        t += rng.expovariate(rate)
+        if t > duration:
+            return jobs
+        large = rng.random() < large_share
+        rows = rng.randint(*large_rows) if large else rng.randint(*small_rows)
+        jobs.append((t, rows, large))
+
+def simulate(jobs, concurrency, prefetch, adaptive=False, min_concurrency=1, max_concurrency=8, dt=0.001):
+    """Возвращает метрики симуляции для заданных настроек пула."""
+    broker = deque()
+    in_transit = deque()  # (время доставки, задание)
+    reserved = deque()
+    processes = [{"job": None, "busy_until": 0.0} for _ in range(concurrency)]
+    qos = concurrency * prefetch
+    target = concurrency
+    pending = deque(jobs)
+    recent_sizes = deque(maxlen=200)
+    rss_samples = deque(maxlen=RSS_WINDOW)
+    latencies = {True: [], False: []}
+    peak_memory = 0.0
+    over_budget = 0.0
+    next_adjust = ADAPTIVE_INTERVAL
+    t = 0.0
+    end = jobs[-1][0] if jobs else 0.0
+
+    while pending or broker or in_transit or reserved or any(p["job"] for p in processes):
+        while pending and pending[0][0] <= t:
+            broker.append(pending.popleft())
+        while in_transit and in_transit[0][0] <= t:
+            reserved.append(in_transit.popleft()[1])
+
+        if adaptive and t >= next_adjust:
+            next_adjust = t + ADAPTIVE_INTERVAL
+            memory = [PROCESS_BASE_MB + (p["job"][1] * ROW_MB if p["job"] else 0.0) for p in processes]
+            rss_samples.append(max(memory))
+            active = sum(1 for p in processes if p["job"])
+            target, multiplier = compute_scaling(
+                list(recent_sizes), active, len(broker) + len(reserved) + len(in_transit), memory, max(rss_samples),
+                min_concurrency, max_concurrency, max_rss_mb=MEMORY_BUDGET_MB, current=target
+            )
+            while len(processes) < target:
+                processes.append({"job": None, "busy_until": 0.0})
+            # Пул уменьшается только за счёт простаивающих процессов (как pool.shrink)
+            for p in [p for p in processes if p["job"] is None]:
+                if len(processes) <= target:
+                    break
+                processes.remove(p)
+            qos = target * multiplier
+
+        memory_now = 0.0
+        for p in processes:
+            if p["job"] and t >= p["busy_until"]:
+                arrived, rows, large = p["job"]
+                latencies[large].append(t - arrived)
+                p["job"] = None  # ack
+            if p["job"] is None and reserved:
+                job = reserved.popleft()
+                recent_sizes.append(job[1])
+                p["job"] = job
+                p["busy_until"] = t + TASK_OVERHEAD + job[1] * ROW_COST
+            memory_now += PROCESS_BASE_MB + (p["job"][1] * ROW_MB if p["job"] else 0.0)
+
+        # Брокер доставляет сообщения, пока неподтверждённых меньше prefetch_count
+        unacked = sum(1 for p in processes if p["job"]) + len(reserved) + len(in_transit)
+        while broker and unacked < qos:
+            in_transit.append((t + BROKER_RTT, broker.popleft()))
+            unacked += 1
+
+        peak_memory = max(peak_memory, memory_now)
+        if memory_now > MEMORY_BUDGET_MB:
+            over_budget += dt
+        t += dt
+
+    def pct(values, q):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        "jobs": len(jobs),
+        "makespan_s": t,
+        "throughput": len(jobs) / t if t else 0.0,
+        "small_p50_ms": pct(latencies[False], 0.50) * 1000,
+        "small_p99_ms": pct(latencies[False], 0.99) * 1000,
+        "large_p50_s": pct(latencies[True], 0.50),
+        "peak_memory_mb": peak_memory,
+        "over_budget_s": over_budget,
+        "tail_s": t - end,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=120.0, help="Длительность потока заданий, с")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--concurrency", type=int, default=4, help="Фиксированный размер пула")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="Верхняя граница адаптивного пула")
+    args = parser.parse_args()
+
+    header = f"{'workload':<12} {'mode':<9} {'jobs':>6} {'jobs/s':>8} {'small p50':>10} {'small p99':>10} {'large p50':>10} {'peak MB':>8} {'>budget s':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, rate, large_share, small_rows, large_rows in WORKLOADS:
+        jobs = generate_jobs(rate, large_share, small_rows, large_rows, args.duration, random.Random(args.seed))
+        runs = [
+            ("fixed", simulate(jobs, args.concurrency, 1)),
+            ("adaptive", simulate(jobs, args.concurrency, 1, adaptive=True, max_concurrency=args.max_concurrency)),
+        ]
+        for mode, m in runs:
+            print(
+                f"{name:<12} {mode:<9} {m['jobs']:>6} {m['throughput']:>8.1f} "
+                f"{m['small_p50_ms']:>8.1f}ms {m['small_p99_ms']:>8.1f}ms {m['large_p50_s']:>9.1f}s "
+                f"{m['peak_memory_mb']:>8.0f} {m['over_budget_s']:>9.1f}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Бенчмарк разбора загружаемого файла в API: время read_input_file + validate_input_data +
+coerce_input_data и пиковая память для одного и того же датасета в CSV, XLSX, Parquet
+и Arrow IPC.
+
+Датасет генерируется синтетически по образцу train.csv (benchmarks/bench_load_data.py,
+со столбцами, которых нет в REQUIRED_COLUMNS) и сохраняется в каждом формате.
+Каждый формат разбирается в отдельном процессе: содержимое файла читается в память,
+как в API, пиковая память - VmHWM процесса (ru_maxrss после fork/exec наследует пик
+родителя), прирост - относительно пика после чтения байтов файла.
+
+Запуск из папки ml_service:
+    python benchmarks/bench_input_formats.py [--rows 1000000] [--formats csv,xlsx,parquet,arrow]
+        [--xlsx-engines stream,pandas]
+
+XLSX разбирается каждым движком из --xlsx-engines (переменная XLSX_ENGINE):
+stream - потоковое чтение XML листа (read_xlsx_rows), pandas - прежний pd.read_excel,
+calamine - если установлен python-calamine.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import pandas as pd
+import pyarrow as pa
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bench_load_data import generate_dataset  # noqa: E402
+
+def write_formats(csv_path, formats):
+    """Сохраняет датасет из CSV в остальных форматах и возвращает пути по форматам."""
+    df = pd.read_csv(csv_path)
+    paths = {"csv": csv_path}
+    base = os.path.splitext(csv_path)[0]
+    if "parquet" in formats:
+        paths["parquet"] = f"{base}.parquet"
+        df.to_parquet(paths["parquet"], index=False)
+    if "arrow" in formats:
+        paths["arrow"] = f"{base}.arrow"
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.ipc.new_file(paths["arrow"], table.schema) as writer:
+            writer.write_table(table)
+    if "xlsx" in formats:
+        paths["xlsx"] = f"{base}.xlsx"
+        df.to_excel(paths["xlsx"], index=False)
+    return {name: paths[name] for name in formats}
+
+def peak_rss_mb():
+    """Возвращает пиковый RSS текущего процесса в МБ (VmHWM из /proc/self/status)."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def run_parse(file_type, path):
+    """Выполняется в дочернем процессе: разбирает файл как API и печатает метрики в JSON."""
+    from services.prediction_service import read_input_file, validate_input_data, coerce_input_data
+    with open(path, "rb") as f:
+        content = f.read()
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    df = coerce_input_data(validate_input_data(read_input_file(content, file_type)))
+    elapsed = time.perf_counter() - started
+    peak = peak_rss_mb()
+    print(json.dumps({"rows": len(df), "seconds": elapsed, "peak_rss_mb": peak, "added_mb": peak - baseline}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--formats", default="csv,xlsx,parquet,arrow")
+    parser.add_argument("--xlsx-engines", default="stream,pandas")
+    parser.add_argument("--run", nargs=2, metavar=("FILE_TYPE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_parse(*args.run)
+        return
+
+    formats = args.formats.split(",")
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, "input.csv")
+        generate_dataset(csv_path, args.rows)
+        paths = write_formats(csv_path, formats)
+        print(f"Датасет: {args.rows} строк")
+        print(f"{'format':<14} {'file MB':>8} {'parse s':>8} {'rows/s':>10} {'peak RSS MB':>12} {'added MB':>9}")
+        runs = []
+        for file_type, path in paths.items():
+            engines = args.xlsx_engines.split(",") if file_type == "xlsx" else [None]
+            runs.extend((file_type, path, engine) for engine in engines)
+        for file_type, path, engine in runs:
+            env = dict(os.environ, XLSX_ENGINE=engine) if engine else None
+            output = subprocess.run(
+                [sys.executable, __file__, "--run", file_type, path],
+                check=True, capture_output=True, text=True, env=env
+            ).stdout.strip().splitlines()[-1]
+            m = json.loads(output)
+            label = f"{file_type}:{engine}" if engine else file_type
+            print(
+                f"{label:<14} {os.path.getsize(path) / 2**20:>8.1f} {m['seconds']:>8.2f} {m['rows'] / m['seconds']:>10.0f} "
+                f"{m['peak_rss_mb']:>12.0f} {m['added_mb']:>9.0f}"
+            )
+
+if __name__ == "__main__":
+    main()
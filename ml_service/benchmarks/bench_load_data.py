@@ -0,0 +1,157 @@
+"""
+Бенчмарк загрузки датасета для обучения: прежний load_data (строки object, float64,
+astype(str) + SimpleImputer + LabelEncoder по всему столбцу) и текущий
+train_models.load_data (category/float32, только нужные столбцы, чтение чанками).
+
+Каждый загрузчик запускается в отдельном процессе, пиковая память - ru_maxrss
+процесса. Датасет генерируется синтетически по образцу train.csv (те же столбцы,
+доля пропусков и мусорные категории), артефакты пишутся во временную папку.
+Дополнительно проверяется, что обе версии дают одинаковые коды признаков и что
+категории таблиц предобработки совпадают с классами прежних энкодеров.
+
+Запуск из папки ml_service:
+    python benchmarks/bench_load_data.py [--rows 3000000] [--chunksize 500000]
+"""
+import argparse
+import json
+import os
+import pickle
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CATEGORIES = {
+    "cap-shape": list("xfsbocp") + ["3 x", "2.85"],
+    "cap-surface": list("tsyhgdeikwlr"),
+    "cap-color": list("nwygeobrpulfk"),
+    "does-bruise-or-bleed": list("ft"),
+    "gill-attachment": list("adxespf"),
+    "gill-spacing": list("cdf"),
+    "gill-color": list("wnypgofkerub"),
+    "stem-surface": list("sykfthig"),
+    "stem-color": list("wnyogeurpkbfl"),
+    "has-ring": list("ft"),
+    "ring-type": list("fezlrpgm"),
+    "habitat": list("dglmhpwu"),
+    "season": list("auws"),
+}
+NAN_SHARE = {"cap-surface": 0.2, "gill-attachment": 0.15, "gill-spacing": 0.4, "stem-surface": 0.6, "ring-type": 0.04}
+
+def generate_dataset(path, rows, seed=42, chunk=500_000):
+    """Пишет синтетический train.csv указанного размера (по частям, чтобы не занимать память)."""
+    rng = np.random.default_rng(seed)
+    for start in range(0, rows, chunk):
+        n = min(chunk, rows - start)
+        df = pd.DataFrame({"id": np.arange(start, start + n), "class": rng.choice(["e", "p"], n)})
+        df["cap-diameter"] = np.round(rng.gamma(2.0, 3.0, n), 2)
+        for col, values in CATEGORIES.items():
+            column = rng.choice(values, n).astype(object)
+            column[rng.random(n) < NAN_SHARE.get(col, 0.001)] = np.nan
+            df[col] = column
+        df["stem-height"] = np.round(rng.gamma(2.0, 3.0, n), 2)
+        df["stem-width"] = np.round(rng.gamma(2.0, 5.0, n), 2)
+        for col in ["stem-root", "veil-type", "veil-color", "spore-print-color"]:
+            df[col] = np.where(rng.random(n) < 0.9, None, "x")
+        df.to_csv(path, mode="w" if start == 0 else "a", header=start == 0, index=False)
+
+def legacy_load_data(path, imputer_dir, encoder_dir):
+    """Прежняя реализация train_models.load_data (для сравнения)."""
+    from sklearn.impute import SimpleImputer
+    from sklearn.preprocessing import LabelEncoder
+    import train_models as tm
+
+    df = pd.read_csv(path)
+    columns_to_drop = ['id'] if 'id' in df.columns else []
+    columns_to_drop.extend([col for col in tm.DROP_COLUMNS if col in df.columns])
+    df = df.drop(columns=columns_to_drop)
+    num_imputer = SimpleImputer(strategy='median')
+    for col in tm.NUMERICAL_COLUMNS:
+        df[col] = num_imputer.fit_transform(df[[col]]).ravel()
+        with open(os.path.join(imputer_dir, f'imputer_{col}.pkl'), 'wb') as f:
+            pickle.dump(num_imputer, f)
+    cat_imputer = SimpleImputer(strategy='constant', fill_value='unknown')
+    for col in tm.CATEGORICAL_COLUMNS:
+        df[col] = cat_imputer.fit_transform(df[[col]].astype(str)).ravel()
+        with open(os.path.join(imputer_dir, f'imputer_{col}.pkl'), 'wb') as f:
+            pickle.dump(cat_imputer, f)
+    encoders = {}
+    for col in tm.CATEGORICAL_COLUMNS:
+        le = LabelEncoder()
+        le.fit(np.append(df[col].unique(), 'unknown'))
+        df[col] = le.transform(df[col].astype(str))
+        encoders[col] = le
+        with open(os.path.join(encoder_dir, f'le_{col}.pkl'), 'wb') as f:
+            pickle.dump(le, f)
+    le_class = LabelEncoder()
+    df['class'] = le_class.fit_transform(df['class'])
+    with open(os.path.join(encoder_dir, 'le_class.pkl'), 'wb') as f:
+        pickle.dump(le_class, f)
+    return df.drop(columns=['class']), df['class'], encoders
+
+def run_loader(mode, path, out_dir, chunksize):
+    """Выполняется в дочернем процессе: загружает данные и печатает метрики в JSON."""
+    import train_models as tm
+    started = time.perf_counter()
+    if mode == "legacy":
+        X, y, encoders = legacy_load_data(path, out_dir, out_dir)
+        categories = {col: le.classes_.astype(str).tolist() for col, le in encoders.items()}
+    else:
+        X, y, preprocessing = tm.load_data(path, chunksize)
+        categories = {col: values.tolist() for col, values in preprocessing["categories"].items()}
+    elapsed = time.perf_counter() - started
+    metrics = {
+        "seconds": elapsed,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "result_mb": (X.memory_usage(deep=True).sum() + y.memory_usage(deep=True)) / 2**20,
+    }
+    X[tm.FEATURE_COLUMNS].astype("float32").to_numpy().dump(os.path.join(out_dir, "X.npy"))
+    with open(os.path.join(out_dir, "categories.json"), "w") as f:
+        json.dump(categories, f)
+    print(json.dumps(metrics))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=3_000_000)
+    parser.add_argument("--chunksize", type=int, default=500_000)
+    parser.add_argument("--run", nargs=3, metavar=("MODE", "PATH", "OUT_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_loader(*args.run, chunksize=args.chunksize)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "train.csv")
+        generate_dataset(path, args.rows)
+        print(f"Датасет: {args.rows} строк, {os.path.getsize(path) / 2**20:.0f} МБ CSV")
+        print(f"{'loader':<10} {'time s':>8} {'peak RSS MB':>12} {'X+y MB':>8}")
+        results = {}
+        for mode in ["legacy", "optimized"]:
+            out_dir = os.path.join(tmp, mode)
+            os.makedirs(out_dir)
+            output = subprocess.run(
+                [sys.executable, __file__, "--chunksize", str(args.chunksize), "--run", mode, path, out_dir],
+                check=True, capture_output=True, text=True
+            ).stdout.strip().splitlines()[-1]
+            results[mode] = json.loads(output)
+            m = results[mode]
+            print(f"{mode:<10} {m['seconds']:>8.1f} {m['peak_rss_mb']:>12.0f} {m['result_mb']:>8.0f}")
+
+        same = np.array_equal(
+            np.load(os.path.join(tmp, "legacy", "X.npy"), allow_pickle=True),
+            np.load(os.path.join(tmp, "optimized", "X.npy"), allow_pickle=True)
+        )
+        same_encoders = (
+            json.load(open(os.path.join(tmp, "legacy", "categories.json")))
+            == json.load(open(os.path.join(tmp, "optimized", "categories.json")))
+        )
+        print(f"Одинаковые признаки: {'да' if same else 'нет'}, одинаковые энкодеры: {'да' if same_encoders else 'нет'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Бенчмарк загрузки модели: прежние отдельные .pkl (модель, импутер на каждый
+столбец, энкодер на каждый категориальный столбец) и бандл joblib с mmap_mode="r".
+
+Модели (RandomForest и MLP) обучаются на синтетических данных, артефакты пишутся
+во временную папку. Для каждого формата и модели запускаются --procs отдельных
+процессов (как воркеры fast/bulk/heavy) и --procs дочерних процессов fork после
+загрузки в родителе (как процессы пула prefork после прогрева). По каждому процессу
+печатается время загрузки, RSS и частная память (Private_Clean + Private_Dirty из
+/proc/self/smaps_rollup): всё, что сверх неё, делится с другими процессами.
+
+Запуск из папки ml_service:
+    python benchmarks/bench_model_bundle.py [--rows 200000] [--trees 100] [--procs 3]
+"""
+import argparse
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def memory_mb():
+    """Возвращает (RSS, частная память) процесса в МБ по /proc/self/smaps_rollup."""
+    values = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return values["Rss"], values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+
+def write_artifacts(out_dir, rows, trees):
+    """Обучает модели и пишет артефакты в обоих форматах."""
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.impute import SimpleImputer
+    from sklearn.neural_network import MLPClassifier
+    from sklearn.preprocessing import LabelEncoder
+    from services import prediction_service as ps
+    from services.model_bundle import build_bundle, save_bundle
+
+    rng = np.random.default_rng(0)
+    medians, categories, encoded = {}, {}, {}
+    for col in ps.REQUIRED_COLUMNS:
+        if col in ps.NUMERICAL_COLUMNS:
+            encoded[col] = rng.gamma(2.0, 3.0, rows)
+            medians[col] = float(np.median(encoded[col]))
+        else:
+            categories[col] = np.array(sorted(list("abcdefghij") + ["nan", "unknown"]))
+            encoded[col] = rng.integers(0, len(categories[col]), rows)
+    X = pd.DataFrame(encoded, columns=ps.REQUIRED_COLUMNS)
+    y = (X["cap-diameter"] + rng.normal(0, 2, rows) > 6).astype(int)
+    class_labels = np.array(["e", "p"])
+
+    legacy_dir = os.path.join(out_dir, "legacy")
+    os.makedirs(legacy_dir)
+    for col in ps.NUMERICAL_COLUMNS:
+        with open(os.path.join(legacy_dir, f"imputer_{col}.pkl"), "wb") as f:
+            pickle.dump(SimpleImputer(strategy="median").fit(X[[col]]), f)
+    for col in ps.CATEGORICAL_COLUMNS:
+        with open(os.path.join(legacy_dir, f"imputer_{col}.pkl"), "wb") as f:
+            pickle.dump(SimpleImputer(strategy="constant", fill_value="unknown").fit(pd.DataFrame({col: categories[col]}, dtype=object)), f)
+        with open(os.path.join(legacy_dir, f"le_{col}.pkl"), "wb") as f:
+            pickle.dump(LabelEncoder().fit(categories[col]), f)
+    with open(os.path.join(legacy_dir, "le_class.pkl"), "wb") as f:
+        pickle.dump(LabelEncoder().fit(class_labels), f)
+
+    models = {
+        "RandomForest": RandomForestClassifier(n_estimators=trees, random_state=0, n_jobs=-1),
+        "NeuralNetwork": MLPClassifier(hidden_layer_sizes=(2048, 2048), max_iter=2, random_state=0),
+    }
+    for name, model in models.items():
+        # MLP нужен только ради размера весов, поэтому обучается на части строк
+        subset = slice(None) if name == "RandomForest" else slice(5000)
+        model.fit(X[subset], y[subset])
+        with open(os.path.join(legacy_dir, f"{name}.pkl"), "wb") as f:
+            pickle.dump(model, f)
+        save_bundle(build_bundle(name, model, medians, categories, class_labels, ps.REQUIRED_COLUMNS),
+                    os.path.join(out_dir, "bundles"))
+
+def load(mode, name, out_dir):
+    """Загружает модель выбранным способом и выполняет одно предсказание."""
+    from services import prediction_service as ps
+    from services import model_bundle
+    ps.MODEL_DIR = ps.IMPUTER_DIR = ps.ENCODER_DIR = os.path.join(out_dir, "legacy")
+    model_bundle.BUNDLE_DIR = os.path.join(out_dir, "bundles" if mode == "bundle" else "missing")
+    artifacts = ps.load_model_artifacts(name)
+    ps.predict_dataframe(ps.build_warmup_frame(artifacts), artifacts)
+    return artifacts
+
+def run_process(mode, name, out_dir):
+    """Отдельный процесс: загрузка с нуля."""
+    from services import prediction_service  # noqa: F401 - импорт библиотек не входит во время загрузки
+    base_rss, base_private = memory_mb()
+    started = time.perf_counter()
+    load(mode, name, out_dir)
+    elapsed = time.perf_counter() - started
+    rss, private = memory_mb()
+    print(json.dumps({"seconds": elapsed, "rss_mb": rss - base_rss, "private_mb": private - base_private}))
+
+def run_forked(mode, name, out_dir, procs):
+    """Родитель загружает модель и делает fork: дочерние процессы предсказывают на унаследованной модели."""
+    from services import prediction_service as ps
+    base_rss, base_private = memory_mb()
+    started = time.perf_counter()
+    artifacts = load(mode, name, out_dir)
+    elapsed = time.perf_counter() - started
+    results = []
+    for _ in range(procs):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            ps.predict_dataframe(ps.build_warmup_frame(artifacts), artifacts)
+            rss, private = memory_mb()
+            os.write(write_fd, json.dumps({"rss_mb": rss - base_rss, "private_mb": private}).encode())
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            results.append(json.loads(f.read()))
+        os.waitpid(pid, 0)
+    print(json.dumps({"seconds": elapsed, "children": results}))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--trees", type=int, default=100)
+    parser.add_argument("--procs", type=int, default=3)
+    parser.add_argument("--run", nargs=4, metavar=("KIND", "MODE", "NAME", "OUT_DIR"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        kind, mode, name, out_dir = args.run
+        if kind == "process":
+            run_process(mode, name, out_dir)
+        else:
+            run_forked(mode, name, out_dir, args.procs)
+        return
+
+    def child(kind, mode, name):
+        output = subprocess.run(
+            [sys.executable, __file__, "--procs", str(args.procs), "--run", kind, mode, name, tmp],
+            check=True, capture_output=True, text=True
+        ).stdout.strip().splitlines()[-1]
+        return json.loads(output)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_artifacts(tmp, args.rows, args.trees)
+        for name in ["RandomForest", "NeuralNetwork"]:
+            size = os.path.getsize(os.path.join(tmp, "bundles", f"{name}.joblib")) / 2**20
+            print(f"{name} (бандл {size:.0f} МБ)")
+            print(f"  {'format':<8} {'load s':>7} {'RSS MB':>8} {'private MB':>11}  {'fork: child private MB':>22}")
+            for mode in ["legacy", "bundle"]:
+                processes = [child("process", mode, name) for _ in range(args.procs)]
+                forked = child("fork", mode, name)
+                load_s = np.mean([p["seconds"] for p in processes])
+                rss = np.mean([p["rss_mb"] for p in processes])
+                private = np.mean([p["private_mb"] for p in processes])
+                child_private = np.mean([c["private_mb"] for c in forked["children"]])
+                print(f"  {mode:<8} {load_s:>7.2f} {rss:>8.0f} {private:>11.0f}  {child_private:>22.0f}")
+
+if __name__ == "__main__":
+    main()
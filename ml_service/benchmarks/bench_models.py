@@ -0,0 +1,76 @@
+"""
+Бенчмарк моделей: время обучения, пропускная способность предсказания и F1 для
+RandomForest, GradientBoosting, NeuralNetwork и HistGradientBoosting (нативные
+категории), а также HistGradientBoosting на тех же кодах как на порядковых числах.
+
+Датасет генерируется синтетически по образцу train.csv (benchmarks/bench_load_data.py),
+класс задаётся скрытым правилом: у каждой категории свой вес, не связанный с её кодом,
+плюс вклад числовых признаков и шум. Признаки готовятся train_models.load_data,
+модели - из train_models.build_models с распределением ядер default_n_jobs.
+Пропускная способность меряется в один поток, как в процессе пула воркера.
+
+Запуск из папки ml_service:
+    python benchmarks/bench_models.py [--rows 300000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.metrics import f1_score
+from sklearn.model_selection import train_test_split
+from threadpoolctl import threadpool_limits
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import train_models as tm  # noqa: E402
+from bench_load_data import CATEGORIES, generate_dataset  # noqa: E402
+
+def assign_labels(path, seed=0):
+    """Перезаписывает класс в датасете по скрытому правилу (категории + числовые признаки + шум)."""
+    rng = np.random.default_rng(seed)
+    df = pd.read_csv(path)
+    score = 0.4 * (df["cap-diameter"].fillna(6) - 6) - 0.1 * (df["stem-width"] - 10)
+    for col, values in CATEGORIES.items():
+        weights = dict(zip(values + [np.nan], rng.normal(0, 1, len(values) + 1)))
+        score += df[col].map(weights).fillna(weights[np.nan])
+    score += rng.normal(0, 0.7, len(df))
+    df["class"] = np.where(score > np.median(score), "p", "e")
+    df.to_csv(path, index=False)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=300_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "train.csv")
+        generate_dataset(path, args.rows)
+        assign_labels(path)
+        X, y, preprocessing = tm.load_data(path)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+    n_jobs = tm.default_n_jobs()
+    models = tm.build_models(n_jobs, preprocessing["categories"])
+    hist = next(model for model, name in models if name == "HistGradientBoosting")
+    models.append((clone(hist).set_params(categorical_features=None), "HistGB (ordinal)"))
+    sample = X_test.iloc[:tm.LATENCY_ROWS]
+
+    print(f"Датасет: {args.rows} строк, обучение {len(X_train)}, тест {len(X_test)}, ядер {os.cpu_count()}")
+    print(f"{'model':<22} {'n_jobs':>6} {'fit s':>8} {'rows/s':>10} {'F1':>7} {'size MB':>8}")
+    for model, name in models:
+        jobs = n_jobs.get(name, n_jobs["HistGradientBoosting"])
+        started = time.perf_counter()
+        with threadpool_limits(limits=jobs):
+            tm.fit_with_progress(model, X_train, y_train, lambda done, total: None)
+        fit_seconds = time.perf_counter() - started
+        f1 = f1_score(y_test, model.predict(X_test), average="weighted")
+        inference = tm.measure_inference(model, sample)
+        print(f"{name:<22} {jobs:>6} {fit_seconds:>8.1f} {1e6 / inference['latency_us']:>10.0f} {f1:>7.4f} {inference['size_mb']:>8.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
 from celery import Celery
+from kombu import Queue
 import logging
 from logging.handlers import RotatingFileHandler
 import redis
-from celery.signals import celeryd_init
+from celery.signals import celeryd_init, worker_process_init
+import json
 import os
+import time
+from typing import Any, Dict, List, Optional
 
 # Get Redis configuration from environment with defaults
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
@@ -11,6 +15,109 @@ REDIS_PORT = os.getenv("REDIS_PORT", "6379")
 REDIS_DB = os.getenv("REDIS_DB", "0")
 REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
 
+# Адаптивная конкурентность и prefetch (services/autoscaler.py), работает с --autoscale=max,min
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "0") == "1"
+
+# Прогрев моделей при старте воркера (WORKER_WARMUP=0 отключает)
+WORKER_WARMUP = os.getenv("WORKER_WARMUP", "1") == "1"
+WORKER_READY_KEY = "ml_service:worker_ready:{hostname}"
+
+# Очереди предсказаний по объёму работы (строки × стоимость модели).
+# Каждую очередь обслуживает отдельный воркер со своим пулом (см. Makefile),
+# поэтому маленькие задачи не ждут за большими файлами.
+FAST_QUEUE = "fast"
+BULK_QUEUE = "bulk"
+HEAVY_QUEUE = "heavy"
+FAST_QUEUE_MAX_WORK = float(os.getenv("FAST_QUEUE_MAX_WORK", "1000"))
+BULK_QUEUE_MAX_WORK = float(os.getenv("BULK_QUEUE_MAX_WORK", "200000"))
+# Если у модели есть профиль (models.profile, измеряется train_models.py), очередь
+# выбирается по ожидаемому времени предсказания в секундах
+FAST_QUEUE_MAX_SECONDS = float(os.getenv("FAST_QUEUE_MAX_SECONDS", "0.5"))
+BULK_QUEUE_MAX_SECONDS = float(os.getenv("BULK_QUEUE_MAX_SECONDS", "30"))
+
+# Большие задания делятся на шарды по PREDICTION_SHARD_SIZE строк,
+# которые параллельно обрабатываются воркерами очереди bulk (Celery chord)
+PREDICTION_SHARD_SIZE = int(os.getenv("PREDICTION_SHARD_SIZE", "50000"))
+
+# Сколько раз задание может продолжиться новой задачей после мягкого лимита времени
+PREDICTION_MAX_CONTINUATIONS = int(os.getenv("PREDICTION_MAX_CONTINUATIONS", "20"))
+
+def estimate_work(rows: int, model_cost: float) -> float:
+    """Оценивает объём работы задачи предсказания в условных единицах."""
+    return rows * max(model_cost, 1.0)
+
+def profile_rows_per_sec(profile: Optional[Dict[str, Any]], rows: int) -> Optional[float]:
+    """
+    Возвращает скорость предсказания модели из её профиля для задания в rows строк.
+
+    Берётся скорость на самом большом измеренном размере пакета, не превышающем rows
+    (для меньших заданий - на самом маленьком пакете).
+
+    Args:
+        profile (Optional[Dict[str, Any]]): Профиль модели (models.profile).
+        rows (int): Количество строк в задании.
+
+    Returns:
+        Optional[float]: Строк в секунду или None, если профиля нет.
+    """
+    measured = sorted(
+        (int(batch), float(rate)) for batch, rate in ((profile or {}).get("rows_per_sec") or {}).items() if rate
+    )
+    if not measured:
+        return None
+    fitting = [rate for batch, rate in measured if batch <= rows]
+    return fitting[-1] if fitting else measured[0][1]
+
+def estimate_seconds(rows: int, profile: Optional[Dict[str, Any]]) -> Optional[float]:
+    """Оценивает время предсказания задания по профилю модели (None, если профиля нет)."""
+    rate = profile_rows_per_sec(profile, rows)
+    return rows / rate if rate else None
+
+def combine_profiles(profiles: List[Optional[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """
+    Строит профиль последовательного прогона нескольких моделей (ансамбля): время на
+    строку складывается. Возвращает None, если хотя бы у одной модели нет профиля.
+    """
+    rates = [(profile or {}).get("rows_per_sec") or {} for profile in profiles]
+    if not rates or not all(rates):
+        return None
+    combined = {
+        batch: 1.0 / sum(1.0 / float(r[batch]) for r in rates)
+        for batch in set.intersection(*(set(r) for r in rates))
+        if all(r[batch] for r in rates)
+    }
+    return {"rows_per_sec": combined} if combined else None
+
+def select_queue(rows: int, model_cost: float, profile: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Выбирает очередь Celery по оценке объёма работы.
+
+    Если у модели есть профиль, объём работы - ожидаемое время предсказания по
+    измеренной скорости модели, иначе - строки × стоимость модели.
+
+    Args:
+        rows (int): Количество строк во входных данных.
+        model_cost (float): Стоимость модели (используется как относительная цена строки).
+        profile (Optional[Dict[str, Any]]): Профиль производительности модели.
+
+    Returns:
+        str: Имя очереди ("fast", "bulk" или "heavy").
+    """
+    seconds = estimate_seconds(rows, profile)
+    if seconds is not None:
+        if seconds <= FAST_QUEUE_MAX_SECONDS:
+            return FAST_QUEUE
+        if seconds <= BULK_QUEUE_MAX_SECONDS:
+            return BULK_QUEUE
+        return HEAVY_QUEUE
+
+    work = estimate_work(rows, model_cost)
+    if work <= FAST_QUEUE_MAX_WORK:
+        return FAST_QUEUE
+    if work <= BULK_QUEUE_MAX_WORK:
+        return BULK_QUEUE
+    return HEAVY_QUEUE
+
 @celeryd_init.connect
 def validate_broker_connection(sender=None, conf=None, **kwargs):
     """Validate Redis connection at worker startup"""
@@ -20,7 +127,62 @@ def validate_broker_connection(sender=None, conf=None, **kwargs):
         logger.info("Successfully connected to Redis")
     except redis.ConnectionError as e:
         logger.error(f"Cannot connect to Redis at {REDIS_URL}: {e}")
-import os
+
+@celeryd_init.connect
+def warm_up_worker(sender=None, conf=None, **kwargs):
+    """
+    Прогревает воркер до начала приёма задач: импортирует pandas/sklearn, загружает
+    в кэш все модели из таблицы models с артефактами предобработки и выполняет по
+    одному прогревочному предсказанию. Дочерние процессы пула наследуют прогретый кэш.
+    """
+    if not WORKER_WARMUP:
+        logger.info("Worker warm-up disabled")
+        return
+    started = time.perf_counter()
+    from database import SessionLocal
+    from services.metrics import record_warmup
+    from services.prediction_service import warm_up_models
+
+    db = SessionLocal()
+    try:
+        report = warm_up_models(db)
+    except Exception as e:
+        logger.error(f"Worker warm-up failed: {e}")
+        report = {}
+    finally:
+        db.close()
+    elapsed = time.perf_counter() - started
+
+    for model_name, model_report in report.items():
+        logger.info(f"metric=worker_warmup_model_seconds model={model_name} ready={model_report['ready']} value={model_report['seconds']:.3f}")
+    # Модели без файла (ещё не обученные) не делают воркер неготовым
+    served = [r for r in report.values() if not r.get("skipped")]
+    ready = bool(served) and all(r["ready"] for r in served)
+    logger.info(f"metric=worker_warmup_seconds worker={sender} ready={ready} value={elapsed:.3f}")
+    record_warmup(str(sender), elapsed, ready, report)
+
+    # Публикуем готовность воркера, чтобы её можно было проверить снаружи
+    try:
+        redis_client = redis.from_url(REDIS_URL)
+        redis_client.set(
+            WORKER_READY_KEY.format(hostname=sender),
+            json.dumps({"ready": ready, "warmup_seconds": elapsed, "models": report})
+        )
+    except redis.RedisError as e:
+        logger.error(f"Cannot publish worker readiness: {e}")
+
+# Экспортер метрик в каждом процессе пула (WORKER_METRICS_PORT + индекс процесса)
+@worker_process_init.connect
+def start_metrics_exporter(**kwargs):
+    from celery.utils.log import current_process_index
+    from services.metrics import start_worker_exporter
+    start_worker_exporter(current_process_index(base=0))
+
+# Горячая подмена новых версий моделей в каждом процессе пула (MODEL_RELOAD_INTERVAL)
+@worker_process_init.connect
+def start_model_version_manager(**kwargs):
+    from services.model_versions import start_model_watcher
+    start_model_watcher()
 
 # Настройка Celery с Redis
 app = Celery(
@@ -42,7 +204,11 @@ app.conf.update(
     task_soft_time_limit=240,  # Мягкий лимит (4 мин)
     task_acks_late=True,  # Подтверждение задачи после выполнения
     worker_prefetch_multiplier=1,  # Обрабатывать одну задачу за раз
+    task_queues=(Queue(FAST_QUEUE), Queue(BULK_QUEUE), Queue(HEAVY_QUEUE)),
+    task_default_queue=FAST_QUEUE,
 )
+if ADAPTIVE_CONCURRENCY:
+    app.conf.worker_autoscaler = "services.autoscaler:AdaptiveAutoscaler"
 
 # Более детальный мониторинг
 logger = logging.getLogger('celery')
@@ -1,6 +1,13 @@
-from sqlalchemy import create_engine
+import logging
+from typing import List
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 # SQLite база данных в файле ml_service.db
 SQLALCHEMY_DATABASE_URL = "sqlite:///./ml_service.db"
 
@@ -20,4 +27,57 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def upgrade_schema(bind: Engine = engine) -> List[str]:
+    """
+    Доводит схему существующей базы до моделей: create_all создаёт только новые таблицы
+    и не меняет уже созданные.
+
+    Недостающие столбцы добавляются через ALTER TABLE ADD COLUMN (новые столбцы
+    допускают NULL). Если столбец в базе NOT NULL, а в модели допускает NULL
+    (predictions.input_data после перехода на спул), таблица пересоздаётся по модели
+    с копированием строк: SQLite не умеет снимать NOT NULL.
+
+    Вызывается после Base.metadata.create_all, когда все модели db.* уже импортированы.
+
+    Args:
+        bind (Engine): Движок базы (по умолчанию engine сервиса).
+
+    Returns:
+        List[str]: Описания выполненных изменений.
+    """
+    changes = []
+    with bind.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"]: column for column in inspector.get_columns(table.name)}
+            relaxed = [
+                column.name for column in table.columns
+                if column.name in existing and column.nullable and not existing[column.name]["nullable"]
+            ]
+            if relaxed:
+                # Старая таблица переименовывается без перезаписи внешних ключей других таблиц
+                # (legacy_alter_table), её индексы удаляются, чтобы создать их заново по модели
+                copied = ", ".join(f'"{name}"' for name in existing if name in table.columns)
+                indexes = [index["name"] for index in inspector.get_indexes(table.name)]
+                conn.execute(text("PRAGMA legacy_alter_table=ON"))
+                conn.execute(text(f'ALTER TABLE "{table.name}" RENAME TO "{table.name}_old"'))
+                conn.execute(text("PRAGMA legacy_alter_table=OFF"))
+                for index in indexes:
+                    conn.execute(text(f'DROP INDEX IF EXISTS "{index}"'))
+                table.create(conn)
+                conn.execute(text(f'INSERT INTO "{table.name}" ({copied}) SELECT {copied} FROM "{table.name}_old"'))
+                conn.execute(text(f'DROP TABLE "{table.name}_old"'))
+                changes.append(f"{table.name}: пересоздана, допускают NULL: {', '.join(relaxed)}")
+                continue
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                    changes.append(f"{table.name}: добавлен столбец {column.name}")
+    for change in changes:
+        logger.info(f"Обновление схемы БД: {change}")
+    return changes
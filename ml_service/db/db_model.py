@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float
+from sqlalchemy import Column, Integer, String, Float, JSON
 from database import Base
 
 class DBModel(Base):
@@ -6,4 +6,5 @@ class DBModel(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, unique=True, nullable=False)
     cost = Column(Float, nullable=False)
-    file_path = Column(String, nullable=False)
\ No newline at end of file
+    file_path = Column(String, nullable=False)
+    profile = Column(JSON, nullable=True)  # Профиль производительности: строк/с по размерам пакета, загрузка, память
\ No newline at end of file
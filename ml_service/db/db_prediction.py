@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, JSON, DateTime
+from sqlalchemy import Column, Integer, String, JSON, DateTime, Boolean
 from database import Base
 from datetime import datetime, timezone
 
@@ -7,7 +7,12 @@ class DBPrediction(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False)
     model_id = Column(Integer, nullable=False)
-    input_data = Column(JSON, nullable=False)
+    input_data = Column(JSON, nullable=True)  # Старые записи; новые хранят данные в спуле
+    input_path = Column(String, nullable=True)  # Файл Arrow IPC со входными данными (services/spool.py)
     result = Column(JSON, nullable=True)  
+    progress = Column(JSON, nullable=True)  # Ход выполнения: строки, скорость, ETA
+    ensemble = Column(JSON, nullable=True)  # Ансамбль: model_ids, models, cost и метки каждой модели (results)
+    model_versions = Column(JSON, nullable=True)  # Версии моделей, закреплённые при запуске задачи: {имя модели: отпечаток}
+    usage_recorded = Column(Boolean, default=False)  # Агрегаты использования (usage) уже учли это предсказание
     status = Column(String, default="pending")
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
\ No newline at end of file
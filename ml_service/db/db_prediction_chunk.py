@@ -0,0 +1,14 @@
+from sqlalchemy import Column, Integer, JSON, DateTime, ForeignKey, UniqueConstraint
+from database import Base
+from datetime import datetime, timezone
+
+class DBPredictionChunk(Base):
+    """Чекпоинт предсказания: результат для диапазона строк [start_row, end_row)."""
+    __tablename__ = "prediction_chunks"
+    __table_args__ = (UniqueConstraint("prediction_id", "start_row", name="uq_prediction_chunk_start"),)
+    id = Column(Integer, primary_key=True, index=True)
+    prediction_id = Column(Integer, ForeignKey("predictions.id"), nullable=False, index=True)
+    start_row = Column(Integer, nullable=False)
+    end_row = Column(Integer, nullable=False)
+    result = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
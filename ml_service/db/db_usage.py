@@ -0,0 +1,16 @@
+from sqlalchemy import Column, Integer, Float, Date, DateTime, UniqueConstraint
+from database import Base
+from datetime import datetime, timezone
+
+class DBUsage(Base):
+    """Агрегаты использования: одна строка на пару (пользователь, модель) за сутки."""
+    __tablename__ = "usage_stats"
+    __table_args__ = (UniqueConstraint("user_id", "model_id", "day", name="uq_usage_user_model_day"),)
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, nullable=False, index=True)
+    model_id = Column(Integer, nullable=False)
+    day = Column(Date, nullable=False)
+    predictions_count = Column(Integer, default=0, nullable=False)
+    rows_scored = Column(Integer, default=0, nullable=False)
+    credits_spent = Column(Float, default=0.0, nullable=False)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
@@ -1,13 +1,20 @@
 # init_models.py
 from sqlalchemy.orm import Session
-from database import SessionLocal, engine, Base
+from database import SessionLocal, engine, Base, upgrade_schema
 from db.db_model import DBModel
 from db.db_user import DBUser
 from db.db_prediction import DBPrediction
 from db.db_transaction import DBTransaction
+from db.db_usage import DBUsage
+from db.db_prediction_chunk import DBPredictionChunk
+from services.prediction_service import find_model_file
 
-# Создание всех таблиц
+# Создание всех таблиц и добавление новых столбцов в уже созданные
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
+
+# Модели, которые есть только в виде бандла train_models.py: регистрируются, когда бандл уже сохранён
+BUNDLE_ONLY_MODELS = ("HistGradientBoosting", "RandomForestLite")
 
 def init_models():
     db: Session = SessionLocal()
@@ -15,11 +22,18 @@ def init_models():
         models = [
             DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"),
             DBModel(id=2, name="GradientBoosting", cost=2.0, file_path="ml_models/trained_ml_models/GradientBoosting.pkl"),
-            DBModel(id=3, name="NeuralNetwork", cost=3.0, file_path="ml_models/trained_ml_models/NeuralNetwork.pkl")
+            DBModel(id=3, name="NeuralNetwork", cost=3.0, file_path="ml_models/trained_ml_models/NeuralNetwork.pkl"),
+            DBModel(id=4, name="HistGradientBoosting", cost=1.5, file_path="ml_models/bundles/HistGradientBoosting.joblib"),
+            DBModel(id=5, name="RandomForestLite", cost=0.5, file_path="ml_models/bundles/RandomForestLite.joblib")
         ]
-        db.add_all(models)
+        not_trained = [m.name for m in models if m.name in BUNDLE_ONLY_MODELS and not find_model_file(m.name)]
+        if not_trained:
+            print(f"Skipping models without bundles (run train_models.py): {', '.join(not_trained)}")
+        # Добавляем только отсутствующие модели, чтобы скрипт можно было запускать на существующей БД
+        missing = [m for m in models if db.get(DBModel, m.id) is None and m.name not in not_trained]
+        db.add_all(missing)
         db.commit()
-        print("Models initialized successfully.")
+        print(f"Models initialized successfully ({len(missing)} added).")
     except Exception as e:
         print(f"Error initializing models: {str(e)}")
         db.rollback()
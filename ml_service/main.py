@@ -1,10 +1,12 @@
 import json
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile
+from fastapi import FastAPI, Depends, HTTPException, Request, status, File, UploadFile, Query
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
+import pandas as pd
 from sqlalchemy.orm import Session
-import os
+import time
 
 from services.auth import (
     User, 
@@ -14,24 +16,34 @@ from services.auth import (
     create_access_token, 
     register_user, 
     get_user, 
-    deduct_balance, 
     increase_balance)
 
-from services.prediction_service import read_input_file, make_prediction, get_available_models, validate_input_data
+from services.prediction_service import (
+    read_input_file, make_prediction, get_available_models, validate_input_data, coerce_input_data, find_model_file,
+    read_json_records, read_ndjson_lines, NDJSON_BATCH_ROWS, INPUT_FILE_TYPES,
+    ENSEMBLE_METRIC_NAME, CASCADE_METRIC_NAME, CASCADE_THRESHOLD)
+from services.spool import write_input_spool, delete_input_spool
+from services.model_bundle import bundle_path
 from models.transaction import Transaction
 from services.db_operations import create_transaction
 from models.prediction import Prediction
 from models.model import Model
-from datetime import timedelta, datetime, timezone
-from database import engine, Base, get_db
-from celery_app import app as celery_app
-from services.db_operations import create_prediction
+from models.usage import Usage, UsageReport, UsageStats
+from datetime import date, timedelta, datetime, timezone
+from database import engine, Base, get_db, upgrade_schema
+from celery_app import app as celery_app, select_queue, combine_profiles
+from services.db_operations import create_prediction, credit_user, debit_user, get_usage
+from services.events import prediction_event_stream
+from services.metrics import observe_stage, timed
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 # SQLAlchemy-модели
 from db.db_user import DBUser
 from db.db_model import DBModel
 from db.db_prediction import DBPrediction
 from db.db_transaction import DBTransaction
+from db.db_usage import DBUsage
+from db.db_prediction_chunk import DBPredictionChunk
 
 import logging
 logger = logging.getLogger(__name__)
@@ -42,9 +54,13 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 MAX_FILE_SIZE = 200 * 1024 * 1024  # 200 MB
+# Типы тела запроса с записями о грибах вместо файла (массив JSON и NDJSON - объект на строку)
+RECORDS_CONTENT_TYPES = ("application/json", "application/x-ndjson", "application/ndjson", "application/jsonl")
+MAX_USAGE_PERIOD_DAYS = 366  # Ограничивает число строк агрегатов в ответе /usage
 
-# Создание таблиц при запуске
+# Создание таблиц при запуске и добавление новых столбцов в уже созданные
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
 
 # app = FastAPI()
 app = FastAPI(
@@ -56,6 +72,7 @@ app = FastAPI(
         {"name": "models", "description": "Получение списка доступных ML-моделей"},
         {"name": "predictions", "description": "Запрос и получение предсказаний"},
         {"name": "account", "description": "Управление балансом и транзакциями"},
+        {"name": "monitoring", "description": "Метрики сервиса"},
     ]
 )
 
@@ -168,95 +185,222 @@ async def get_models(current_user: User = Depends(get_current_user), db: Session
         db (Session): Сессия SQLAlchemy для доступа к базе данных.
 
     Returns:
-        list[Model]: Список объектов моделей с их ID, именем и стоимостью.
+        list[Model]: Список объектов моделей с их ID, именем, стоимостью и профилем производительности.
 
     Raises:
         HTTPException: Если пользователь не аутентифицирован (401).
     """
     return get_available_models(db)
 
-# Запрос на получение предсказания
-@app.post("/predict", response_model=Prediction, tags=["predictions"])
-async def predict(
-    model_id: int,
-    file: UploadFile = File(...),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
-):
+async def read_upload(file: UploadFile) -> Tuple[pd.DataFrame, float, float]:
     """
-    Запускает асинхронное предсказание с использованием ML-модели.
+    Проверяет загруженный файл, разбирает его, валидирует и приводит признаки к типам модели.
 
     Args:
-        model_id (int): ID выбранной ML-модели.
-        file (UploadFile): Загружаемый файл (CSV или XLSX) с входными данными.
-        current_user (User): Объект текущего пользователя для аутентификации.
-        db (Session): Сессия SQLAlchemy для доступа к базе данных.
+        file (UploadFile): Загружаемый файл (CSV, XLSX, Parquet или Arrow IPC).
 
     Returns:
-        Prediction: Объект предсказания с текущим статусом ("pending").
+        Tuple[pd.DataFrame, float, float]: Входные данные, время разбора и время валидации (с).
 
     Raises:
-        HTTPException: Если файл отсутствует, имеет неверный формат, модель не найдена,
-                       баланс недостаточен или пользователь не аутентифицирован (400, 401).
+        HTTPException: Если файл отсутствует, слишком большой, имеет неверный формат или некорректные данные (400).
     """
     if file.size is None or file.size > MAX_FILE_SIZE:
-        raise HTTPException(status_code=400, detail="File too large or invalid, max 200MB. Please upload a valid CSV or XLSX file.")
+        raise HTTPException(status_code=400, detail="File too large or invalid, max 200MB. Please upload a valid CSV, XLSX, Parquet or Arrow file.")
 
     # Проверка расширения файла
     if not file.filename:
-        raise HTTPException(status_code=400, detail="No file provided. Please upload a CSV or XLSX file.")
+        raise HTTPException(status_code=400, detail="No file provided. Please upload a CSV, XLSX, Parquet or Arrow file.")
     
     file_type = file.filename.split(".")[-1].lower()
    
-    if file_type not in ["csv", "xlsx"]:
-        raise HTTPException(status_code=400, detail=f"Unsupported file format: {file_type}. Use CSV or XLSX.")
+    if file_type not in INPUT_FILE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported file format: {file_type}. Use CSV, XLSX, Parquet or Arrow.")
     
     # Чтение файла
     content = await file.read()
+    started = time.perf_counter()
     input_data = read_input_file(content, file_type)
+    parse_seconds = time.perf_counter() - started
 
-    # Валидация входных данных
+    # Валидация входных данных и приведение к типам признаков
+    started = time.perf_counter()
     validate_input_data(input_data)
+    input_data = coerce_input_data(input_data)
+    validation_seconds = time.perf_counter() - started
+    return input_data, parse_seconds, validation_seconds
 
-    # Проверка модели
-    models = get_available_models(db)
-    selected_model = next((m for m in models if m.id == model_id), None)
-    if not selected_model:
-        raise HTTPException(status_code=400, detail=f"Model ID {model_id} not found. Check available models with GET /models.")
-    
-    # Проверка существования файла модели
-    model_path = os.path.join("ml_models", "trained_ml_models", f"{selected_model.name}.pkl")
-    if not os.path.exists(model_path):
-        raise HTTPException(status_code=500, detail=f"Model file not found: {model_path}")
-    
-    # Проверка баланса
-    if current_user.balance < selected_model.cost:
-        raise HTTPException(status_code=400, detail=f"Insufficient balance: {current_user.balance}. Required: {selected_model.cost}. Increase balance via POST /payment.")
-    
-    # Создание записи предсказания со статусом "pending"
-    db_prediction = create_prediction(
-        db,
-        user_id=current_user.id,
-        model_id=model_id,
-        input_data=input_data,
-        status="pending"
-    )
+async def read_records_body(request: Request, content_type: str) -> Tuple[pd.DataFrame, float, float]:
+    """
+    Читает записи о грибах из тела запроса: JSON-массив или поток NDJSON.
 
-    # Списание токенов и запись транзакции
-    deduct_balance(db, current_user.username, selected_model.cost)
-    create_transaction(
-        db,
-        user_id=current_user.id,
-        amount=-selected_model.cost,
-        description=f"Prediction using model {selected_model.name}"
-    )
+    Размер тела ограничен MAX_FILE_SIZE: запрос отклоняется по Content-Length или,
+    если заголовка нет, как только получено больше. JSON-массив разбирается целиком
+    после получения. NDJSON читается потоком: строки копятся пакетами по
+    NDJSON_BATCH_ROWS, каждый пакет проверяется по схеме MushroomRecord и сразу
+    переводится в столбцы, поэтому в памяти не держатся одновременно тело запроса
+    и словари всех записей.
 
-    # Запуск асинхронной задачи
+    Args:
+        request (Request): Запрос с телом application/json или application/x-ndjson.
+        content_type (str): Тип содержимого без параметров.
+
+    Returns:
+        Tuple[pd.DataFrame, float, float]: Входные данные, время разбора со схемной
+            проверкой и время сборки столбцов (с).
+
+    Raises:
+        HTTPException: Если тело слишком большое, пустое или записи некорректны (400).
+    """
+    started = time.perf_counter()
+    # Заведомо слишком большое тело отклоняется до чтения, остальное - по мере получения
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_FILE_SIZE:
+        raise HTTPException(status_code=400, detail="Request body too large, max 200MB.")
+    received = 0
+    if content_type == "application/json":
+        body = bytearray()
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_FILE_SIZE:
+                raise HTTPException(status_code=400, detail="Request body too large, max 200MB.")
+            body += chunk
+        frames = [read_json_records(bytes(body))]
+    else:
+        frames = []
+        rows = 0
+        pending: List[bytes] = []
+        buffer = bytearray()  # неполная последняя строка
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_FILE_SIZE:
+                raise HTTPException(status_code=400, detail="Request body too large, max 200MB.")
+            # Делится только новый фрагмент, хвост без перевода строки дописывается в буфер
+            *lines, tail = chunk.split(b"\n")
+            if lines:
+                lines[0] = bytes(buffer) + lines[0]
+                buffer = bytearray(tail)
+            else:
+                buffer += tail
+            pending.extend(line for line in lines if line.strip())
+            while len(pending) >= NDJSON_BATCH_ROWS:
+                batch, pending = pending[:NDJSON_BATCH_ROWS], pending[NDJSON_BATCH_ROWS:]
+                frames.append(read_ndjson_lines(batch, rows))
+                rows += len(batch)
+        if buffer.strip():
+            pending.append(bytes(buffer))
+        if pending:
+            frames.append(read_ndjson_lines(pending, rows))
+    parse_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    input_data = pd.concat(frames, ignore_index=True) if len(frames) > 1 else (frames[0] if frames else None)
+    if input_data is None or input_data.empty:
+        raise HTTPException(status_code=400, detail="No records provided.")
+    return input_data, parse_seconds, time.perf_counter() - started
+
+async def read_prediction_input(request: Request, file: Optional[UploadFile]) -> Tuple[pd.DataFrame, float, float]:
+    """
+    Читает входные данные предсказания: файл (multipart) или записи в теле запроса
+    (application/json - массив объектов, application/x-ndjson - объект на строку).
+
+    Returns:
+        Tuple[pd.DataFrame, float, float]: Входные данные, время разбора и время валидации (с).
+
+    Raises:
+        HTTPException: Если данных нет или они некорректны (400).
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if file is None and content_type in RECORDS_CONTENT_TYPES:
+        return await read_records_body(request, content_type)
+    if file is None:
+        raise HTTPException(status_code=400, detail="No file provided. Please upload a CSV, XLSX, Parquet or Arrow file or send JSON/NDJSON records.")
+    return await read_upload(file)
+
+def submit_prediction(
+    db: Session,
+    current_user: User,
+    input_data: pd.DataFrame,
+    model_id: int,
+    cost: float,
+    description: str,
+    metric_name: str,
+    queue: str,
+    ensemble: Optional[Dict[str, Any]] = None
+) -> Prediction:
+    """
+    Передаёт входные данные в спул, создаёт запись предсказания, списывает кредиты
+    вместе с записью транзакции одним коммитом и отправляет задачу в очередь.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        current_user (User): Текущий пользователь.
+        input_data (pd.DataFrame): Проверенные входные данные.
+        model_id (int): ID модели (для ансамбля - первой модели).
+        cost (float): Списываемая стоимость.
+        description (str): Описание транзакции.
+        metric_name (str): Имя модели в метриках.
+        queue (str): Очередь Celery.
+        ensemble (Optional[Dict[str, Any]]): Модели ансамбля (model_ids, models, cost).
+
+    Returns:
+        Prediction: Объект предсказания со статусом "pending".
+
+    Raises:
+        HTTPException: Если недостаточно средств (400) или пользователь не найден (404);
+            если задачу не удалось поставить в очередь (500) - тогда предсказание
+            помечается "failed", спул удаляется, а стоимость возвращается.
+    """
+    # Входные данные передаются воркеру через спул (Arrow IPC), в БД хранится только путь
+    input_path = write_input_spool(input_data)
+
+    db_prediction = None
+    try:
+        with timed("db_write", metric_name, len(input_data)):
+            # Создание записи предсказания со статусом "pending"
+            db_prediction = create_prediction(
+                db,
+                user_id=current_user.id,
+                model_id=model_id,
+                input_path=input_path,
+                status="pending",
+                ensemble=ensemble
+            )
+
+            # Списание токенов и запись транзакции одним коммитом: либо оба, либо ничего
+            try:
+                charged = debit_user(db, current_user.id, cost, description, prediction_id=db_prediction.id)
+            except ValueError as e:
+                logger.error(f"Списание провалено: {str(e)}")
+                raise HTTPException(status_code=400, detail="Недостаточно средств")
+            if charged is None:
+                raise HTTPException(status_code=404, detail="Пользователь не найден")
+    except Exception:
+        # Списание не прошло (баланс не изменён): запись предсказания (если создана)
+        # не должна ссылаться на удалённый спул
+        delete_input_spool(input_path)
+        if db_prediction is not None:
+            db.rollback()
+            db_prediction.status = "failed"
+            db.commit()
+        raise
+
+    # Запуск асинхронной задачи в очереди, соответствующей объёму работы
     try:
-        task = celery_app.send_task("services.tasks.predict_task", args=[db_prediction.id])
-        logger.info(f"Задача отправлена: predict_task with prediction_id={db_prediction.id}, task_id={task.id}")
+        task = celery_app.send_task("services.tasks.predict_task", args=[db_prediction.id], queue=queue)
+        logger.info(f"Задача отправлена: predict_task with prediction_id={db_prediction.id}, task_id={task.id}, queue={queue}")
     except Exception as e:
         logger.error(f"Не удалось отправить задачу для prediction_id={db_prediction.id}: {str(e)}")
+        # Задача не поставлена в очередь: спул не нужен, предсказание не выполнится - оплата возвращается
+        delete_input_spool(input_path)
+        db_prediction.status = "failed"
+        credit_user(
+            db,
+            user_id=current_user.id,
+            amount=cost,
+            description=f"Refund for unqueued prediction {db_prediction.id}",
+            prediction_id=db_prediction.id
+        )
         raise HTTPException(status_code=500, detail=f"Failed to queue task: {str(e)}")
     
     # Возвращаем объект Prediction с текущим статусом
@@ -267,10 +411,239 @@ async def predict(
         input_data=db_prediction.input_data,
         result=db_prediction.result,
         status=db_prediction.status,
+        ensemble=db_prediction.ensemble,
         created_at=db_prediction.created_at,
         task_id=str(task.id)
     )
 
+# Запрос на получение предсказания
+@app.post("/predict", response_model=Prediction, tags=["predictions"])
+async def predict(
+    request: Request,
+    model_id: int,
+    file: Optional[UploadFile] = File(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Запускает асинхронное предсказание с использованием ML-модели.
+
+    Входные данные - файл CSV/XLSX/Parquet/Arrow (multipart) или записи в теле запроса:
+    JSON-массив объектов (Content-Type: application/json) для небольших запросов
+    или NDJSON, объект на строку (application/x-ndjson), для больших - тело читается
+    потоком. Ключи записей - столбцы REQUIRED_COLUMNS, null - пропуск.
+
+    Args:
+        model_id (int): ID выбранной ML-модели.
+        request (Request): Запрос (тело JSON или NDJSON, если файл не загружен).
+        file (Optional[UploadFile]): Загружаемый файл (CSV, XLSX, Parquet или Arrow IPC) с входными данными.
+        current_user (User): Объект текущего пользователя для аутентификации.
+        db (Session): Сессия SQLAlchemy для доступа к базе данных.
+
+    Returns:
+        Prediction: Объект предсказания с текущим статусом ("pending").
+
+    Raises:
+        HTTPException: Если файл отсутствует, имеет неверный формат, модель не найдена,
+                       баланс недостаточен или пользователь не аутентифицирован (400, 401).
+    """
+    input_data, parse_seconds, validation_seconds = await read_prediction_input(request, file)
+
+    # Проверка модели
+    models = get_available_models(db)
+    selected_model = next((m for m in models if m.id == model_id), None)
+    if not selected_model:
+        raise HTTPException(status_code=400, detail=f"Model ID {model_id} not found. Check available models with GET /models.")
+    
+    # Проверка существования файла модели (бандла или отдельного .pkl)
+    if not find_model_file(selected_model.name):
+        raise HTTPException(status_code=500, detail=f"Model file not found: {bundle_path(selected_model.name)}")
+    
+    # Проверка баланса
+    if current_user.balance < selected_model.cost:
+        raise HTTPException(status_code=400, detail=f"Insufficient balance: {current_user.balance}. Required: {selected_model.cost}. Increase balance via POST /payment.")
+    
+    observe_stage("parse", parse_seconds, selected_model.name, len(input_data))
+    observe_stage("validation", validation_seconds, selected_model.name, len(input_data))
+
+    return submit_prediction(
+        db, current_user, input_data, model_id, selected_model.cost,
+        description=f"Prediction using model {selected_model.name}",
+        metric_name=selected_model.name,
+        queue=select_queue(len(input_data), selected_model.cost, selected_model.profile)
+    )
+
+def select_member_models(db: Session, model_ids: List[int], kind: str) -> List[Model]:
+    """
+    Проверяет модели ансамбля или каскада: не меньше двух разных, все есть в БД и на диске.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        model_ids (List[int]): ID моделей в порядке запроса.
+        kind (str): "Ensemble" или "Cascade" (для текста ошибки).
+
+    Returns:
+        List[Model]: Модели в порядке model_ids.
+
+    Raises:
+        HTTPException: Если моделей меньше двух, они повторяются или модель не найдена (400),
+                       файл модели отсутствует (500).
+    """
+    if len(model_ids) < 2 or len(set(model_ids)) != len(model_ids):
+        raise HTTPException(status_code=400, detail=f"{kind} needs at least two distinct model IDs.")
+    models = {m.id: m for m in get_available_models(db)}
+    missing = [model_id for model_id in model_ids if model_id not in models]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Model ID {missing[0]} not found. Check available models with GET /models.")
+    selected_models = [models[model_id] for model_id in model_ids]
+    for model in selected_models:
+        if not find_model_file(model.name):
+            raise HTTPException(status_code=500, detail=f"Model file not found: {bundle_path(model.name)}")
+    return selected_models
+
+# Ансамблевое предсказание несколькими моделями
+@app.post("/predict/ensemble", response_model=Prediction, tags=["predictions"])
+async def predict_with_ensemble(
+    request: Request,
+    model_ids: List[int] = Query(...),
+    file: Optional[UploadFile] = File(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Запускает одно задание предсказания несколькими моделями.
+
+    Файл разбирается и проверяется один раз, воркер кодирует признаки один раз на чанк
+    и предсказывает всеми моделями параллельно. В result возвращается голосование
+    большинства (при равенстве голосов - метка модели, указанной раньше), в
+    ensemble.results - метки каждой модели. Списывается суммарная стоимость моделей
+    одной транзакцией.
+
+    Args:
+        model_ids (List[int]): ID моделей (не меньше двух разных), например ?model_ids=1&model_ids=2.
+        request (Request): Запрос (тело JSON или NDJSON, если файл не загружен).
+        file (Optional[UploadFile]): Загружаемый файл (CSV, XLSX, Parquet или Arrow IPC) с входными данными.
+        current_user (User): Объект текущего пользователя для аутентификации.
+        db (Session): Сессия SQLAlchemy для доступа к базе данных.
+
+    Returns:
+        Prediction: Объект предсказания с текущим статусом ("pending") и составом ансамбля.
+
+    Raises:
+        HTTPException: Если моделей меньше двух или они повторяются, модель не найдена,
+                       файл некорректен, баланс недостаточен или пользователь не аутентифицирован (400, 401).
+    """
+    input_data, parse_seconds, validation_seconds = await read_prediction_input(request, file)
+    selected_models = select_member_models(db, model_ids, "Ensemble")
+
+    # Проверка баланса (суммарная стоимость моделей)
+    cost = sum(model.cost for model in selected_models)
+    if current_user.balance < cost:
+        raise HTTPException(status_code=400, detail=f"Insufficient balance: {current_user.balance}. Required: {cost}. Increase balance via POST /payment.")
+
+    names = [model.name for model in selected_models]
+    observe_stage("parse", parse_seconds, ENSEMBLE_METRIC_NAME, len(input_data))
+    observe_stage("validation", validation_seconds, ENSEMBLE_METRIC_NAME, len(input_data))
+
+    return submit_prediction(
+        db, current_user, input_data, model_ids[0], cost,
+        description=f"Ensemble prediction using models {', '.join(names)}",
+        metric_name=ENSEMBLE_METRIC_NAME,
+        queue=select_queue(len(input_data), cost, combine_profiles([model.profile for model in selected_models])),
+        ensemble={"model_ids": model_ids, "models": names, "cost": cost}
+    )
+
+# Каскадное предсказание: дешёвая модель, сомнительные строки - дорогим моделям
+@app.post("/predict/cascade", response_model=Prediction, tags=["predictions"])
+async def predict_with_cascade(
+    request: Request,
+    model_ids: List[int] = Query(...),
+    threshold: Optional[float] = None,
+    file: Optional[UploadFile] = File(None),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Запускает каскадное предсказание.
+
+    Первая модель размечает все строки через predict_proba; строки, где максимальная
+    вероятность класса ниже threshold, передаются следующей модели, и так до последней,
+    которая размечает все оставшиеся. При запуске списывается стоимость всех моделей
+    (как если бы до последней дошли все строки); после завершения разница со стоимостью
+    по фактической доле эскалаций возвращается отдельной транзакцией. Доля эскалаций,
+    списанная сумма, возврат и экономия времени - в ensemble.
+
+    Args:
+        model_ids (List[int]): ID моделей от дешёвой к дорогой (не меньше двух разных),
+            например ?model_ids=1&model_ids=2.
+        threshold (Optional[float]): Порог уверенности в (0, 1] (по умолчанию CASCADE_THRESHOLD).
+        request (Request): Запрос (тело JSON или NDJSON, если файл не загружен).
+        file (Optional[UploadFile]): Загружаемый файл (CSV, XLSX, Parquet или Arrow IPC) с входными данными.
+        current_user (User): Объект текущего пользователя для аутентификации.
+        db (Session): Сессия SQLAlchemy для доступа к базе данных.
+
+    Returns:
+        Prediction: Объект предсказания с текущим статусом ("pending") и составом каскада.
+
+    Raises:
+        HTTPException: Если порог вне (0, 1], моделей меньше двух или они повторяются, модель
+                       не найдена, файл некорректен, баланс недостаточен или пользователь
+                       не аутентифицирован (400, 401).
+    """
+    threshold = CASCADE_THRESHOLD if threshold is None else threshold
+    if not 0 < threshold <= 1:
+        raise HTTPException(status_code=400, detail=f"Invalid threshold: {threshold}. Use a value in (0, 1].")
+    input_data, parse_seconds, validation_seconds = await read_prediction_input(request, file)
+    selected_models = select_member_models(db, model_ids, "Cascade")
+
+    # Проверка баланса (все строки на всех моделях; неиспользованное вернётся)
+    costs = [model.cost for model in selected_models]
+    cost = sum(costs)
+    if current_user.balance < cost:
+        raise HTTPException(status_code=400, detail=f"Insufficient balance: {current_user.balance}. Required: {cost}. Increase balance via POST /payment.")
+
+    names = [model.name for model in selected_models]
+    observe_stage("parse", parse_seconds, CASCADE_METRIC_NAME, len(input_data))
+    observe_stage("validation", validation_seconds, CASCADE_METRIC_NAME, len(input_data))
+
+    return submit_prediction(
+        db, current_user, input_data, model_ids[0], cost,
+        description=f"Cascade prediction using models {' -> '.join(names)}",
+        metric_name=CASCADE_METRIC_NAME,
+        queue=select_queue(len(input_data), cost, combine_profiles([model.profile for model in selected_models])),
+        ensemble={
+            "mode": "cascade", "model_ids": model_ids, "models": names,
+            "costs": costs, "cost": cost, "threshold": threshold
+        }
+    )
+
+# Поток событий о смене статусов предсказаний (Server-Sent Events)
+@app.get("/predictions/events", tags=["predictions"])
+async def prediction_events(current_user: User = Depends(get_current_user)):
+    """
+    Отдаёт поток Server-Sent Events с изменениями статусов предсказаний пользователя.
+
+    Воркер публикует события в Redis pub/sub при старте и завершении задачи, поэтому
+    клиентам не нужно опрашивать GET /predictions/{id}. Сразу после подписки приходит
+    комментарий ": connected", далее - события вида
+    `event: prediction` / `data: {"prediction_id": 1, "status": "completed"}`.
+
+    Args:
+        current_user (User): Аутентифицированный пользователь.
+
+    Returns:
+        StreamingResponse: Поток text/event-stream.
+
+    Raises:
+        HTTPException: Если пользователь не аутентифицирован (401).
+    """
+    logger.info(f"User {current_user.username} subscribed to prediction events")
+    return StreamingResponse(
+        prediction_event_stream(current_user.id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Получение статуса конкретного предсказания
 @app.get("/predictions/{prediction_id}", tags=["predictions"])
 def get_prediction(prediction_id: int, db: Session = Depends(get_db), current_user: User = Depends(get_current_user)):
@@ -335,6 +708,8 @@ def get_prediction(prediction_id: int, db: Session = Depends(get_db), current_us
         input_data=prediction.input_data,
         result=result,
         status=prediction.status,
+        progress=prediction.progress,
+        ensemble=prediction.ensemble,
         created_at=prediction.created_at
     )
 
@@ -417,3 +792,70 @@ async def get_transactions(
         created_at=t.created_at
     ) for t in transactions]
 
+
+
+@app.get("/usage", response_model=UsageReport, tags=["account"])
+async def usage(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """
+    Возвращает агрегированную статистику использования по моделям и дням.
+
+    Данные берутся из предрассчитанных агрегатов (usage_stats), которые обновляются
+    при завершении предсказаний, поэтому время ответа не зависит от длины истории.
+
+    Args:
+        start (date, optional): Начало периода (по умолчанию первый день текущего месяца).
+        end (date, optional): Конец периода (по умолчанию сегодня).
+        current_user (User): Аутентифицированный пользователь.
+        db (Session): Сессия SQLAlchemy.
+
+    Returns:
+        UsageReport: Итоги за период, разбивка по моделям и по дням.
+
+    Raises:
+        HTTPException: Если период задан некорректно (400) или пользователь не аутентифицирован (401).
+    """
+    today = datetime.now(timezone.utc).date()
+    end = end or today
+    start = start or end.replace(day=1)
+    if start > end:
+        raise HTTPException(status_code=400, detail="Start date must not be later than end date")
+    if (end - start).days >= MAX_USAGE_PERIOD_DAYS:
+        raise HTTPException(status_code=400, detail=f"Usage period is limited to {MAX_USAGE_PERIOD_DAYS} days")
+
+    rows = get_usage(db, current_user.id, start, end)
+    total = UsageStats()
+    by_model: dict[int, UsageStats] = {}
+    for row in rows:
+        for stats in (total, by_model.setdefault(row.model_id, UsageStats())):
+            stats.predictions_count += row.predictions_count
+            stats.rows_scored += row.rows_scored
+            stats.credits_spent += row.credits_spent
+    logger.info(f"User {current_user.username} retrieved usage for {start}..{end}")
+    return UsageReport(
+        start=start,
+        end=end,
+        total=total,
+        by_model=by_model,
+        days=[Usage.model_validate(row) for row in rows]
+    )
+
+# Метрики в формате Prometheus
+@app.get("/metrics", tags=["monitoring"])
+async def metrics():
+    """
+    Отдаёт метрики процесса API в текстовом формате Prometheus.
+
+    Гистограмма ml_service_stage_seconds содержит длительности этапов (parse, validation,
+    db_write) с метками модели и корзины размера входных данных. Метрики этапов воркера
+    (queue_wait, preprocessing, predict, db_write, end_to_end) отдают экспортеры процессов
+    пула (WORKER_METRICS_PORT + индекс процесса).
+
+    Returns:
+        Response: Метрики в формате text/plain; version=0.0.4.
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,8 +1,9 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Dict, Any
 
 class Model(BaseModel):
     id: int
     name: str
     cost: float  # Стоимость предсказания в токенах
-    file_path: str
\ No newline at end of file
+    file_path: str
+    profile: Optional[Dict[str, Any]] = None  # rows_per_sec по размерам пакета, load_seconds, memory_mb (из train_models.py)
\ No newline at end of file
@@ -0,0 +1,34 @@
+from typing import Union
+from pydantic import Field, StrictBool, StrictFloat, StrictInt, StrictStr
+from typing_extensions import Annotated, TypedDict
+
+# Одна запись о грибе в JSON/NDJSON запросах на предсказание: ключи - столбцы
+# REQUIRED_COLUMNS (все обязательны, null - пропуск), лишние ключи игнорируются.
+# TypedDict (а не BaseModel) проверяется pydantic-core без создания объектов на каждую строку.
+# Категориальное значение - строка, либо true/false или число, как их прочитал бы pandas
+# из CSV; строгие типы слева направо сохраняют тип значения и вдвое быстрее "умного" Union.
+# Числовой признак - только JSON-число: true и строки вроде "5.5" отклоняются, как и в CSV
+# они не стали бы числом.
+Numeric = Annotated[Union[StrictInt, StrictFloat, None], Field(union_mode="left_to_right")]
+Categorical = Annotated[
+    Union[StrictStr, StrictBool, StrictInt, StrictFloat, None], Field(union_mode="left_to_right")
+]
+
+MushroomRecord = TypedDict("MushroomRecord", {
+    "cap-diameter": Numeric,
+    "cap-shape": Categorical,
+    "cap-surface": Categorical,
+    "cap-color": Categorical,
+    "does-bruise-or-bleed": Categorical,
+    "gill-attachment": Categorical,
+    "gill-spacing": Categorical,
+    "gill-color": Categorical,
+    "stem-height": Numeric,
+    "stem-width": Numeric,
+    "stem-surface": Categorical,
+    "stem-color": Categorical,
+    "has-ring": Categorical,
+    "ring-type": Categorical,
+    "habitat": Categorical,
+    "season": Categorical,
+})
@@ -6,9 +6,11 @@ class Prediction(BaseModel):
     id: Optional[int] = None
     user_id: int
     model_id: int
-    input_data: List[Dict[str, Any]]  # Список словарей с данными грибов
+    input_data: Optional[List[Dict[str, Any]]] = None  # Список словарей с данными грибов (для старых записей)
     result: Optional[List[str]] = None  # Список предсказаний (e - edible или p - poisonous)
     status: str = "pending"  # pending, completed, failed
+    progress: Optional[Dict[str, Any]] = None  # rows_processed, rows_total, rows_per_sec, eta_seconds
+    ensemble: Optional[Dict[str, Any]] = None  # model_ids, models, cost; results - метки каждой модели (result - голосование)
     created_at: Optional[datetime] = None
     task_id: Optional[str] = None
 
@@ -0,0 +1,21 @@
+from pydantic import BaseModel, ConfigDict
+from typing import Dict, List
+from datetime import date
+
+class UsageStats(BaseModel):
+    predictions_count: int = 0  # Количество завершённых предсказаний
+    rows_scored: int = 0  # Количество обработанных строк
+    credits_spent: float = 0.0  # Потраченные кредиты
+
+class Usage(UsageStats):
+    model_id: int
+    day: date
+
+    model_config = ConfigDict(from_attributes=True, protected_namespaces=())
+
+class UsageReport(BaseModel):
+    start: date
+    end: date
+    total: UsageStats
+    by_model: Dict[int, UsageStats]  # Ключ - ID модели
+    days: List[Usage]
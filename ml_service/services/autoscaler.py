@@ -0,0 +1,223 @@
+import logging
+import math
+import os
+from collections import deque
+from time import monotonic
+from typing import List, Optional, Sequence, Tuple
+import redis
+from celery.worker import state
+from celery.worker.autoscale import Autoscaler
+from celery_app import REDIS_URL
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Границы адаптивного режима (включается ADAPTIVE_CONCURRENCY=1 и флагом --autoscale=max,min)
+ADAPTIVE_MIN_PREFETCH = int(os.getenv("ADAPTIVE_MIN_PREFETCH", "1"))
+ADAPTIVE_MAX_PREFETCH = int(os.getenv("ADAPTIVE_MAX_PREFETCH", "4"))
+ADAPTIVE_MAX_RSS_MB = float(os.getenv("ADAPTIVE_MAX_RSS_MB", "4096"))
+ADAPTIVE_INTERVAL = float(os.getenv("ADAPTIVE_INTERVAL", "5"))
+# Размеры заданий (строки), между которыми prefetch снижается от максимального до минимального.
+# Сравнивается верхний перцентиль размеров: даже редкие крупные задания блокируют
+# задания, зарезервированные за ними в том же процессе.
+SIZE_PERCENTILE = 0.98
+SMALL_JOB_ROWS = int(os.getenv("ADAPTIVE_SMALL_JOB_ROWS", "1000"))
+LARGE_JOB_ROWS = int(os.getenv("ADAPTIVE_LARGE_JOB_ROWS", "50000"))
+
+# Скользящее окно размеров последних заданий (общее для всех воркеров)
+RECENT_JOB_SIZES_KEY = "ml_service:recent_job_sizes"
+RECENT_JOB_SIZES_WINDOW = 200
+# Сколько последних измерений RSS учитывать (память крупных заданий не должна
+# "забываться" в паузах между ними)
+RSS_WINDOW = 12
+
+_redis_client = None
+
+def _get_redis_client() -> redis.Redis:
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.from_url(REDIS_URL)
+    return _redis_client
+
+def record_job_size(rows: int) -> None:
+    """
+    Добавляет размер задания в скользящее окно, по которому адаптируется воркер.
+
+    Args:
+        rows (int): Количество строк в задании.
+    """
+    try:
+        pipe = _get_redis_client().pipeline()
+        pipe.lpush(RECENT_JOB_SIZES_KEY, rows)
+        pipe.ltrim(RECENT_JOB_SIZES_KEY, 0, RECENT_JOB_SIZES_WINDOW - 1)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Не удалось записать размер задания: {e}")
+
+def _percentile(values: Sequence[int], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def compute_scaling(
+    recent_sizes: Sequence[int],
+    active: int,
+    queue_depth: int,
+    rss_mb: Sequence[float],
+    peak_rss_mb: float,
+    min_concurrency: int,
+    max_concurrency: int,
+    min_prefetch: int = ADAPTIVE_MIN_PREFETCH,
+    max_prefetch: int = ADAPTIVE_MAX_PREFETCH,
+    max_rss_mb: float = ADAPTIVE_MAX_RSS_MB,
+    current: Optional[int] = None,
+) -> Tuple[int, int]:
+    """
+    Вычисляет целевое число активных процессов и множитель prefetch.
+
+    Мелкие задания выигрывают от prefetch (меньше простоя на обращения к брокеру),
+    крупные упираются в память и блокируют зарезервированные за ними задания,
+    поэтому для них prefetch минимален. Процессов добавляется не больше, чем помещается
+    в свободную память из расчёта на самый тяжёлый процесс, а при превышении бюджета
+    их число сокращается. Увеличение применяется сразу, а уменьшение
+    без нехватки памяти идёт по одному процессу за шаг, чтобы кратковременно пустая
+    очередь не обрушивала пул.
+
+    Args:
+        recent_sizes (Sequence[int]): Размеры последних заданий в строках.
+        active (int): Количество выполняемых сейчас задач.
+        queue_depth (int): Количество заданий в очереди и в резерве воркера.
+        rss_mb (Sequence[float]): Текущий RSS каждого процесса пула (МБ).
+        peak_rss_mb (float): Максимальный RSS процесса пула за последние измерения (МБ).
+        min_concurrency (int): Нижняя граница числа процессов.
+        max_concurrency (int): Верхняя граница числа процессов.
+        min_prefetch (int): Нижняя граница множителя prefetch.
+        max_prefetch (int): Верхняя граница множителя prefetch.
+        max_rss_mb (float): Бюджет памяти на все процессы пула (МБ).
+        current (Optional[int]): Текущее целевое число процессов, если уже выбрано.
+
+    Returns:
+        Tuple[int, int]: (число процессов, множитель prefetch).
+    """
+    typical_rows = _percentile(recent_sizes, SIZE_PERCENTILE) if recent_sizes else SMALL_JOB_ROWS
+
+    # Множитель prefetch: максимум для мелких заданий, минимум для крупных
+    if typical_rows <= SMALL_JOB_ROWS:
+        prefetch = max_prefetch
+    elif typical_rows >= LARGE_JOB_ROWS:
+        prefetch = min_prefetch
+    else:
+        share = (typical_rows - SMALL_JOB_ROWS) / (LARGE_JOB_ROWS - SMALL_JOB_ROWS)
+        prefetch = round(max_prefetch - share * (max_prefetch - min_prefetch))
+
+    # Процессы: занятые плюс столько, чтобы разобрать очередь с учётом prefetch,
+    # но не больше, чем помещается в бюджет памяти
+    concurrency = min(max_concurrency, max(min_concurrency, active + math.ceil(queue_depth / prefetch)))
+    if current is not None and concurrency < current:
+        concurrency = current - 1
+    if peak_rss_mb > 0 and rss_mb:
+        headroom = math.floor((max_rss_mb - sum(rss_mb)) / peak_rss_mb)
+        concurrency = min(concurrency, max(min_concurrency, len(rss_mb) + headroom))
+    return max(concurrency, min_concurrency, 1), max(prefetch, 1)
+
+def _process_rss_mb(pid: int) -> float:
+    """Возвращает текущий RSS процесса в МБ (Linux /proc), 0 если недоступно."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0.0
+
+class AdaptiveAutoscaler(Autoscaler):
+    """
+    Автоскейлер Celery, который подбирает число активных процессов и prefetch
+    по размерам последних заданий, глубине очереди и RSS процессов пула.
+
+    Подключается через worker_autoscaler в celery_app.py (ADAPTIVE_CONCURRENCY=1)
+    и работает в границах --autoscale=max,min.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._last_adjust = 0.0
+        self.target_concurrency = None
+        self.prefetch_multiplier = None
+        self._rss_samples = deque(maxlen=RSS_WINDOW)
+
+    def _queue_depth(self) -> int:
+        depth = len(state.reserved_requests)
+        try:
+            queues = [q.name for q in self.worker.consumer.task_consumer.queues]
+            client = _get_redis_client()
+            depth += sum(client.llen(name) for name in queues)
+        except Exception as e:
+            logger.debug(f"Не удалось получить глубину очереди: {e}")
+        return depth
+
+    def _recent_sizes(self) -> List[int]:
+        try:
+            return [int(v) for v in _get_redis_client().lrange(RECENT_JOB_SIZES_KEY, 0, -1)]
+        except redis.RedisError as e:
+            logger.debug(f"Не удалось получить размеры заданий: {e}")
+            return []
+
+    def _rss_mb(self) -> List[float]:
+        pids = self.pool.info.get("processes", []) if isinstance(self.pool.info, dict) else []
+        rss = [_process_rss_mb(pid) for pid in pids]
+        self._rss_samples.append(max(rss, default=0.0))
+        return rss
+
+    def _apply_qos(self, concurrency: int, multiplier: int):
+        """
+        Устанавливает prefetch_count = concurrency × multiplier.
+
+        При task_acks_late=True prefetch_count ограничивает число выполняемых и
+        зарезервированных задач, поэтому новое ограничение действует сразу, даже если
+        занятые процессы пула ещё нельзя остановить.
+        """
+        consumer = getattr(self.worker, "consumer", None)
+        if consumer is None or consumer.qos is None or not consumer.initial_prefetch_count:
+            return  # prefetch отключён
+        consumer.prefetch_multiplier = multiplier
+        diff = concurrency * multiplier - consumer.qos.value
+        if diff > 0:
+            consumer.qos.increment_eventually(diff)
+        elif diff < 0:
+            consumer.qos.decrement_eventually(-diff)
+        if (concurrency, multiplier) != (self.target_concurrency, self.prefetch_multiplier):
+            logger.info(f"Adaptive worker settings: concurrency={concurrency}, prefetch multiplier={multiplier}")
+        self.target_concurrency = concurrency
+        self.prefetch_multiplier = multiplier
+
+    def _maybe_scale(self, req=None):
+        if monotonic() - self._last_adjust < ADAPTIVE_INTERVAL:
+            return False
+        self._last_adjust = monotonic()
+
+        rss = self._rss_mb()
+        concurrency, prefetch = compute_scaling(
+            self._recent_sizes(),
+            len(state.active_requests),
+            self._queue_depth(),
+            rss,
+            max(self._rss_samples),
+            self.min_concurrency,
+            self.max_concurrency,
+            current=self.target_concurrency,
+        )
+        # Пул стартует с min_concurrency, поэтому уменьшать его есть смысл только после
+        # увеличения: scale_down Celery сам выдерживает keepalive с последнего scale_up
+        procs = self.processes
+        scaled = False
+        if concurrency > procs:
+            self.scale_up(concurrency - procs)
+            scaled = True
+        elif concurrency < procs:
+            self.scale_down(procs - concurrency)
+            scaled = True
+
+        self._apply_qos(concurrency, prefetch)
+        return scaled
@@ -3,9 +3,12 @@ from db.db_user import DBUser
 from db.db_prediction import DBPrediction
 from db.db_transaction import DBTransaction
 from db.db_model import DBModel
+from db.db_usage import DBUsage
+from db.db_prediction_chunk import DBPredictionChunk
 from passlib.context import CryptContext
-from datetime import datetime, timezone
-from typing import List, Optional
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Union
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -52,6 +55,19 @@ def get_user_by_username(db: Session, username: str) -> Optional[DBUser]:
     """
     return db.query(DBUser).filter(DBUser.username == username).first()
 
+def get_user_by_id(db: Session, user_id: int) -> Optional[DBUser]:
+    """
+    Получает пользователя по идентификатору.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        user_id (int): Идентификатор пользователя.
+
+    Returns:
+        Optional[DBUser]: Объект пользователя или None, если пользователь не найден.
+    """
+    return db.query(DBUser).filter(DBUser.id == user_id).first()
+
 def update_user_balance(db: Session, username: str, amount: float) -> Optional[DBUser]:
     """
     Обновляет баланс пользователя, добавляя или вычитая указанную сумму.
@@ -71,7 +87,15 @@ def update_user_balance(db: Session, username: str, amount: float) -> Optional[D
         db.refresh(db_user)
     return db_user
 
-def create_prediction(db: Session, user_id: int, model_id: int, input_data: List[dict], status: str = "pending") -> DBPrediction:
+def create_prediction(
+    db: Session,
+    user_id: int,
+    model_id: int,
+    input_data: Optional[List[dict]] = None,
+    status: str = "pending",
+    input_path: Optional[str] = None,
+    ensemble: Optional[Dict[str, Any]] = None
+) -> DBPrediction:
     """
     Создаёт запись о предсказании в базе данных.
 
@@ -79,8 +103,10 @@ def create_prediction(db: Session, user_id: int, model_id: int, input_data: List
         db (Session): Сессия SQLAlchemy.
         user_id (int): Идентификатор пользователя, инициировавшего предсказание.
         model_id (int): Идентификатор модели машинного обучения.
-        input_data (List[dict]): Входные данные для предсказания в формате списка словарей.
+        input_data (Optional[List[dict]]): Входные данные в формате списка словарей (если не используется спул).
         status (str, optional): Статус предсказания (по умолчанию "pending").
+        input_path (Optional[str]): Путь к файлу спула со входными данными.
+        ensemble (Optional[Dict[str, Any]]): Модели ансамбля (model_ids, models, cost), если это ансамбль.
 
     Returns:
         DBPrediction: Объект созданной записи предсказания.
@@ -89,6 +115,8 @@ def create_prediction(db: Session, user_id: int, model_id: int, input_data: List
         user_id=user_id,
         model_id=model_id,
         input_data=input_data,
+        input_path=input_path,
+        ensemble=ensemble,
         status=status,
         created_at=datetime.now(timezone.utc)
     )
@@ -97,7 +125,9 @@ def create_prediction(db: Session, user_id: int, model_id: int, input_data: List
     db.refresh(db_prediction)
     return db_prediction
 
-def update_prediction_result(db: Session, prediction_id: int, result: List[str], status: str) -> Optional[DBPrediction]:
+def update_prediction_result(
+    db: Session, prediction_id: int, result: List[str], status: str, ensemble: Optional[Dict[str, Any]] = None
+) -> Optional[DBPrediction]:
     """
     Обновляет результат и статус предсказания в базе данных.
 
@@ -106,6 +136,7 @@ def update_prediction_result(db: Session, prediction_id: int, result: List[str],
         prediction_id (int): Идентификатор предсказания.
         result (List[str]): Результат предсказания в формате списка строк.
         status (str): Новый статус предсказания ("completed" или "failed").
+        ensemble (Optional[Dict[str, Any]]): Описание ансамбля с метками каждой модели.
 
     Returns:
         Optional[DBPrediction]: Обновлённая запись предсказания или None, если запись не найдена.
@@ -114,10 +145,75 @@ def update_prediction_result(db: Session, prediction_id: int, result: List[str],
     if db_prediction:
         db_prediction.result = result
         db_prediction.status = status
+        if ensemble is not None:
+            db_prediction.ensemble = ensemble
         db.commit()
         db.refresh(db_prediction)
     return db_prediction
 
+def save_prediction_chunk(
+    db: Session, prediction_id: int, start_row: int, end_row: int, result: Union[List[str], Dict[str, Any]]
+) -> DBPredictionChunk:
+    """
+    Сохраняет чекпоинт предсказания для диапазона строк [start_row, end_row).
+
+    Если чекпоинт для этого диапазона уже сохранён (повторная доставка задачи),
+    возвращается существующая запись.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        prediction_id (int): Идентификатор предсказания.
+        start_row (int): Индекс первой строки диапазона.
+        end_row (int): Индекс строки после последней.
+        result: Результат предсказания для диапазона (метки или результат ансамбля).
+
+    Returns:
+        DBPredictionChunk: Запись чекпоинта.
+    """
+    db_chunk = DBPredictionChunk(
+        prediction_id=prediction_id,
+        start_row=start_row,
+        end_row=end_row,
+        result=result,
+        created_at=datetime.now(timezone.utc)
+    )
+    db.add(db_chunk)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return db.query(DBPredictionChunk).filter(
+            DBPredictionChunk.prediction_id == prediction_id,
+            DBPredictionChunk.start_row == start_row
+        ).first()
+    db.refresh(db_chunk)
+    return db_chunk
+
+def get_prediction_chunks(db: Session, prediction_id: int) -> Dict[int, DBPredictionChunk]:
+    """
+    Возвращает сохранённые чекпоинты предсказания.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        prediction_id (int): Идентификатор предсказания.
+
+    Returns:
+        Dict[int, DBPredictionChunk]: Чекпоинты по индексу первой строки диапазона.
+    """
+    chunks = db.query(DBPredictionChunk).filter(DBPredictionChunk.prediction_id == prediction_id).all()
+    return {chunk.start_row: chunk for chunk in chunks}
+
+def delete_prediction_chunks(db: Session, prediction_id: int) -> None:
+    """
+    Удаляет чекпоинты завершённого предсказания.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        prediction_id (int): Идентификатор предсказания.
+    """
+    db.query(DBPredictionChunk).filter(DBPredictionChunk.prediction_id == prediction_id).delete(synchronize_session=False)
+    db.commit()
+
 def create_transaction(db: Session, user_id: int, amount: float, description: str, prediction_id: Optional[int] = None) -> DBTransaction:
     """
     Создаёт запись о транзакции в базе данных.
@@ -143,6 +239,71 @@ def create_transaction(db: Session, user_id: int, amount: float, description: st
     db.refresh(db_transaction)
     return db_transaction
 
+def credit_user(
+    db: Session, user_id: int, amount: float, description: str, prediction_id: Optional[int] = None
+) -> Optional[DBTransaction]:
+    """
+    Зачисляет сумму на баланс пользователя и записывает транзакцию одним коммитом.
+
+    В тот же коммит попадают другие изменения сессии (например, отметка о возврате
+    в предсказании): либо сохраняется всё, либо ничего.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        user_id (int): Идентификатор пользователя.
+        amount (float): Сумма зачисления.
+        description (str): Описание транзакции.
+        prediction_id (Optional[int]): Идентификатор связанного предсказания.
+
+    Returns:
+        Optional[DBTransaction]: Запись транзакции или None, если пользователь не найден.
+    """
+    db_user = db.query(DBUser).filter(DBUser.id == user_id).first()
+    if not db_user:
+        return None
+    db_user.balance = db_user.balance + amount
+    db_transaction = DBTransaction(
+        user_id=user_id,
+        amount=amount,
+        description=description,
+        created_at=datetime.now(timezone.utc),
+        prediction_id=prediction_id
+    )
+    db.add(db_transaction)
+    try:
+        db.commit()
+    except SQLAlchemyError:
+        db.rollback()
+        raise
+    db.refresh(db_transaction)
+    return db_transaction
+
+def debit_user(
+    db: Session, user_id: int, amount: float, description: str, prediction_id: Optional[int] = None
+) -> Optional[DBTransaction]:
+    """
+    Списывает сумму с баланса пользователя и записывает транзакцию одним коммитом (см. credit_user).
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        user_id (int): Идентификатор пользователя.
+        amount (float): Сумма списания.
+        description (str): Описание транзакции.
+        prediction_id (Optional[int]): Идентификатор связанного предсказания.
+
+    Returns:
+        Optional[DBTransaction]: Запись транзакции (с суммой -amount) или None, если пользователь не найден.
+
+    Raises:
+        ValueError: Если на балансе недостаточно средств.
+    """
+    db_user = db.query(DBUser).filter(DBUser.id == user_id).first()
+    if not db_user:
+        return None
+    if db_user.balance < amount:
+        raise ValueError(f"Insufficient balance: {db_user.balance}. Required: {amount}")
+    return credit_user(db, user_id, -amount, description, prediction_id=prediction_id)
+
 def get_model_by_id(db: Session, model_id: int) -> Optional[DBModel]:
     """
     Получает модель машинного обучения по её идентификатору.
@@ -154,4 +315,96 @@ def get_model_by_id(db: Session, model_id: int) -> Optional[DBModel]:
     Returns:
         Optional[DBModel]: Объект модели или None, если модель не найдена.
     """
-    return db.query(DBModel).filter(DBModel.id == model_id).first()
\ No newline at end of file
+    return db.query(DBModel).filter(DBModel.id == model_id).first()
+
+def update_model_profile(db: Session, model_name: str, profile: Dict[str, Any]) -> Optional[DBModel]:
+    """
+    Сохраняет профиль производительности модели, измеренный после обучения.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        model_name (str): Имя модели.
+        profile (Dict[str, Any]): Профиль (rows_per_sec по размерам пакета, load_seconds, memory_mb и т.п.).
+
+    Returns:
+        Optional[DBModel]: Обновлённая модель или None, если модель не найдена.
+    """
+    db_model = db.query(DBModel).filter(DBModel.name == model_name).first()
+    if not db_model:
+        return None
+    db_model.profile = profile
+    db.commit()
+    db.refresh(db_model)
+    return db_model
+
+def record_usage(
+    db: Session, user_id: int, model_id: int, rows: int, credits: float, day: Optional[date] = None, commit: bool = True
+) -> DBUsage:
+    """
+    Инкрементально обновляет агрегаты использования (пользователь, модель, сутки).
+
+    Счётчики увеличиваются на стороне БД, поэтому параллельные воркеры не теряют обновления.
+    С commit=False изменения остаются в текущей транзакции сессии и сохраняются одним
+    коммитом с остальными изменениями (см. services.tasks.complete_prediction).
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        user_id (int): Идентификатор пользователя.
+        model_id (int): Идентификатор модели.
+        rows (int): Количество обработанных строк.
+        credits (float): Количество потраченных кредитов.
+        day (date, optional): День агрегации (по умолчанию текущий день в UTC).
+        commit (bool): Зафиксировать транзакцию (False - оставить коммит вызывающему).
+
+    Returns:
+        DBUsage: Обновлённая строка агрегатов.
+    """
+    day = day or datetime.now(timezone.utc).date()
+    key = (DBUsage.user_id == user_id, DBUsage.model_id == model_id, DBUsage.day == day)
+    for _ in range(2):
+        updated = db.query(DBUsage).filter(*key).update({
+            DBUsage.predictions_count: DBUsage.predictions_count + 1,
+            DBUsage.rows_scored: DBUsage.rows_scored + rows,
+            DBUsage.credits_spent: DBUsage.credits_spent + credits,
+            DBUsage.updated_at: datetime.now(timezone.utc),
+        }, synchronize_session=False)
+        if updated:
+            break
+        try:
+            # Вставка в точке сохранения: при конфликте откатывается только она
+            with db.begin_nested():
+                db.add(DBUsage(
+                    user_id=user_id,
+                    model_id=model_id,
+                    day=day,
+                    predictions_count=1,
+                    rows_scored=rows,
+                    credits_spent=credits,
+                    updated_at=datetime.now(timezone.utc)
+                ))
+            break
+        except IntegrityError:
+            # Строку за этот день успел создать другой воркер - повторяем как UPDATE
+            pass
+    if commit:
+        db.commit()
+    return db.query(DBUsage).filter(*key).first()
+
+def get_usage(db: Session, user_id: int, start: date, end: date) -> List[DBUsage]:
+    """
+    Возвращает дневные агрегаты использования пользователя за период.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        user_id (int): Идентификатор пользователя.
+        start (date): Начало периода (включительно).
+        end (date): Конец периода (включительно).
+
+    Returns:
+        List[DBUsage]: Строки агрегатов, отсортированные по дню и модели.
+    """
+    return db.query(DBUsage).filter(
+        DBUsage.user_id == user_id,
+        DBUsage.day >= start,
+        DBUsage.day <= end
+    ).order_by(DBUsage.day, DBUsage.model_id).all()
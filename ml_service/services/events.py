@@ -0,0 +1,81 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Dict
+import redis
+import redis.asyncio as aioredis
+from celery_app import REDIS_URL
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Канал Redis pub/sub с событиями предсказаний пользователя
+PREDICTION_EVENTS_CHANNEL = "ml_service:predictions:{user_id}"
+# Интервал служебных сообщений, чтобы прокси не закрывали простаивающее соединение
+HEARTBEAT_INTERVAL = 15.0
+
+_redis_client = None
+
+def _get_redis_client() -> redis.Redis:
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.from_url(REDIS_URL)
+    return _redis_client
+
+def publish_prediction_event(user_id: int, prediction_id: int, status: str, **extra: Any) -> None:
+    """
+    Публикует событие изменения статуса предсказания в Redis pub/sub.
+
+    Ошибки Redis только логируются: уведомления не должны ломать выполнение задачи.
+
+    Args:
+        user_id (int): Идентификатор владельца предсказания.
+        prediction_id (int): Идентификатор предсказания.
+        status (str): Новый статус ("running", "completed", "failed").
+        **extra: Дополнительные поля события.
+    """
+    event = {"prediction_id": prediction_id, "status": status, **extra}
+    try:
+        _get_redis_client().publish(PREDICTION_EVENTS_CHANNEL.format(user_id=user_id), json.dumps(event))
+    except redis.RedisError as e:
+        logger.error(f"Не удалось опубликовать событие предсказания {prediction_id}: {e}")
+
+def format_sse(event: Dict[str, Any]) -> str:
+    """Форматирует событие как сообщение Server-Sent Events."""
+    return f"event: prediction\ndata: {json.dumps(event)}\n\n"
+
+async def prediction_event_stream(user_id: int) -> AsyncIterator[str]:
+    """
+    Подписывается на события предсказаний пользователя и отдаёт их в формате SSE.
+
+    Сразу после подписки отправляется комментарий ": connected", чтобы клиент мог
+    догрузить статусы, изменившиеся до подписки.
+
+    Args:
+        user_id (int): Идентификатор пользователя.
+
+    Yields:
+        str: Сообщения Server-Sent Events.
+    """
+    client = aioredis.from_url(REDIS_URL)
+    pubsub = client.pubsub()
+    await pubsub.subscribe(PREDICTION_EVENTS_CHANNEL.format(user_id=user_id))
+    try:
+        yield ": connected\n\n"
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=HEARTBEAT_INTERVAL)
+            if message is None:
+                yield ": heartbeat\n\n"
+                continue
+            try:
+                yield format_sse(json.loads(message["data"]))
+            except (TypeError, ValueError) as e:
+                logger.error(f"Некорректное событие в канале пользователя {user_id}: {e}")
+    except asyncio.CancelledError:
+        logger.debug(f"Клиент пользователя {user_id} отключился от потока событий")
+        raise
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+        await client.aclose()
@@ -0,0 +1,155 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, Optional
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Базовый порт экспортера метрик процессов воркера: процесс пула с индексом i
+# слушает WORKER_METRICS_PORT + i (0 отключает экспортер)
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9810"))
+
+# Корзины размера входных данных (строки) для метки size
+SIZE_BUCKETS = [(100, "<=100"), (1_000, "<=1k"), (10_000, "<=10k"), (100_000, "<=100k")]
+
+# Этапы обработки предсказания:
+# parse, validation - разбор и проверка файла в API;
+# queue_wait - от создания записи до начала задачи;
+# preprocessing, predict - предобработка признаков и model.predict (на батч);
+# db_write - запись чекпоинтов, прогресса и результата;
+# end_to_end - от создания записи до сохранения результата.
+STAGE_SECONDS = Histogram(
+    "ml_service_stage_seconds",
+    "Длительность этапов обработки предсказания",
+    ["stage", "model", "size"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+PREDICTIONS_TOTAL = Counter(
+    "ml_service_predictions_total",
+    "Завершённые предсказания",
+    ["model", "status"],
+)
+ROWS_TOTAL = Counter(
+    "ml_service_rows_scored_total",
+    "Строки, обработанные моделью",
+    ["model"],
+)
+# Подмены версий моделей в кэше процесса (status: swapped или rejected)
+MODEL_RELOADS_TOTAL = Counter(
+    "ml_service_model_reloads_total",
+    "Проверенные новые версии моделей",
+    ["model", "status"],
+)
+# Доля строк каскада, переданных от первой модели дальше (на задание)
+CASCADE_ESCALATION_RATE = Histogram(
+    "ml_service_cascade_escalation_rate",
+    "Доля строк каскада, переданных следующим моделям",
+    buckets=(0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1),
+)
+
+# Прогрев воркера при старте (celeryd_init): выполняется в главном процессе до fork,
+# поэтому значения видны в экспортерах всех процессов пула
+WORKER_WARMUP_SECONDS = Gauge(
+    "ml_service_worker_warmup_seconds",
+    "Длительность прогрева воркера",
+    ["worker"],
+)
+MODEL_WARMUP_SECONDS = Gauge(
+    "ml_service_model_warmup_seconds",
+    "Длительность прогрева модели на воркере",
+    ["worker", "model"],
+)
+# 1 - воркер (модель) прогрет и готов принимать задачи, 0 - нет
+WORKER_READY = Gauge(
+    "ml_service_worker_ready",
+    "Готовность воркера после прогрева",
+    ["worker"],
+)
+MODEL_READY = Gauge(
+    "ml_service_model_ready",
+    "Готовность модели на воркере после прогрева",
+    ["worker", "model"],
+)
+
+def size_bucket(rows: int) -> str:
+    """Возвращает метку корзины размера входных данных."""
+    for limit, label in SIZE_BUCKETS:
+        if rows <= limit:
+            return label
+    return ">100k"
+
+def observe_stage(stage: str, seconds: Optional[float], model: str, rows: int) -> None:
+    """
+    Записывает длительность этапа в гистограмму ml_service_stage_seconds.
+
+    Args:
+        stage (str): Название этапа (parse, validation, queue_wait, preprocessing, predict, db_write, end_to_end).
+        seconds (Optional[float]): Длительность этапа в секундах (None не записывается).
+        model (str): Имя модели.
+        rows (int): Количество строк, по которому выбирается корзина размера.
+    """
+    if seconds is None:
+        return
+    STAGE_SECONDS.labels(stage=stage, model=model, size=size_bucket(rows)).observe(seconds)
+
+@contextmanager
+def timed(stage: str, model: str, rows: int) -> Iterator[None]:
+    """Контекстный менеджер, который измеряет длительность блока как этап stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started, model, rows)
+
+def seconds_since(moment: Optional[datetime]) -> Optional[float]:
+    """Секунды от moment до текущего момента (naive datetime из SQLite считается UTC)."""
+    if moment is None:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - moment).total_seconds()
+
+def record_warmup(worker: str, seconds: float, ready: bool, report: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Записывает результат прогрева воркера в метрики.
+
+    Args:
+        worker (str): Имя хоста воркера.
+        seconds (float): Общая длительность прогрева в секундах.
+        ready (bool): Готов ли воркер принимать задачи.
+        report (Dict[str, Dict[str, Any]]): Отчёт warm_up_models по моделям (ready, seconds).
+    """
+    WORKER_WARMUP_SECONDS.labels(worker=worker).set(seconds)
+    WORKER_READY.labels(worker=worker).set(1 if ready else 0)
+    for model_name, model_report in report.items():
+        MODEL_WARMUP_SECONDS.labels(worker=worker, model=model_name).set(model_report["seconds"])
+        MODEL_READY.labels(worker=worker, model=model_name).set(1 if model_report["ready"] else 0)
+
+def start_worker_exporter(process_index: Optional[int]) -> Optional[int]:
+    """
+    Запускает HTTP-экспортер метрик в процессе пула воркера.
+
+    У каждого процесса prefork свои счётчики, поэтому каждый процесс отдаёт их на
+    своём порту WORKER_METRICS_PORT + process_index.
+
+    Args:
+        process_index (Optional[int]): Индекс процесса в пуле (0, 1, ...).
+
+    Returns:
+        Optional[int]: Порт экспортера или None, если экспортер не запущен.
+    """
+    if WORKER_METRICS_PORT <= 0 or process_index is None:
+        return None
+    port = WORKER_METRICS_PORT + process_index
+    try:
+        start_http_server(port)
+    except OSError as e:
+        logger.error(f"Не удалось запустить экспортер метрик на порту {port}: {e}")
+        return None
+    logger.info(f"Экспортер метрик процесса {process_index} слушает порт {port}")
+    return port
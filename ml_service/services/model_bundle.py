@@ -0,0 +1,226 @@
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+import joblib
+import numpy as np
+import sklearn
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Бандл модели - один файл joblib со всем, что нужно для предсказания: модель,
+# таблицы предобработки (медианы числовых признаков, категории в порядке их кодов,
+# метки классов), порядок признаков, метаданные обучения и хэш содержимого.
+# Рядом лежит {имя}.json с метаданными и контрольной суммой файла, чтобы узнать
+# версию и проверить бандл без загрузки модели.
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUNDLE_DIR = os.getenv("MODEL_BUNDLE_DIR", os.path.join(BASE_DIR, "ml_models", "bundles"))
+BUNDLE_FORMAT_VERSION = 1
+
+# Ключи, по которым считается хэш содержимого (то, от чего зависят предсказания)
+CONTENT_KEYS = ("model", "medians", "categories", "class_labels", "feature_order")
+
+def bundle_path(model_name: str, directory: Optional[str] = None) -> str:
+    """Возвращает путь к бандлу модели."""
+    return os.path.join(directory or BUNDLE_DIR, f"{model_name}.joblib")
+
+def content_hash(bundle: Dict[str, Any]) -> str:
+    """
+    Считает хэш модели и таблиц предобработки при сборке бандла.
+
+    Хэш идентифицирует обученное содержимое (версии с одинаковым хэшем взаимозаменяемы).
+    Для проверки целостности при загрузке он не пересчитывается: узлы деревьев sklearn
+    содержат неинициализированные байты выравнивания, и после загрузки сериализация
+    той же модели даёт другие байты. Целостность проверяется по контрольной сумме файла.
+    """
+    return joblib.hash({key: bundle[key] for key in CONTENT_KEYS}, hash_name="sha1")
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """Считает sha256 файла, читая его блоками."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def category_lookup(classes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Строит таблицу поиска для кодирования категорий.
+
+    Код категории - её позиция в classes. После обучения на полном датасете classes
+    отсортированы (как у LabelEncoder), при дообучении новые значения дописываются в
+    конец, чтобы коды, на которых обучена модель, не сдвигались.
+
+    Args:
+        classes (np.ndarray): Известные значения признака в порядке кодов.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (отсортированные значения, их коды).
+    """
+    order = np.argsort(classes, kind="stable")
+    return np.asarray(classes)[order], order
+
+def encode_categorical(values: np.ndarray, sorted_classes: np.ndarray, codes: np.ndarray, unknown_code: int) -> np.ndarray:
+    """
+    Кодирует строковые значения признака по таблице из category_lookup (np.searchsorted).
+
+    Args:
+        values (np.ndarray): Значения признака (строки).
+        sorted_classes (np.ndarray): Отсортированные известные значения.
+        codes (np.ndarray): Коды отсортированных значений.
+        unknown_code (int): Код для неизвестных значений.
+
+    Returns:
+        np.ndarray: Коды значений.
+    """
+    positions = np.minimum(np.searchsorted(sorted_classes, values), len(sorted_classes) - 1)
+    return np.where(sorted_classes[positions] == values, codes[positions], unknown_code)
+
+def build_bundle(
+    model_name: str,
+    model: Any,
+    medians: Dict[str, float],
+    categories: Dict[str, np.ndarray],
+    class_labels: np.ndarray,
+    feature_order: list,
+    metadata: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Собирает бандл модели.
+
+    Категории и метки классов хранятся как массивы строк фиксированной длины в порядке
+    кодов: при загрузке с mmap_mode они отображаются из файла, а кодирование признака
+    сводится к np.searchsorted (см. category_lookup).
+
+    Args:
+        model_name (str): Имя модели.
+        model: Обученная модель.
+        medians (Dict[str, float]): Медианы числовых признаков (заполнение пропусков).
+        categories (Dict[str, np.ndarray]): Известные значения категориальных признаков
+            в порядке кодов (классы LabelEncoder, включая 'unknown').
+        class_labels (np.ndarray): Метки классов в порядке их кодов.
+        feature_order (list): Порядок признаков на входе модели.
+        metadata (Optional[Dict[str, Any]]): Метаданные обучения (F1, размеры выборок и т.п.).
+
+    Returns:
+        Dict[str, Any]: Бандл с посчитанным хэшем содержимого.
+    """
+    bundle = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "name": model_name,
+        "model": model,
+        "medians": {col: float(value) for col, value in medians.items()},
+        "categories": {col: np.asarray(values, dtype=str) for col, values in categories.items()},
+        "class_labels": np.asarray(class_labels, dtype=str),
+        "feature_order": list(feature_order),
+        "metadata": {
+            "trained_at": datetime.now(timezone.utc).isoformat(),
+            "sklearn_version": sklearn.__version__,
+            "numpy_version": np.__version__,
+            "joblib_version": joblib.__version__,
+            **(metadata or {}),
+        },
+    }
+    bundle["content_hash"] = content_hash(bundle)
+    return bundle
+
+def read_bundle_info(model_name: str, directory: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Читает метаданные бандла из {имя}.json без загрузки модели.
+
+    Returns:
+        Optional[Dict[str, Any]]: Метаданные (version, content_hash, file_sha256, metadata) или None.
+    """
+    path = os.path.splitext(bundle_path(model_name, directory))[0] + ".json"
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_bundle(bundle: Dict[str, Any], directory: Optional[str] = None) -> str:
+    """
+    Сохраняет бандл с очередной версией.
+
+    Версия на единицу больше версии предыдущего бандла этой модели. Файлы пишутся
+    во временные и атомарно переименовываются: процессы, уже отобразившие старый
+    бандл, продолжают читать его, новые загрузки видят только целый новый файл.
+    Сначала заменяется {имя}.json (с контрольной суммой нового файла и, в "previous",
+    прежнего), затем сам бандл: загрузка между двумя заменами видит прежний бандл и
+    проверяет его по "previous", а не падает на несовпадении контрольной суммы.
+    Массивы не сжимаются, чтобы их можно было отобразить через mmap_mode.
+
+    Args:
+        bundle (Dict[str, Any]): Бандл из build_bundle.
+        directory (Optional[str]): Папка бандлов (по умолчанию BUNDLE_DIR).
+
+    Returns:
+        str: Путь к сохранённому бандлу.
+    """
+    directory = directory or BUNDLE_DIR
+    os.makedirs(directory, exist_ok=True)
+    previous = read_bundle_info(bundle["name"], directory)
+    bundle["version"] = (previous or {}).get("version", 0) + 1
+
+    path = bundle_path(bundle["name"], directory)
+    joblib.dump(bundle, f"{path}.tmp")
+
+    info = {key: bundle[key] for key in ("name", "format_version", "version", "content_hash", "metadata")}
+    info["file_sha256"] = file_sha256(f"{path}.tmp")
+    if previous:
+        info["previous"] = {key: previous.get(key) for key in ("version", "content_hash", "file_sha256")}
+    info_path = os.path.splitext(path)[0] + ".json"
+    with open(f"{info_path}.tmp", "w") as f:
+        json.dump(info, f, indent=2, default=str)
+    os.replace(f"{info_path}.tmp", info_path)
+    os.replace(f"{path}.tmp", path)
+    logger.info(f"Бандл {bundle['name']} версии {bundle['version']} сохранён: {path} (hash {bundle['content_hash']})")
+    return path
+
+def load_bundle(path: str, mmap_mode: Optional[str] = "r", verify: bool = False) -> Dict[str, Any]:
+    """
+    Загружает бандл модели.
+
+    С mmap_mode="r" массивы numpy (таблицы предобработки, веса MLP) не копируются,
+    а отображаются из файла: страницы общие для всех процессов, загрузивших тот же
+    бандл, через page cache. Деревья sklearn при распаковке копируют свои узлы, их
+    память делится между процессами пула за счёт загрузки в родительском процессе
+    до fork (прогрев воркера).
+
+    Args:
+        path (str): Путь к бандлу.
+        mmap_mode (Optional[str]): Режим отображения массивов (None - читать в память).
+        verify (bool): Сверить контрольную сумму файла и хэш содержимого с {имя}.json
+            (с текущей версией или, пока save_bundle заменяет файлы, с "previous").
+
+    Returns:
+        Dict[str, Any]: Бандл.
+
+    Raises:
+        ValueError: Если формат бандла не поддерживается или бандл не совпадает с {имя}.json.
+    """
+    info_path = os.path.splitext(path)[0] + ".json"
+    info = None
+    if verify:
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Нет метаданных бандла {info_path}, контрольная сумма не проверяется")
+        if info:
+            checksum = file_sha256(path)
+            info = next((i for i in [info, info.get("previous")] if i and i.get("file_sha256") == checksum), None)
+            if info is None:
+                raise ValueError(f"Model bundle checksum mismatch: {path}")
+
+    bundle = joblib.load(path, mmap_mode=mmap_mode)
+    if not isinstance(bundle, dict) or bundle.get("format_version") != BUNDLE_FORMAT_VERSION:
+        version = bundle.get("format_version") if isinstance(bundle, dict) else None
+        raise ValueError(f"Unsupported model bundle format {version}: {path}")
+    if info and info.get("content_hash") != bundle["content_hash"]:
+        raise ValueError(f"Model bundle content hash mismatch: {path}")
+    return bundle
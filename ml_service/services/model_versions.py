@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+import numpy as np
+from fastapi import HTTPException
+from services import prediction_service
+from services.metrics import MODEL_RELOADS_TOTAL
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Как часто (в секундах) проверять файлы загруженных моделей на новую версию
+# (0 отключает горячую подмену - новые версии подхватываются только после перезапуска)
+MODEL_RELOAD_INTERVAL = float(os.getenv("MODEL_RELOAD_INTERVAL", "30"))
+
+class ModelVersionManager:
+    """
+    Подменяет версии моделей в кэше процесса без перезапуска воркера.
+
+    Фоновый поток раз в interval секунд сравнивает отпечаток файлов каждой
+    загруженной модели (model_fingerprint) с отпечатком загруженной версии.
+    Новая версия загружается рядом со старой, проверяется прогревочным
+    предсказанием и атомарно заменяет запись кэша. Задачи считаются версией,
+    закреплённой при запуске (load_pinned_artifacts), поэтому старая версия
+    хранится ещё MODEL_PREVIOUS_VERSION_TTL секунд. Версия, не прошедшая
+    проверку, не подменяется и не перепроверяется, пока файлы модели не
+    изменятся снова.
+
+    Каждый процесс пула загружает новую версию сам: страницы, общие после
+    загрузки до fork (copy-on-write), не разделяются, и N процессов держат
+    N копий новой версии (плюс до TTL секунд - прежнюю). Бандл по умолчанию
+    отображается через mmap (MODEL_BUNDLE_MMAP_MODE) и делит страничный кэш,
+    но объекты модели в куче - нет. Общую память возвращает перезапуск воркера;
+    MODEL_RELOAD_INTERVAL=0 отключает подмену совсем.
+    """
+
+    def __init__(self, interval: float = MODEL_RELOAD_INTERVAL):
+        self.interval = interval
+        self._rejected = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def check(self, model_name: str) -> bool:
+        """
+        Проверяет модель на новую версию и подменяет её в кэше.
+
+        Args:
+            model_name (str): Имя модели.
+
+        Returns:
+            bool: True, если новая версия загружена, проверена и подменена.
+        """
+        with self._lock:
+            current = prediction_service._ARTIFACTS_CACHE.get(model_name)
+            fingerprint = prediction_service.model_fingerprint(model_name)
+            if current is None or fingerprint is None or fingerprint in (current.get("fingerprint"), self._rejected.get(model_name)):
+                return False
+
+            started = time.perf_counter()
+            try:
+                artifacts = prediction_service.read_model_artifacts(model_name)
+                self.validate(artifacts, current)
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                self._rejected[model_name] = fingerprint
+                MODEL_RELOADS_TOTAL.labels(model=model_name, status="rejected").inc()
+                logger.error(f"Новая версия модели {model_name} не прошла проверку, остаётся прежняя: {detail}")
+                return False
+
+            prediction_service.swap_model_artifacts(model_name, artifacts)
+            self._rejected.pop(model_name, None)
+            MODEL_RELOADS_TOTAL.labels(model=model_name, status="swapped").inc()
+            logger.info(
+                f"Модель {model_name}: версия {current.get('version')} заменена на {artifacts.get('version')} "
+                f"за {time.perf_counter() - started:.2f} с"
+            )
+            return True
+
+    @staticmethod
+    def validate(artifacts: dict, current: dict) -> None:
+        """
+        Проверяет новую версию прогревочным предсказанием.
+
+        Raises:
+            ValueError: Если предсказание не совпадает по форме или метки классов
+                отличаются от меток текущей версии.
+        """
+        labels = prediction_service.predict_dataframe(prediction_service.build_warmup_frame(artifacts), artifacts)
+        if len(labels) != 1 or labels[0] not in artifacts["class_labels"]:
+            raise ValueError(f"Smoke prediction returned {labels}")
+        if set(np.asarray(artifacts["class_labels"]).tolist()) != set(np.asarray(current["class_labels"]).tolist()):
+            raise ValueError(f"Class labels changed: {list(current['class_labels'])} -> {list(artifacts['class_labels'])}")
+
+    def check_all(self) -> List[str]:
+        """Проверяет все загруженные модели и возвращает имена подменённых."""
+        prediction_service.expire_previous_artifacts()
+        return [name for name in list(prediction_service._ARTIFACTS_CACHE) if self.check(name)]
+
+    def run(self) -> None:
+        """Цикл фонового потока: проверка раз в interval секунд до вызова stop."""
+        while not self._stop.wait(self.interval):
+            try:
+                self.check_all()
+            except Exception as e:
+                logger.error(f"Проверка версий моделей не удалась: {e}")
+
+    def start(self) -> None:
+        """Запускает фоновый поток проверки версий."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="model-version-manager", daemon=True)
+        self._thread.start()
+        logger.info(f"Проверка новых версий моделей каждые {self.interval} с")
+
+    def stop(self) -> None:
+        """Останавливает фоновый поток."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+def start_model_watcher() -> Optional[ModelVersionManager]:
+    """
+    Запускает горячую подмену моделей в текущем процессе (MODEL_RELOAD_INTERVAL > 0).
+
+    Returns:
+        Optional[ModelVersionManager]: Запущенный менеджер или None, если подмена отключена.
+    """
+    if MODEL_RELOAD_INTERVAL <= 0:
+        return None
+    manager = ModelVersionManager()
+    manager.start()
+    return manager
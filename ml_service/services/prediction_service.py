@@ -1,16 +1,40 @@
+import hashlib
 import json
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import io
 import logging
 import pickle
 import os
-from typing import List, Dict, Any, Sequence
+import time
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Callable, Optional, Tuple, Union
 from fastapi import HTTPException
+from pydantic import TypeAdapter, ValidationError
 from sqlalchemy.orm import Session
 from models.prediction import Prediction
 from models.model import Model
+from models.mushroom_record import MushroomRecord
 from db.db_model import DBModel
-from services.db_operations import create_prediction, update_prediction_result, get_model_by_id
+from celery.exceptions import SoftTimeLimitExceeded
+from services.db_operations import (
+    update_prediction_result,
+    get_model_by_id,
+    save_prediction_chunk,
+    get_prediction_chunks,
+    delete_prediction_chunks)
+from services.spool import read_input_spool, spool_row_count
+from services.metrics import timed, ROWS_TOTAL
+try:
+    import python_calamine  # noqa: F401 - необязательный движок для XLSX (pandas engine="calamine")
+except ImportError:
+    python_calamine = None
+from services.model_bundle import bundle_path, load_bundle, read_bundle_info, category_lookup, encode_categorical
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -27,7 +51,47 @@ for directory in [MODEL_DIR, IMPUTER_DIR, ENCODER_DIR]:
     if not os.path.exists(directory):
         logger.error(f"Не найдена директория: {directory}")
         raise FileNotFoundError(f"Directory not found: {directory}")
-    
+
+# Режим отображения массивов бандла (пустая строка - читать в память процесса)
+# и проверка хэша содержимого бандла при загрузке
+MODEL_BUNDLE_MMAP_MODE = os.getenv("MODEL_BUNDLE_MMAP_MODE", "r") or None
+MODEL_BUNDLE_VERIFY = os.getenv("MODEL_BUNDLE_VERIFY", "1") == "1"
+
+# Размер чанка, после которого сохраняется чекпоинт предсказания
+PREDICTION_CHUNK_SIZE = int(os.getenv("PREDICTION_CHUNK_SIZE", "10000"))
+
+# Поддерживаемые форматы входных файлов (расширения). Parquet и Arrow IPC
+# читаются с проекцией на REQUIRED_COLUMNS и готовыми типами столбцов
+ARROW_FILE_TYPES = ("arrow", "feather", "ipc")
+INPUT_FILE_TYPES = ("csv", "xlsx", "parquet") + ARROW_FILE_TYPES
+# Движок чтения XLSX: stream (потоковое чтение XML листа, read_xlsx_rows), calamine
+# (pd.read_excel на Rust, нужен необязательный пакет python-calamine) или pandas (прежний pd.read_excel)
+XLSX_ENGINES = ("stream", "calamine", "pandas")
+XLSX_ENGINE = os.getenv("XLSX_ENGINE", "stream")
+if XLSX_ENGINE not in XLSX_ENGINES:
+    raise ValueError(f"XLSX_ENGINE must be one of {', '.join(XLSX_ENGINES)}, got {XLSX_ENGINE!r}")
+if XLSX_ENGINE == "calamine" and python_calamine is None:
+    raise ImportError("XLSX_ENGINE=calamine requires the python-calamine package")
+XLSX_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_RELS_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+XLSX_REL_ID = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id"
+
+# Схема записей JSON/NDJSON запросов и размер пакета строк NDJSON, который
+# проверяется одним вызовом и добавляется к данным как блок столбцов
+RECORD_ADAPTER = TypeAdapter(MushroomRecord)
+RECORDS_ADAPTER = TypeAdapter(List[MushroomRecord])
+NDJSON_BATCH_ROWS = int(os.getenv("NDJSON_BATCH_ROWS", "10000"))
+
+# Ансамбль: модели предсказывают по общей матрице признаков в пуле потоков
+# (0 - поток на каждую модель); имя в метриках для этапов всего ансамбля
+ENSEMBLE_MAX_THREADS = int(os.getenv("ENSEMBLE_MAX_THREADS", "0"))
+ENSEMBLE_METRIC_NAME = "ensemble"
+
+# Каскад: строки, в которых модель уверена не ниже порога (максимальная вероятность
+# класса), остаются за ней, остальные передаются следующей модели
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", "0.9"))
+CASCADE_METRIC_NAME = "cascade"
+
 # Список всех признаков
 REQUIRED_COLUMNS = [
     "cap-diameter", "cap-shape", "cap-surface", "cap-color", "does-bruise-or-bleed",
@@ -42,7 +106,9 @@ CATEGORICAL_COLUMNS = [col for col in REQUIRED_COLUMNS if col not in NUMERICAL_C
 MODELS = [
     Model(id=1, name="RandomForest", cost=1.0, file_path=f"{MODEL_DIR}/RandomForest.pkl"),
     Model(id=2, name="GradientBoosting", cost=2.0, file_path=f"{MODEL_DIR}/GradientBoosting.pkl"),
-    Model(id=3, name="NeuralNetwork", cost=3.0, file_path=f"{MODEL_DIR}/NeuralNetwork.pkl")
+    Model(id=3, name="NeuralNetwork", cost=3.0, file_path=f"{MODEL_DIR}/NeuralNetwork.pkl"),
+    Model(id=4, name="HistGradientBoosting", cost=1.5, file_path=bundle_path("HistGradientBoosting")),
+    Model(id=5, name="RandomForestLite", cost=0.5, file_path=bundle_path("RandomForestLite"))
 ]
 
 def get_available_models(db: Session) -> List[Model]:
@@ -57,18 +123,222 @@ def get_available_models(db: Session) -> List[Model]:
     """
     logger.info("Получение списка доступных моделей")
     db_models = db.query(DBModel).all()
-    return [Model(id=m.id, name=m.name, cost=m.cost, file_path=m.file_path) for m in db_models]
+    return [Model(id=m.id, name=m.name, cost=m.cost, file_path=m.file_path, profile=m.profile) for m in db_models]
+
+def read_arrow_table(table: pa.Table) -> pd.DataFrame:
+    """
+    Переводит таблицу Arrow в DataFrame, оставляя только столбцы REQUIRED_COLUMNS.
+
+    Типы столбцов берутся из файла, текст не разбирается. Пропуски в категориальных
+    столбцах становятся NaN (как пустые ячейки CSV), чтобы coerce_input_data привёл
+    их к 'nan', а не к 'None'.
+
+    Args:
+        table (pa.Table): Таблица из Parquet или Arrow IPC.
+
+    Returns:
+        pd.DataFrame: Данные с имеющимися в таблице столбцами из REQUIRED_COLUMNS.
+    """
+    table = table.select([col for col in REQUIRED_COLUMNS if col in table.column_names])
+    df = table.to_pandas()
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
+
+def read_columnar_file(file: bytes, file_type: str) -> pd.DataFrame:
+    """
+    Читает Parquet или Arrow IPC (файл или поток; Feather v2 - это файл Arrow IPC)
+    с проекцией на столбцы REQUIRED_COLUMNS.
+
+    Parquet читает с диска только нужные столбцы; Arrow IPC отображается из буфера
+    без копирования, и в DataFrame переводятся только нужные столбцы.
+
+    Args:
+        file (bytes): Содержимое файла.
+        file_type (str): 'parquet' или один из ARROW_FILE_TYPES.
+
+    Returns:
+        pd.DataFrame: Прочитанные данные (см. read_arrow_table).
+    """
+    buffer = pa.BufferReader(file)
+    if file_type == "parquet":
+        parquet = pq.ParquetFile(buffer)
+        columns = [col for col in REQUIRED_COLUMNS if col in parquet.schema_arrow.names]
+        return read_arrow_table(parquet.read(columns=columns))
+    try:
+        table = pa.ipc.open_file(buffer).read_all()
+    except pa.ArrowInvalid:
+        table = pa.ipc.open_stream(pa.BufferReader(file)).read_all()
+    return read_arrow_table(table)
+
+def xlsx_first_sheet(archive: zipfile.ZipFile) -> str:
+    """
+    Возвращает путь к XML первого листа книги XLSX внутри архива.
+
+    Args:
+        archive (zipfile.ZipFile): Открытый архив XLSX.
+
+    Returns:
+        str: Путь к файлу листа (например, 'xl/worksheets/sheet1.xml').
+    """
+    sheet = ET.fromstring(archive.read("xl/workbook.xml")).find(f"{XLSX_NS}sheets/{XLSX_NS}sheet")
+    rels = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    target = next(
+        rel.get("Target") for rel in rels.iter(f"{XLSX_RELS_NS}Relationship") if rel.get("Id") == sheet.get(XLSX_REL_ID)
+    )
+    return target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+
+def xlsx_shared_strings(archive: zipfile.ZipFile) -> List[str]:
+    """
+    Читает таблицу общих строк XLSX (xl/sharedStrings.xml).
+
+    Args:
+        archive (zipfile.ZipFile): Открытый архив XLSX.
+
+    Returns:
+        List[str]: Строки по индексу; пустой список, если таблицы нет.
+    """
+    if "xl/sharedStrings.xml" not in archive.namelist():
+        return []
+    strings = []
+    for _, element in ET.iterparse(archive.open("xl/sharedStrings.xml")):
+        if element.tag == f"{XLSX_NS}si":
+            # Текст - либо <t>, либо фрагменты форматированного текста <r><t>; фонетика <rPh> не входит
+            parts = element.findall(f"{XLSX_NS}t") + element.findall(f"{XLSX_NS}r/{XLSX_NS}t")
+            strings.append("".join(part.text or "" for part in parts))
+            element.clear()
+    return strings
+
+def read_xlsx_rows(file: bytes) -> pd.DataFrame:
+    """
+    Потоково читает первый лист XLSX, оставляя только столбцы REQUIRED_COLUMNS.
+
+    XML листа разбирается построчно парсером ElementTree (C), без объектной модели
+    openpyxl: у ячеек ненужных столбцов не разбираются значения, разобранные строки
+    сразу удаляются из дерева. Первая непустая строка - заголовок. Пропускаются только
+    полностью пустые строки листа: строка, где заполнен хотя бы один столбец (даже
+    ненужный), остаётся строкой из пропусков, чтобы результаты совпадали со строками
+    файла. Пустой <v></v> - пропуск.
+    Значения - как у openpyxl: строки (общие и inline), числа, bool;
+    пустые ячейки категориальных столбцов - NaN. Форматы дат не применяются
+    (дата остаётся числом Excel) - в признаках датасета дат нет. Ячейки прочих
+    типов (даты ISO 8601 t="d", формулы t="str", ошибки t="e") остаются строками
+    и проверяются в coerce_input_data, как строки из CSV.
+
+    Args:
+        file (bytes): Содержимое файла XLSX.
+
+    Returns:
+        pd.DataFrame: Данные с имеющимися на листе столбцами из REQUIRED_COLUMNS.
+    """
+    with zipfile.ZipFile(io.BytesIO(file)) as archive:
+        strings = xlsx_shared_strings(archive)
+        cell_tag, value_tag, text_tag = f"{XLSX_NS}c", f"{XLSX_NS}v", f"{XLSX_NS}t"
+        row_tag, sheet_data_tag = f"{XLSX_NS}row", f"{XLSX_NS}sheetData"
+        letters_index: Dict[str, int] = {}
+        header: Optional[Dict[int, Any]] = None
+        wanted: Dict[int, int] = {}
+        columns: List[str] = []
+        records = []
+        sheet_data = None
+        for event, element in ET.iterparse(archive.open(xlsx_first_sheet(archive)), events=("start", "end")):
+            if event == "start":
+                if element.tag == sheet_data_tag:
+                    sheet_data = element
+                continue
+            if element.tag != row_tag:
+                continue
+            values: Dict[int, Any] = {}
+            blank = True
+            position = -1
+            for cell in element:
+                ref = cell.get("r")
+                if ref:
+                    letters = ref.rstrip("0123456789")
+                    position = letters_index.get(letters)
+                    if position is None:
+                        position = sum(
+                            (ord(ch) - 64) * 26 ** i for i, ch in enumerate(reversed(letters))
+                        ) - 1
+                        letters_index[letters] = position
+                else:
+                    position += 1
+                kind = cell.get("t")
+                if header is not None and position not in wanted:
+                    # Значения ненужных столбцов не разбираются, только проверяется, что строка не пустая
+                    if blank and (cell.findtext(value_tag) or kind == "inlineStr" and any(part.text for part in cell.iter(text_tag))):
+                        blank = False
+                    continue
+                if kind == "inlineStr":
+                    value = "".join(part.text or "" for part in cell.iter(text_tag)) or None
+                else:
+                    value = cell.findtext(value_tag) or None  # пустой <v></v> - пропуск
+                    if value is not None:
+                        if kind == "s":
+                            value = strings[int(value)]
+                        elif kind == "b":
+                            value = value == "1"
+                        elif kind in (None, "n"):
+                            value = int(value) if value.lstrip("-").isdigit() else float(value)
+                if value is not None:
+                    values[position] = value
+                    blank = False
+            element.clear()
+            if sheet_data is not None:
+                sheet_data.remove(element)
+            if blank:
+                continue
+            if header is None:
+                header = values
+                positions = {name: i for i, name in header.items() if name in REQUIRED_COLUMNS}
+                columns = [col for col in REQUIRED_COLUMNS if col in positions]
+                wanted = {positions[col]: j for j, col in enumerate(columns)}
+                if not columns:
+                    break
+                continue
+            record = [None] * len(columns)
+            for position, value in values.items():
+                record[wanted[position]] = value
+            records.append(record)
+    if header is not None and not columns:
+        return pd.DataFrame(columns=list(header.values()))
+    df = pd.DataFrame.from_records(records, columns=columns)
+    for col in CATEGORICAL_COLUMNS:
+        if col in df.columns and df[col].dtype == object:
+            df[col] = df[col].where(df[col].notna(), np.nan)
+    return df
 
-def read_input_file(file: bytes, file_type: str) -> Sequence[Dict[str, Any]]:
+def read_xlsx_file(file: bytes) -> pd.DataFrame:
     """
-    Читает входной файл (CSV или XLSX) и возвращает данные в формате списка словарей.
+    Читает XLSX движком из XLSX_ENGINE.
+
+    Args:
+        file (bytes): Содержимое файла XLSX.
+
+    Returns:
+        pd.DataFrame: Прочитанные данные.
+    """
+    if XLSX_ENGINE == "calamine":
+        # dtype=object: иначе столбец из true/false с пропуском pandas превращает в 0.0/1.0
+        return pd.read_excel(
+            io.BytesIO(file), engine="calamine", usecols=lambda col: col in REQUIRED_COLUMNS,
+            dtype={col: object for col in CATEGORICAL_COLUMNS}
+        )
+    if XLSX_ENGINE == "pandas":
+        return pd.read_excel(io.BytesIO(file))
+    return read_xlsx_rows(file)
+
+def read_input_file(file: bytes, file_type: str) -> pd.DataFrame:
+    """
+    Читает входной файл (CSV, XLSX, Parquet или Arrow IPC) и возвращает данные в виде DataFrame.
 
     Args:
         file (bytes): Содержимое файла в виде байтов.
-        file_type (str): Тип файла ('csv' или 'xlsx').
+        file_type (str): Тип файла (один из INPUT_FILE_TYPES).
 
     Returns:
-        Sequence[Dict[str, Any]]: Данные в формате списка словарей.
+        pd.DataFrame: Прочитанные данные.
 
     Raises:
         HTTPException: Если тип файла не поддерживается или произошла ошибка чтения.
@@ -80,164 +350,1001 @@ def read_input_file(file: bytes, file_type: str) -> Sequence[Dict[str, Any]]:
         if file_type == "csv":
             df = pd.read_csv(file_stream)
         elif file_type == "xlsx":
-            df = pd.read_excel(file_stream)
+            df = read_xlsx_file(file)
+        elif file_type == "parquet" or file_type in ARROW_FILE_TYPES:
+            df = read_columnar_file(file, file_type)
         else:
             logger.error(f"Неподдерживаемый тип файла: {file_type}")
-            raise HTTPException(status_code=400, detail="Неподдерживаемый тип файла. Поддерживаются только CSV и XLSX файлы.")
-        data = df.to_dict(orient="records")
-        logger.info(f"Успешно прочитано строк: {len(data)}")
-        return data
+            raise HTTPException(status_code=400, detail="Неподдерживаемый тип файла. Поддерживаются CSV, XLSX, Parquet и Arrow файлы.")
+        logger.info(f"Успешно прочитано строк: {len(df)}")
+        return df
     except Exception as e:
         logger.error(f"Ошибка чтения файла: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Ошибка чтения файла: {str(e)}")
 
-def validate_input_data(data: Sequence[Dict[str, Any]]) -> Sequence[Dict[str, Any]]:
+def records_to_frame(records: List[Dict[str, Any]]) -> pd.DataFrame:
+    """
+    Собирает проверенные записи (MushroomRecord) сразу в столбцы с типами признаков.
+
+    Результат такой же, как у coerce_input_data для файла с теми же значениями:
+    числовые признаки - float64 (null - NaN), категориальные - строки (null - 'nan',
+    как пустая ячейка CSV; true/false - 'True'/'False', как у pandas).
+
+    Args:
+        records (List[Dict[str, Any]]): Записи после проверки по MushroomRecord.
+
+    Returns:
+        pd.DataFrame: Данные со столбцами REQUIRED_COLUMNS в фиксированном порядке.
+    """
+    columns = {}
+    for col in REQUIRED_COLUMNS:
+        values = [record[col] for record in records]
+        if col in NUMERICAL_COLUMNS:
+            columns[col] = np.array(values, dtype="float64")
+        else:
+            columns[col] = np.array(["nan" if value is None else str(value) for value in values], dtype=object)
+    return pd.DataFrame(columns, columns=REQUIRED_COLUMNS)
+
+def describe_record_error(error: ValidationError, first_row: int = 0) -> str:
+    """Формирует текст первой ошибки проверки записей: номер записи, поле и причина."""
+    detail = error.errors()[0]
+    loc = detail["loc"]
+    if not loc:
+        return detail["msg"]
+    field = f" field {loc[1]}" if len(loc) > 1 else ""
+    return f"Record {first_row + int(loc[0])}{field}: {detail['msg']}"
+
+def read_json_records(body: bytes, first_row: int = 0) -> pd.DataFrame:
+    """
+    Разбирает JSON-массив записей о грибах и проверяет его по схеме MushroomRecord.
+
+    JSON разбирается и проверяется pydantic-core за один проход, без промежуточного
+    DataFrame из словарей; записи сразу собираются в столбцы (records_to_frame).
+
+    Args:
+        body (bytes): Тело запроса - JSON-массив объектов.
+        first_row (int): Номер первой записи (для сообщений об ошибках в пакетах NDJSON).
+
+    Returns:
+        pd.DataFrame: Данные со столбцами REQUIRED_COLUMNS.
+
+    Raises:
+        HTTPException: Если JSON некорректен, пуст или запись не проходит проверку (400).
+    """
+    try:
+        records = RECORDS_ADAPTER.validate_json(body)
+    except ValidationError as e:
+        logger.error(f"Ошибка проверки JSON-записей: {describe_record_error(e, first_row)}")
+        raise HTTPException(status_code=400, detail=f"Invalid records: {describe_record_error(e, first_row)}")
+    return records_to_frame(records)
+
+def read_ndjson_lines(lines: List[bytes], first_row: int = 0) -> pd.DataFrame:
+    """
+    Разбирает пакет строк NDJSON (по одной записи на строку).
+
+    Пакет проверяется одним вызовом как JSON-массив; если JSON некорректен,
+    строки проверяются по одной, чтобы указать номер ошибочной записи.
+
+    Args:
+        lines (List[bytes]): Непустые строки NDJSON.
+        first_row (int): Номер первой строки пакета среди всех записей.
+
+    Returns:
+        pd.DataFrame: Данные со столбцами REQUIRED_COLUMNS.
+
+    Raises:
+        HTTPException: Если строка - некорректный JSON или запись не проходит проверку (400).
+    """
+    try:
+        records = RECORDS_ADAPTER.validate_json(b"[" + b",".join(lines) + b"]")
+    except ValidationError as e:
+        if e.errors()[0]["loc"]:
+            raise HTTPException(status_code=400, detail=f"Invalid records: {describe_record_error(e, first_row)}")
+        for offset, line in enumerate(lines):
+            try:
+                RECORD_ADAPTER.validate_json(line)
+            except ValidationError as line_error:
+                detail = f"Record {first_row + offset}: {line_error.errors()[0]['msg']}"
+                logger.error(f"Ошибка разбора NDJSON: {detail}")
+                raise HTTPException(status_code=400, detail=f"Invalid records: {detail}")
+        raise HTTPException(status_code=400, detail=f"Invalid records: {describe_record_error(e, first_row)}")
+    return records_to_frame(records)
+
+def validate_input_data(data: pd.DataFrame) -> pd.DataFrame:
     """
     Проверяет входные данные на наличие всех необходимых столбцов.
 
     Args:
-        data (Sequence[Dict[str, Any]]): Входные данные в формате списка словарей.
+        data (pd.DataFrame): Входные данные.
 
     Returns:
-        Sequence[Dict[str, Any]]: Проверенные данные.
+        pd.DataFrame: Проверенные данные.
 
     Raises:
         HTTPException: Если отсутствуют необходимые столбцы.
     """
     logger.info("Валидация входных данных")
-    for row in data:
-        for col in REQUIRED_COLUMNS:
-            if col not in row:
-                logger.error(f"Пропущена колонка: {col}")
-                raise HTTPException(status_code=400, detail=f"Missing column: {col}")
+    for col in REQUIRED_COLUMNS:
+        if col not in data.columns:
+            logger.error(f"Пропущена колонка: {col}")
+            raise HTTPException(status_code=400, detail=f"Missing column: {col}")
     logger.info("Входные данные успешно провалидированы")
     return data
 
-def make_prediction(db: Session, prediction: Prediction) -> Prediction:
+def coerce_input_data(data: pd.DataFrame) -> pd.DataFrame:
     """
-    Выполняет предсказание с использованием обученной ML-модели и сохраняет результат в базе данных.
+    Оставляет только признаки модели и приводит их к типам, с которыми работает предобработка:
+    числовые - float64, категориальные - строки (как astype(str) в predict_dataframe).
 
     Args:
-        db (Session): Сессия SQLAlchemy для взаимодействия с базой данных.
-        prediction (Prediction): Объект предсказания с входными данными.
+        data (pd.DataFrame): Провалидированные входные данные.
 
     Returns:
-        Prediction: Обновлённый объект предсказания с результатами и статусом.
+        pd.DataFrame: Данные со столбцами REQUIRED_COLUMNS в фиксированном порядке.
 
     Raises:
-        HTTPException: Если модель не найдена, файл модели отсутствует или произошла ошибка предсказания.
+        HTTPException: Если в числовом столбце есть нечисловые значения (400).
+    """
+    df = pd.DataFrame(index=data.index)
+    for col in REQUIRED_COLUMNS:
+        if col in NUMERICAL_COLUMNS:
+            try:
+                df[col] = pd.to_numeric(data[col]).astype("float64")
+            except (TypeError, ValueError) as e:
+                logger.error(f"Нечисловое значение в колонке {col}: {str(e)}")
+                raise HTTPException(status_code=400, detail=f"Invalid numeric value in column {col}: {str(e)}")
+        else:
+            df[col] = data[col].astype(str)
+    return df.reset_index(drop=True)
+
+def load_prediction_frame(prediction: Prediction, start: int = 0, end: Optional[int] = None) -> pd.DataFrame:
+    """
+    Возвращает входные данные предсказания для диапазона строк.
+
+    Данные читаются из файла спула (Arrow IPC через memory map); для старых записей,
+    у которых входные данные хранятся в столбце input_data, используется он.
+
+    Args:
+        prediction (Prediction): Предсказание (или запись DBPrediction).
+        start (int): Индекс первой строки диапазона.
+        end (Optional[int]): Индекс строки после последней (по умолчанию до конца данных).
+
+    Returns:
+        pd.DataFrame: Входные данные диапазона.
+    """
+    input_path = getattr(prediction, "input_path", None)
+    if input_path:
+        return read_input_spool(input_path, start, end)
+    return pd.DataFrame(list(prediction.input_data[start:end]))
+
+def count_prediction_rows(prediction: Prediction) -> int:
+    """
+    Возвращает количество входных строк предсказания, не читая сами данные из спула.
+
+    Args:
+        prediction (Prediction): Предсказание (или запись DBPrediction).
+
+    Returns:
+        int: Количество строк.
+    """
+    input_path = getattr(prediction, "input_path", None)
+    if input_path:
+        return spool_row_count(input_path)
+    return len(prediction.input_data or [])
+
+# Кэш артефактов моделей в памяти процесса: {имя модели: артефакты}
+_ARTIFACTS_CACHE: Dict[str, Dict[str, Any]] = {}
+
+# Сколько секунд держать в памяти версию модели, вытесненную горячей подменой, для задач,
+# закреплённых за ней при запуске (0 - освобождать сразу; такие задачи продолжат текущей версией)
+MODEL_PREVIOUS_VERSION_TTL = float(os.getenv("MODEL_PREVIOUS_VERSION_TTL", "900"))
+
+# Вытесненные версии: {имя модели: (время подмены по time.monotonic, артефакты)}
+_PREVIOUS_ARTIFACTS: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+def find_model_file(model_name: str) -> Optional[str]:
+    """
+    Возвращает путь к файлу модели: бандлу, а если его нет - к отдельному .pkl.
+
+    Args:
+        model_name (str): Имя модели.
+
+    Returns:
+        Optional[str]: Путь к существующему файлу или None.
+    """
+    for path in [bundle_path(model_name), os.path.join(MODEL_DIR, f"{model_name}.pkl")]:
+        if os.path.exists(path):
+            return path
+    return None
+
+def build_artifacts(
+    model_name: str,
+    model: Any,
+    medians: Dict[str, float],
+    categories: Dict[str, np.ndarray],
+    class_labels: np.ndarray,
+    feature_order: List[str],
+    **extra: Any
+) -> Dict[str, Any]:
+    """
+    Собирает артефакты модели для predict_dataframe из таблиц предобработки.
+
+    Args:
+        model_name (str): Имя модели.
+        model: Обученная модель.
+        medians (Dict[str, float]): Медианы числовых признаков.
+        categories (Dict[str, np.ndarray]): Известные значения категориальных признаков в порядке кодов.
+        class_labels (np.ndarray): Метки классов в порядке их кодов.
+        feature_order (List[str]): Порядок признаков на входе модели.
+        **extra: Дополнительные поля (версия, хэш и источник артефактов).
+
+    Returns:
+        Dict[str, Any]: Артефакты с ключами "name", "model", "medians", "categories",
+            "lookups" (таблицы category_lookup), "unknown_codes", "class_labels",
+            "feature_order", "preprocessing_key" (хэш таблиц предобработки: модели с
+            одинаковым ключом кодируют признаки одинаково) и полями из extra.
+
+    Raises:
+        HTTPException: Если в категориях признака нет значения 'unknown' (500).
+    """
+    lookups = {}
+    unknown_codes = {}
+    for col, classes in categories.items():
+        matches = np.flatnonzero(np.asarray(classes) == "unknown")
+        if not len(matches):
+            logger.error(f"В категориях признака {col} модели {model_name} нет значения 'unknown'")
+            raise HTTPException(status_code=500, detail=f"Encoder for column {col} has no 'unknown' class")
+        unknown_codes[col] = int(matches[0])
+        lookups[col] = category_lookup(classes)
+    digest = hashlib.sha1(json.dumps([list(feature_order), medians], sort_keys=True, default=float).encode())
+    for col in sorted(categories):
+        digest.update(col.encode())
+        digest.update(np.asarray(categories[col]).tobytes())
+    return {
+        "name": model_name,
+        "model": model,
+        "medians": medians,
+        "categories": categories,
+        "lookups": lookups,
+        "unknown_codes": unknown_codes,
+        "class_labels": class_labels,
+        "feature_order": feature_order,
+        "preprocessing_key": digest.hexdigest(),
+        **extra,
+    }
+
+def load_legacy_artifacts(model_name: str) -> Dict[str, Any]:
+    """
+    Загружает модель и артефакты предобработки из отдельных .pkl файлов (модели без бандла)
+    и переводит импутеры и энкодеры в таблицы предобработки.
+
+    Args:
+        model_name (str): Имя модели (совпадает с именем .pkl файла).
+
+    Returns:
+        Dict[str, Any]: Артефакты модели (см. build_artifacts).
+
+    Raises:
+        HTTPException: Если файл модели, импутера или энкодера не найден (500).
+    """
+    model_path = os.path.join(MODEL_DIR, f"{model_name}.pkl")
+    if not os.path.exists(model_path):
+        logger.error(f"Не найден файл модели: {model_path}")
+        raise HTTPException(status_code=500, detail=f"Model file not found: {model_path}")
+    with open(model_path, 'rb') as f:
+        model = pickle.load(f)
+    logger.debug(f"Loaded model: {type(model)}, random_state: {getattr(model, 'random_state', None)}")
+
+    # Загрузка импутеров и энкодеров
+    medians = {}
+    categories = {}
+    for col in NUMERICAL_COLUMNS:
+        imputer_path = os.path.join(IMPUTER_DIR, f'imputer_{col}.pkl')
+        if not os.path.exists(imputer_path):
+            logger.error(f"Не найден файл импутера: {imputer_path}")
+            raise HTTPException(status_code=500, detail=f"Imputer file not found: {imputer_path}")
+        with open(imputer_path, 'rb') as f:
+            medians[col] = float(pickle.load(f).statistics_[0])
+
+    # Категориальные импутеры (константа 'unknown') после astype(str) ничего не меняют:
+    # пропуски уже стали строкой 'nan', поэтому нужны только классы энкодеров
+    for col in CATEGORICAL_COLUMNS:
+        encoder_path = os.path.join(ENCODER_DIR, f'le_{col}.pkl')
+        if not os.path.exists(encoder_path):
+            logger.error(f"Не найден файл энкодера: {encoder_path}")
+            raise HTTPException(status_code=500, detail=f"Encoder file not found: {encoder_path}")
+        with open(encoder_path, 'rb') as f:
+            categories[col] = np.asarray(pickle.load(f).classes_, dtype=str)
+    le_class_path = os.path.join(ENCODER_DIR, 'le_class.pkl')
+    if not os.path.exists(le_class_path):
+        logger.error(f"Не найден файл энкодера классов: {le_class_path}")
+        raise HTTPException(status_code=500, detail=f"Class encoder file not found: {le_class_path}")
+    with open(le_class_path, 'rb') as f:
+        class_labels = np.asarray(pickle.load(f).classes_, dtype=str)
+
+    feature_order = list(getattr(model, "feature_names_in_", REQUIRED_COLUMNS))
+    return build_artifacts(model_name, model, medians, categories, class_labels, feature_order, source=model_path)
+
+def model_fingerprint(model_name: str) -> Optional[str]:
+    """
+    Возвращает отпечаток файлов модели на диске, не загружая модель.
+
+    Для бандла - версия и контрольная сумма из {имя}.json плюс время изменения и
+    размер файла, для отдельного .pkl - время изменения и размер. Отпечаток меняется
+    при сохранении новой версии (см. services.model_versions).
+
+    Args:
+        model_name (str): Имя модели.
+
+    Returns:
+        Optional[str]: Отпечаток или None, если файла модели нет.
     """
+    path = find_model_file(model_name)
+    if path is None:
+        return None
     try:
-        logger.info(f"Создание предсказания для модели ID: {prediction.model_id}")
-        # Сохранение предсказания в БД
-        db_prediction = create_prediction(
-            db,
-            user_id=prediction.user_id,
-            model_id=prediction.model_id,
-            input_data=prediction.input_data
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if path == bundle_path(model_name):
+        info = read_bundle_info(model_name) or {}
+        return f"bundle:{info.get('version')}:{info.get('file_sha256')}:{stat.st_mtime_ns}:{stat.st_size}"
+    return f"pkl:{stat.st_mtime_ns}:{stat.st_size}"
+
+def read_model_artifacts(model_name: str) -> Dict[str, Any]:
+    """
+    Загружает модель и артефакты предобработки с диска, минуя кэш процесса.
+
+    Если есть бандл модели (ml_models/bundles/{имя}.joblib), всё читается из него
+    (массивы отображаются через mmap, см. MODEL_BUNDLE_MMAP_MODE), иначе из отдельных
+    .pkl файлов модели, импутеров и энкодеров.
+
+    Args:
+        model_name (str): Имя модели.
+
+    Returns:
+        Dict[str, Any]: Артефакты модели (см. build_artifacts) с "fingerprint"
+            (model_fingerprint до загрузки); для бандла также "version" и "content_hash".
+
+    Raises:
+        HTTPException: Если файлы модели не найдены или бандл повреждён (500).
+    """
+    fingerprint = model_fingerprint(model_name)
+    path = bundle_path(model_name)
+    if os.path.exists(path):
+        try:
+            bundle = load_bundle(path, mmap_mode=MODEL_BUNDLE_MMAP_MODE, verify=MODEL_BUNDLE_VERIFY)
+        except ValueError as e:
+            logger.error(f"Не удалось загрузить бандл модели {model_name}: {str(e)}")
+            raise HTTPException(status_code=500, detail=str(e))
+        artifacts = build_artifacts(
+            model_name, bundle["model"], bundle["medians"], bundle["categories"],
+            bundle["class_labels"], bundle["feature_order"],
+            version=bundle["version"], content_hash=bundle["content_hash"], source=path
         )
+        logger.info(f"Бандл модели {model_name} версии {bundle['version']} загружен")
+    else:
+        artifacts = load_legacy_artifacts(model_name)
+        logger.info(f"Артефакты модели {model_name} загружены")
+    artifacts["fingerprint"] = fingerprint
+    return artifacts
 
-        # Проверка модели
-        db_model = get_model_by_id(db, prediction.model_id)
-        if not db_model:
-            update_prediction_result(db, db_prediction.id, [], "failed")
-            logger.error(f"Модель не найдена: {prediction.model_id}")
-            raise HTTPException(status_code=400, detail="Invalid model ID")
+def load_model_artifacts(model_name: str) -> Dict[str, Any]:
+    """
+    Возвращает артефакты модели из кэша процесса, загружая их при первом обращении.
+
+    Новые версии подменяются в кэше целиком (services.model_versions), поэтому
+    задача, получившая артефакты, дорабатывает на них, а следующие задачи получают
+    новую версию.
+
+    Args:
+        model_name (str): Имя модели.
+
+    Returns:
+        Dict[str, Any]: Артефакты модели (см. read_model_artifacts).
+
+    Raises:
+        HTTPException: Если файлы модели не найдены или бандл повреждён (500).
+    """
+    if model_name in _ARTIFACTS_CACHE:
+        return _ARTIFACTS_CACHE[model_name]
+    artifacts = read_model_artifacts(model_name)
+    _ARTIFACTS_CACHE[model_name] = artifacts
+    logger.info(f"Артефакты модели {model_name} добавлены в кэш")
+    return artifacts
 
-        # Загрузка модели
-        model_path = os.path.join(MODEL_DIR, f"{db_model.name}.pkl")
-        if not os.path.exists(model_path):
-            update_prediction_result(db, db_prediction.id, [], "failed")
-            logger.error(f"Не найден файл модели: {model_path}")
-            raise HTTPException(status_code=500, detail=f"Model file not found: {model_path}")
-        with open(model_path, 'rb') as f:
-            model = pickle.load(f)
-        logger.debug(f"Loaded model: {type(model)}, random_state: {getattr(model, 'random_state', None)}")
-
-        # Загрузка импутеров и энкодеров
-        imputers = {}
-        encoders = {}
-        for col in NUMERICAL_COLUMNS:
-            imputer_path = os.path.join(IMPUTER_DIR, f'imputer_{col}.pkl')
-            if not os.path.exists(imputer_path):
-                update_prediction_result(db, db_prediction.id, [], "failed")
-                logger.error(f"Не найден файл импутера: {imputer_path}")
-                raise HTTPException(status_code=500, detail=f"Imputer file not found: {imputer_path}")
-            imputers[col] = pickle.load(open(imputer_path, 'rb'))
-
-        for col in CATEGORICAL_COLUMNS:
-            imputer_path = os.path.join(IMPUTER_DIR, f'imputer_{col}.pkl')
-            encoder_path = os.path.join(ENCODER_DIR, f'le_{col}.pkl')
-            if not os.path.exists(imputer_path):
-                update_prediction_result(db, db_prediction.id, [], "failed")
-                logger.error(f"Не найден файл импутера: {imputer_path}")
-                raise HTTPException(status_code=500, detail=f"Imputer file not found: {imputer_path}")
-            if not os.path.exists(encoder_path):
-                update_prediction_result(db, db_prediction.id, [], "failed")
-                logger.error(f"Не найден файл энкодера: {encoder_path}")
-                raise HTTPException(status_code=500, detail=f"Encoder file not found: {encoder_path}")
-            imputers[col] = pickle.load(open(imputer_path, 'rb'))
-            encoders[col] = pickle.load(open(encoder_path, 'rb'))
-        le_class_path = os.path.join(ENCODER_DIR, 'le_class.pkl')
-        if not os.path.exists(le_class_path):
-            update_prediction_result(db, db_prediction.id, [], "failed")
-            logger.error(f"Не найден файл энкодера классов: {le_class_path}")
-            raise HTTPException(status_code=500, detail=f"Class encoder file not found: {le_class_path}")
-        le_class = pickle.load(open(le_class_path, 'rb'))
-
-        # Валидация данных
-        data = validate_input_data(prediction.input_data)
-
-        # Подготовка данных для предсказания
-        df = pd.DataFrame(data)
-
-        # Обработка NaN
-        for col in NUMERICAL_COLUMNS:
-            df[col] = imputers[col].transform(df[[col]]).ravel()
-        for col in CATEGORICAL_COLUMNS:
-            df[col] = imputers[col].transform(df[[col]].astype(str)).ravel()
-
-        # Обработка неизвестных категориальных значений
-        for col in CATEGORICAL_COLUMNS:
-            known_classes = set(encoders[col].classes_)
-            df[col] = df[col].apply(lambda x: x if x in known_classes else 'unknown')
-
-        # Кодирование категориальных признаков
-        for col in CATEGORICAL_COLUMNS:
+def swap_model_artifacts(model_name: str, artifacts: Dict[str, Any]) -> None:
+    """
+    Подменяет версию модели в кэше процесса, сохраняя вытесненную версию
+    на MODEL_PREVIOUS_VERSION_TTL секунд (см. load_pinned_artifacts).
+
+    Args:
+        model_name (str): Имя модели.
+        artifacts (Dict[str, Any]): Артефакты новой версии (см. read_model_artifacts).
+    """
+    previous = _ARTIFACTS_CACHE.get(model_name)
+    _ARTIFACTS_CACHE[model_name] = artifacts
+    if previous is not None and MODEL_PREVIOUS_VERSION_TTL > 0:
+        _PREVIOUS_ARTIFACTS[model_name] = (time.monotonic(), previous)
+
+def expire_previous_artifacts(now: Optional[float] = None) -> List[str]:
+    """
+    Освобождает вытесненные версии моделей старше MODEL_PREVIOUS_VERSION_TTL секунд.
+
+    Args:
+        now (Optional[float]): Текущее время по time.monotonic (по умолчанию - сейчас).
+
+    Returns:
+        List[str]: Имена моделей, чьи прежние версии освобождены.
+    """
+    now = time.monotonic() if now is None else now
+    expired = [
+        name for name, (swapped_at, _) in list(_PREVIOUS_ARTIFACTS.items())
+        if now - swapped_at >= MODEL_PREVIOUS_VERSION_TTL
+    ]
+    for name in expired:
+        _PREVIOUS_ARTIFACTS.pop(name, None)
+    return expired
+
+def pin_model_versions(model_names: List[str]) -> Dict[str, Optional[str]]:
+    """
+    Возвращает версии моделей, которыми задача начинает считать в этом процессе.
+
+    Вызывается при первом запуске задачи (services.tasks.predict_task): шарды и
+    продолжения затем считаются теми же версиями (load_pinned_artifacts).
+
+    Args:
+        model_names (List[str]): Имена моделей предсказания.
+
+    Returns:
+        Dict[str, Optional[str]]: {имя модели: отпечаток версии из кэша процесса, а для
+            ещё не загруженной модели - model_fingerprint файлов на диске}.
+    """
+    return {
+        name: _ARTIFACTS_CACHE[name].get("fingerprint") if name in _ARTIFACTS_CACHE else model_fingerprint(name)
+        for name in model_names
+    }
+
+def load_pinned_artifacts(model_name: str, fingerprint: Optional[str]) -> Dict[str, Any]:
+    """
+    Возвращает артефакты версии модели, закреплённой за задачей при её запуске.
+
+    Шарды и продолжения одной задачи считаются одной версией, даже если процессы
+    пула подменяют модель в разное время. Версия ищется в кэше процесса, затем среди
+    вытесненных версий (swap_model_artifacts); если процесс ещё не подменил модель,
+    а на диске уже закреплённая версия, она читается только для этой задачи - кэш
+    подменит services.model_versions после проверки. Если закреплённой версии больше
+    нет (новый процесс пула, истёк MODEL_PREVIOUS_VERSION_TTL), задача продолжается
+    текущей версией.
+
+    Args:
+        model_name (str): Имя модели.
+        fingerprint (Optional[str]): Закреплённый отпечаток (None - текущая версия процесса).
+
+    Returns:
+        Dict[str, Any]: Артефакты модели (см. read_model_artifacts).
+
+    Raises:
+        HTTPException: Если файлы модели не найдены или бандл повреждён (500).
+    """
+    artifacts = load_model_artifacts(model_name)
+    if fingerprint is None or artifacts.get("fingerprint") == fingerprint:
+        return artifacts
+    previous = _PREVIOUS_ARTIFACTS.get(model_name)
+    if previous is not None and previous[1].get("fingerprint") == fingerprint:
+        return previous[1]
+    if model_fingerprint(model_name) == fingerprint:
+        pinned = read_model_artifacts(model_name)
+        if pinned.get("fingerprint") == fingerprint:
+            logger.info(f"Модель {model_name}: закреплённая версия загружена с диска для одной задачи")
+            return pinned
+    logger.warning(
+        f"Модель {model_name}: закреплённая версия {fingerprint} больше недоступна, "
+        f"используется текущая {artifacts.get('fingerprint')}"
+    )
+    return artifacts
+
+def encode_features(df: pd.DataFrame, artifacts: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Заполняет пропуски и кодирует признаки по таблицам предобработки.
+
+    Числовые пропуски заполняются медианой, категориальные значения приводятся к
+    строкам (пропуск становится 'nan', как при обучении) и кодируются через
+    np.searchsorted по таблице поиска; неизвестные значения получают код 'unknown'.
+    Результат совпадает с SimpleImputer + LabelEncoder.
+
+    Args:
+        df (pd.DataFrame): Входные данные со всеми столбцами из REQUIRED_COLUMNS.
+        artifacts (Dict[str, Any]): Артефакты модели из load_model_artifacts.
+
+    Returns:
+        pd.DataFrame: Признаки в порядке artifacts["feature_order"].
+
+    Raises:
+        HTTPException: Если числовой признак содержит нечисловые значения (400).
+    """
+    medians = artifacts["medians"]
+    features = {}
+    for col in artifacts["feature_order"]:
+        if col in medians:
             try:
-                df[col] = encoders[col].transform(df[col].astype(str))
-            except ValueError as e:
-                update_prediction_result(db, db_prediction.id, [], "failed")
+                features[col] = df[col].astype("float64").fillna(medians[col]).to_numpy()
+            except (TypeError, ValueError) as e:
                 logger.error(f"Ошибка кодирования признака {col}: {str(e)}")
                 raise HTTPException(status_code=400, detail=f"Неверные данные в колонке {col}: {str(e)}")
+        else:
+            sorted_classes, codes = artifacts["lookups"][col]
+            values = df[col].astype(str).to_numpy(dtype=str)
+            features[col] = encode_categorical(values, sorted_classes, codes, artifacts["unknown_codes"][col])
+    return pd.DataFrame(features, columns=artifacts["feature_order"])
+
+def predict_dataframe(df: pd.DataFrame, artifacts: Dict[str, Any]) -> List[str]:
+    """
+    Выполняет предобработку признаков и предсказание для DataFrame.
+
+    Args:
+        df (pd.DataFrame): Входные данные со всеми столбцами из REQUIRED_COLUMNS.
+        artifacts (Dict[str, Any]): Артефакты модели из load_model_artifacts.
+
+    Returns:
+        List[str]: Предсказанные классы (e - edible или p - poisonous).
+
+    Raises:
+        HTTPException: Если признак не удалось закодировать (400).
+    """
+    with timed("preprocessing", artifacts.get("name", "unknown"), len(df)):
+        features = encode_features(df, artifacts)
+    return predict_features(features, artifacts)
+
+def predict_features(features: pd.DataFrame, artifacts: Dict[str, Any]) -> List[str]:
+    """
+    Выполняет предсказание по уже закодированным признакам.
+
+    Args:
+        features (pd.DataFrame): Признаки из encode_features.
+        artifacts (Dict[str, Any]): Артефакты модели из load_model_artifacts.
+
+    Returns:
+        List[str]: Предсказанные классы.
+    """
+    model_name = artifacts.get("name", "unknown")
+    rows = len(features)
+    with timed("predict", model_name, rows):
+        predictions = artifacts["model"].predict(features)
+    ROWS_TOTAL.labels(model=model_name).inc(rows)
+    return artifacts["class_labels"][np.asarray(predictions, dtype=np.intp)].tolist()
+
+def majority_vote(labels: Dict[str, List[str]]) -> List[str]:
+    """
+    Выбирает для каждой строки метку большинства моделей.
+
+    При равенстве голосов побеждает метка модели, указанной в ансамбле раньше.
+
+    Args:
+        labels (Dict[str, List[str]]): Метки каждой модели в порядке моделей ансамбля.
+
+    Returns:
+        List[str]: Итоговые метки.
+    """
+    votes = np.array(list(labels.values()))
+    # counts[i, j] - число моделей, согласных с моделью i в строке j; argmax берёт первую из равных
+    counts = np.stack([(votes == votes[i]).sum(axis=0) for i in range(len(votes))])
+    winners = counts.argmax(axis=0)
+    return votes[winners, np.arange(votes.shape[1])].tolist()
+
+def predict_ensemble(df: pd.DataFrame, artifacts_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Предсказывает несколькими моделями по одной матрице признаков и голосует большинством.
+
+    Признаки кодируются один раз на каждый набор таблиц предобработки (у моделей,
+    обученных вместе, он общий), затем модели предсказывают параллельно в пуле потоков:
+    деревья и BLAS отпускают GIL на время предсказания.
+
+    Args:
+        df (pd.DataFrame): Входные данные со всеми столбцами из REQUIRED_COLUMNS.
+        artifacts_list (List[Dict[str, Any]]): Артефакты моделей ансамбля по порядку.
+
+    Returns:
+        Dict[str, Any]: {"vote": итоговые метки, "models": {имя модели: метки}}.
+    """
+    features = {}
+    with timed("preprocessing", ENSEMBLE_METRIC_NAME, len(df)):
+        for artifacts in artifacts_list:
+            key = artifacts["preprocessing_key"]
+            if key not in features:
+                features[key] = encode_features(df, artifacts)
+
+    with ThreadPoolExecutor(max_workers=ENSEMBLE_MAX_THREADS or len(artifacts_list)) as executor:
+        futures = {
+            artifacts["name"]: executor.submit(predict_features, features[artifacts["preprocessing_key"]], artifacts)
+            for artifacts in artifacts_list
+        }
+        labels = {name: future.result() for name, future in futures.items()}
+    return {"vote": majority_vote(labels), "models": labels}
+
+def predict_cascade(df: pd.DataFrame, artifacts_list: List[Dict[str, Any]], threshold: float) -> Dict[str, Any]:
+    """
+    Предсказывает каскадом моделей: каждая следующая модель получает только строки,
+    в которых предыдущая не уверена.
+
+    Модель каждой ступени, кроме последней, считает predict_proba; строки с
+    максимальной вероятностью класса не ниже threshold получают её метку, остальные
+    передаются дальше. Последняя модель размечает все оставшиеся строки. Признаки
+    кодируются один раз на набор таблиц предобработки, дальше берутся нужные строки.
+
+    Args:
+        df (pd.DataFrame): Входные данные со всеми столбцами из REQUIRED_COLUMNS.
+        artifacts_list (List[Dict[str, Any]]): Артефакты моделей каскада по порядку ступеней.
+        threshold (float): Порог уверенности.
+
+    Returns:
+        Dict[str, Any]: {"labels": итоговые метки, "stages": номер ступени, давшей метку
+            строке, "seconds": {имя модели: время кодирования и предсказания}}.
+
+    Raises:
+        HTTPException: Если модель не последней ступени не умеет predict_proba (400).
+    """
+    labels = np.empty(len(df), dtype=object)
+    stages = np.zeros(len(df), dtype=np.int64)
+    remaining = np.arange(len(df))
+    features = {}
+    seconds = {}
+    for stage, artifacts in enumerate(artifacts_list):
+        model_name = artifacts.get("name", "unknown")
+        model = artifacts["model"]
+        last = stage == len(artifacts_list) - 1
+        if not last and not hasattr(model, "predict_proba"):
+            raise HTTPException(status_code=400, detail=f"Model {model_name} does not provide class probabilities")
+        started = time.perf_counter()
+        if len(remaining):
+            key = artifacts["preprocessing_key"]
+            if key not in features:
+                with timed("preprocessing", model_name, len(remaining)):
+                    features[key] = encode_features(df.iloc[remaining], artifacts).set_axis(remaining)
+            stage_features = features[key].loc[remaining]
+            with timed("predict", model_name, len(remaining)):
+                if last:
+                    codes = np.asarray(model.predict(stage_features), dtype=np.intp)
+                    confident = np.ones(len(remaining), dtype=bool)
+                else:
+                    proba = model.predict_proba(stage_features)
+                    codes = np.asarray(model.classes_, dtype=np.intp)[proba.argmax(axis=1)]
+                    confident = proba.max(axis=1) >= threshold
+            ROWS_TOTAL.labels(model=model_name).inc(len(remaining))
+            labels[remaining[confident]] = artifacts["class_labels"][codes[confident]]
+            stages[remaining[confident]] = stage
+            remaining = remaining[~confident]
+        seconds[model_name] = time.perf_counter() - started
+    return {"labels": labels.tolist(), "stages": stages.tolist(), "seconds": seconds}
+
+def cascade_report(result: Dict[str, Any], ensemble: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Считает по результату каскада долю эскалаций, стоимость и экономию времени.
+
+    Стоимость ступени - стоимость модели, умноженная на долю строк, дошедших до неё
+    (первая ступень обрабатывает все строки). Экономия времени оценивается относительно
+    прогона последней модели по всем строкам с её измеренной скоростью; если до неё не
+    дошла ни одна строка, оценки нет.
+
+    Args:
+        result (Dict[str, Any]): Результат predict_cascade для всех строк.
+        ensemble (Dict[str, Any]): Описание каскада (models, costs, cost - списанная сумма).
+
+    Returns:
+        Dict[str, Any]: {"rows", "escalation_rate", "credits", "billed", "refund",
+            "seconds", "baseline_seconds", "seconds_saved"}.
+    """
+    models = ensemble["models"]
+    stages = np.asarray(result["stages"])
+    total = max(len(stages), 1)
+    rows = {name: int((stages >= stage).sum()) for stage, name in enumerate(models)}
+    credits = {name: round(cost * rows[name] / total, 4) for name, cost in zip(models, ensemble["costs"])}
+    billed = round(sum(credits.values()), 4)
+    seconds = result["seconds"]
+    last = models[-1]
+    baseline = seconds[last] * total / rows[last] if rows[last] else None
+    return {
+        "rows": rows,
+        "escalation_rate": round(rows[models[1]] / total, 4),
+        "credits": credits,
+        "billed": billed,
+        "refund": round(max(ensemble["cost"] - billed, 0.0), 4),
+        "seconds": {name: round(value, 4) for name, value in seconds.items()},
+        "baseline_seconds": round(baseline, 4) if baseline is not None else None,
+        "seconds_saved": round(baseline - sum(seconds.values()), 4) if baseline is not None else None,
+    }
+
+def is_cascade(ensemble: Optional[Dict[str, Any]]) -> bool:
+    """Возвращает True, если задание - каскад моделей, а не голосование."""
+    return bool(ensemble) and ensemble.get("mode") == "cascade"
+
+def job_metric_name(ensemble: Optional[Dict[str, Any]], model_name: str) -> str:
+    """Имя задания в метриках: каскад, ансамбль или имя единственной модели."""
+    if not ensemble:
+        return model_name
+    return CASCADE_METRIC_NAME if is_cascade(ensemble) else ENSEMBLE_METRIC_NAME
+
+def concat_results(parts: List[Any]) -> Any:
+    """
+    Склеивает результаты чанков или шардов по порядку строк.
+
+    Списки склеиваются, словари - по ключам, числа (время ступеней каскада) складываются.
+
+    Args:
+        parts: Метки частей, результаты ансамбля ({"vote", "models"}) или каскада
+            ({"labels", "stages", "seconds"}).
+
+    Returns:
+        Результат того же вида для всех строк.
+    """
+    if parts and isinstance(parts[0], dict):
+        return {key: concat_results([part[key] for part in parts]) for key in parts[0]}
+    if parts and not isinstance(parts[0], list):
+        return sum(parts)
+    return [label for part in parts for label in part]
+
+def finalize_result(
+    result: Union[List[str], Dict[str, Any]], ensemble: Optional[Dict[str, Any]]
+) -> Tuple[List[str], Optional[Dict[str, Any]]]:
+    """
+    Разделяет склеенный результат на итоговые метки и описание ансамбля для записи в БД.
+
+    Args:
+        result: Результат concat_results для всех строк.
+        ensemble (Optional[Dict[str, Any]]): Описание ансамбля или каскада из записи предсказания.
+
+    Returns:
+        Tuple[List[str], Optional[Dict[str, Any]]]: Метки и описание ансамбля с метками
+            каждой модели (results) или отчётом каскада (None для одной модели).
+    """
+    if not ensemble:
+        return result, None
+    if is_cascade(ensemble):
+        return result["labels"], {**ensemble, **cascade_report(result, ensemble)}
+    return result["vote"], {**ensemble, "results": result["models"]}
+
+def build_warmup_frame(artifacts: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Строит одну синтетическую строку из известных значений признаков для прогревочного предсказания.
+
+    Args:
+        artifacts (Dict[str, Any]): Артефакты модели из load_model_artifacts.
+
+    Returns:
+        pd.DataFrame: DataFrame из одной строки со всеми столбцами REQUIRED_COLUMNS.
+    """
+    row = {}
+    for col in NUMERICAL_COLUMNS:
+        row[col] = artifacts["medians"][col]
+    for col in CATEGORICAL_COLUMNS:
+        row[col] = str(artifacts["categories"][col][0])
+    return pd.DataFrame([row], columns=REQUIRED_COLUMNS)
+
+def warm_up_models(db: Session) -> Dict[str, Dict[str, Any]]:
+    """
+    Загружает в кэш артефакты всех моделей из таблицы models и выполняет по одному
+    прогревочному предсказанию, чтобы холодный старт не попадал на пользователей.
+
+    Args:
+        db (Session): Сессия SQLAlchemy для взаимодействия с базой данных.
+
+    Модели без файла (ещё не обученные) не прогреваются и помечаются "skipped": предсказания
+    ими отклоняются до списания средств и на готовность воркера они не влияют.
+
+    Returns:
+        Dict[str, Dict[str, Any]]: Отчёт о готовности по каждой модели
+            ({"ready": bool, "skipped": bool, "seconds": float, "error": Optional[str]}).
+    """
+    report = {}
+    for db_model in db.query(DBModel).all():
+        started = time.perf_counter()
+        if not find_model_file(db_model.name):
+            logger.warning(f"Прогрев модели {db_model.name} пропущен: файл модели не найден")
+            report[db_model.name] = {
+                "ready": False, "skipped": True, "seconds": 0.0,
+                "error": f"Model file not found: {bundle_path(db_model.name)}"
+            }
+            continue
+        try:
+            artifacts = load_model_artifacts(db_model.name)
+            predict_dataframe(build_warmup_frame(artifacts), artifacts)
+            report[db_model.name] = {"ready": True, "skipped": False, "seconds": time.perf_counter() - started, "error": None}
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error(f"Прогрев модели {db_model.name} не удался: {detail}")
+            report[db_model.name] = {"ready": False, "skipped": False, "seconds": time.perf_counter() - started, "error": detail}
+    return report
+
+def get_prediction_models(db: Session, prediction: Prediction) -> List[DBModel]:
+    """
+    Возвращает модели предсказания: все модели ансамбля или одну модель.
 
-        # Выполнение предсказания
-        predictions = model.predict(df[REQUIRED_COLUMNS])
-        result = le_class.inverse_transform(predictions).tolist()
+    Raises:
+        HTTPException: Если модель не найдена (400).
+    """
+    ensemble = getattr(prediction, "ensemble", None)
+    db_models = []
+    for model_id in (ensemble["model_ids"] if ensemble else [prediction.model_id]):
+        db_model = get_model_by_id(db, model_id)
+        if not db_model:
+            logger.error(f"Модель не найдена: {model_id}")
+            raise HTTPException(status_code=400, detail="Invalid model ID")
+        db_models.append(db_model)
+    return db_models
+
+def score_frame(
+    df: pd.DataFrame, artifacts_list: List[Dict[str, Any]], ensemble: Optional[Dict[str, Any]]
+) -> Union[List[str], Dict[str, Any]]:
+    """Предсказывает одной моделью, ансамблем (см. predict_ensemble) или каскадом (см. predict_cascade)."""
+    if is_cascade(ensemble):
+        return predict_cascade(df, artifacts_list, ensemble.get("threshold", CASCADE_THRESHOLD))
+    if ensemble:
+        return predict_ensemble(df, artifacts_list)
+    return predict_dataframe(df, artifacts_list[0])
+
+def score_chunks(
+    db: Session,
+    prediction: Prediction,
+    artifacts_list: List[Dict[str, Any]],
+    start: int,
+    end: int,
+    chunk_size: int,
+    metric_name: str,
+    on_chunk: Optional[Callable[[int], None]] = None
+) -> List[Any]:
+    """
+    Предсказывает строки [start, end) по чанкам, сохраняя результат каждого чанка как
+    чекпоинт (prediction_chunks). Чанки, уже сохранённые прежней попыткой, не пересчитываются.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        prediction (Prediction): Предсказание (или запись DBPrediction) с входными данными.
+        artifacts_list (List[Dict[str, Any]]): Артефакты моделей предсказания.
+        start (int): Индекс первой строки диапазона.
+        end (int): Индекс строки после последней.
+        chunk_size (int): Количество строк в одном чанке.
+        metric_name (str): Имя модели в метриках.
+        on_chunk (Optional[Callable[[int], None]]): Вызывается после каждого нового чанка
+            с индексом строки после его последней строки.
+
+    Returns:
+        List[Any]: Результаты чанков по порядку (см. concat_results).
+    """
+    ensemble = getattr(prediction, "ensemble", None)
+    checkpoints = get_prediction_chunks(db, prediction.id)
+    parts = []
+    position = start
+    while position < end:
+        chunk = checkpoints.get(position)
+        if chunk is None:
+            chunk_end = min(position + chunk_size, end)
+            data = validate_input_data(load_prediction_frame(prediction, position, chunk_end))
+            labels = score_frame(data, artifacts_list, ensemble)
+            with timed("db_write", metric_name, chunk_end - position):
+                chunk = save_prediction_chunk(db, prediction.id, position, chunk_end, labels)
+            if on_chunk is not None:
+                on_chunk(chunk.end_row)
+        parts.append(chunk.result)
+        position = chunk.end_row
+    return parts
+
+def score_prediction_rows(
+    db: Session,
+    prediction: Prediction,
+    start: int = 0,
+    end: Optional[int] = None,
+    chunk_size: int = PREDICTION_CHUNK_SIZE,
+    on_chunk: Optional[Callable[[int], None]] = None
+) -> Union[List[str], Dict[str, Any]]:
+    """
+    Выполняет предсказание для диапазона строк входных данных без записи итогового результата в БД.
+
+    Используется шардами параллельного предсказания (services.tasks.predict_shard_task).
+    Строки обрабатываются чанками с чекпоинтами (score_chunks), поэтому шард, прерванный
+    мягким лимитом времени или ошибкой, продолжает с первого необработанного чанка.
+
+    Args:
+        db (Session): Сессия SQLAlchemy для взаимодействия с базой данных.
+        prediction (Prediction): Предсказание (или запись DBPrediction) с входными данными.
+        start (int): Индекс первой строки диапазона.
+        end (Optional[int]): Индекс строки после последней (по умолчанию до конца данных).
+        chunk_size (int): Количество строк в одном чанке.
+        on_chunk (Optional[Callable[[int], None]]): Вызывается после каждого нового чанка.
+
+    Returns:
+        Предсказанные классы для строк диапазона в исходном порядке; для ансамбля -
+        {"vote": метки голосования, "models": {имя модели: метки}}; для каскада -
+        результат predict_cascade.
+
+    Raises:
+        HTTPException: Если модель не найдена, файл модели отсутствует или данные некорректны.
+        SoftTimeLimitExceeded: Если задача упёрлась в мягкий лимит; готовые чанки уже сохранены.
+    """
+    db_models = get_prediction_models(db, prediction)
+    pinned = getattr(prediction, "model_versions", None) or {}
+    artifacts_list = [load_pinned_artifacts(m.name, pinned.get(m.name)) for m in db_models]
+    end = count_prediction_rows(prediction) if end is None else end
+    metric_name = job_metric_name(getattr(prediction, "ensemble", None), db_models[0].name)
+    return concat_results(score_chunks(db, prediction, artifacts_list, start, end, chunk_size, metric_name, on_chunk))
+
+def make_prediction(
+    db: Session,
+    prediction: Prediction,
+    chunk_size: int = PREDICTION_CHUNK_SIZE,
+    on_progress: Optional[Callable[[int, int], None]] = None
+) -> Prediction:
+    """
+    Выполняет предсказание с использованием обученной ML-модели и сохраняет результат в базе данных.
+
+    Строки обрабатываются чанками по chunk_size, результат каждого чанка сохраняется как
+    чекпоинт (prediction_chunks). Повторный запуск (retry или мягкий лимит времени)
+    продолжает с первого необработанного чанка. Для ансамбля каждый чанк кодируется
+    один раз и предсказывается всеми моделями; в result сохраняется голосование
+    большинства, метки каждой модели - в ensemble["results"]. Для каскада в ensemble
+    сохраняется отчёт cascade_report (доля эскалаций, стоимость, экономия времени).
+
+    Args:
+        db (Session): Сессия SQLAlchemy для взаимодействия с базой данных.
+        prediction (Prediction): Существующая запись предсказания с входными данными.
+        chunk_size (int): Количество строк в одном чанке.
+        on_progress (Optional[Callable[[int, int], None]]): Вызывается после каждого нового
+            чанка с количеством обработанных строк и общим количеством строк.
+
+    Returns:
+        Prediction: Обновлённый объект предсказания с результатами и статусом.
+
+    Raises:
+        HTTPException: Если модель не найдена, файл модели отсутствует или произошла ошибка предсказания.
+        SoftTimeLimitExceeded: Если задача упёрлась в мягкий лимит; готовые чанки уже сохранены.
+    """
+    try:
+        logger.info(f"Выполнение предсказания {prediction.id} для модели ID: {prediction.model_id}")
+
+        # Проверка моделей (одна модель или все модели ансамбля)
+        ensemble = getattr(prediction, "ensemble", None)
+        db_models = get_prediction_models(db, prediction)
+        metric_name = job_metric_name(ensemble, db_models[0].name)
+
+        # Загрузка закреплённых версий моделей и таблиц предобработки (из кэша процесса, если уже загружены)
+        pinned = getattr(prediction, "model_versions", None) or {}
+        artifacts_list = [load_pinned_artifacts(db_model.name, pinned.get(db_model.name)) for db_model in db_models]
+
+        # Предсказание по чанкам с чекпоинтами
+        checkpoints = get_prediction_chunks(db, prediction.id)
+        if checkpoints:
+            logger.info(f"Предсказание {prediction.id}: продолжаем с {len(checkpoints)} сохранёнными чанками")
+        total_rows = count_prediction_rows(prediction)
+        on_chunk = (lambda rows: on_progress(rows, total_rows)) if on_progress is not None else None
+        parts = score_chunks(db, prediction, artifacts_list, 0, total_rows, chunk_size, metric_name, on_chunk)
+        labels, ensemble = finalize_result(concat_results(parts), ensemble)
 
         # Обновление предсказания в БД
-        db_prediction = update_prediction_result(db, db_prediction.id, json.dumps(result), "completed")
+        db_prediction = update_prediction_result(db, prediction.id, labels, "completed", ensemble=ensemble)
+        delete_prediction_chunks(db, prediction.id)
 
         logger.info("Предсказание успешно завершено")
-        # Парсим result из строки JSON в список перед созданием объекта Prediction, чтобы избежать ошибки ValueError
-        parsed_result = json.loads(db_prediction.result) if db_prediction.result else None
         return Prediction(
             id=db_prediction.id,
             user_id=db_prediction.user_id,
             model_id=db_prediction.model_id,
             input_data=db_prediction.input_data,
-            result=parsed_result,
+            result=db_prediction.result,
             status=db_prediction.status,
+            ensemble=db_prediction.ensemble,
             created_at=db_prediction.created_at
         )
+    except SoftTimeLimitExceeded:
+        logger.warning(f"Предсказание {prediction.id} прервано мягким лимитом времени, чекпоинты сохранены")
+        raise
     except HTTPException as e:
+        update_prediction_result(db, prediction.id, [], "failed")
         logger.error(f"Предсказание завершилось ошибкой: {str(e)}")
         raise
     except ValueError as e:
-        update_prediction_result(db, db_prediction.id, json.dumps([]), "failed")
+        update_prediction_result(db, prediction.id, [], "failed")
         logger.error(f"Ошибка предсказания: Неверные данные: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Invalid data: {str(e)}")
     except Exception as e:
-        update_prediction_result(db, db_prediction.id, json.dumps([]), "failed")
+        update_prediction_result(db, prediction.id, [], "failed")
         logger.error(f"Неожиданная ошибка предсказания: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,92 @@
+import logging
+import os
+import uuid
+from typing import Optional
+import pandas as pd
+import pyarrow as pa
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Общая локальная папка, через которую API передаёт входные данные воркерам.
+# API и воркеры должны видеть её по одному и тому же пути.
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPOOL_DIR = os.getenv("PREDICTION_SPOOL_DIR", os.path.join(BASE_DIR, "spool"))
+
+def write_input_spool(df: pd.DataFrame) -> str:
+    """
+    Записывает входные данные предсказания в спул как файл Arrow IPC.
+
+    Файл сначала пишется во временный и затем атомарно переименовывается,
+    поэтому воркер никогда не увидит его частично записанным.
+
+    Args:
+        df (pd.DataFrame): Провалидированные и приведённые к типам входные данные.
+
+    Returns:
+        str: Путь к файлу в спуле.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    path = os.path.join(SPOOL_DIR, f"{uuid.uuid4().hex}.arrow")
+    tmp_path = f"{path}.tmp"
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    logger.info(f"Входные данные ({table.num_rows} строк) записаны в спул: {path}")
+    return path
+
+def read_input_spool(path: str, start: int = 0, end: Optional[int] = None) -> pd.DataFrame:
+    """
+    Читает диапазон строк из файла спула через memory map.
+
+    Файл не копируется в память процесса целиком: срез таблицы ссылается на
+    отображённые страницы, в DataFrame преобразуются только строки [start, end).
+
+    Args:
+        path (str): Путь к файлу в спуле.
+        start (int): Индекс первой строки диапазона.
+        end (Optional[int]): Индекс строки после последней (по умолчанию до конца).
+
+    Returns:
+        pd.DataFrame: Входные данные диапазона.
+
+    Raises:
+        FileNotFoundError: Если файл спула не найден.
+    """
+    with pa.memory_map(path, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+        end = table.num_rows if end is None else min(end, table.num_rows)
+        return table.slice(start, max(end - start, 0)).to_pandas()
+
+def spool_row_count(path: str) -> int:
+    """
+    Возвращает количество строк в файле спула, читая только метаданные батчей.
+
+    Args:
+        path (str): Путь к файлу в спуле.
+
+    Returns:
+        int: Количество строк.
+    """
+    with pa.memory_map(path, "r") as source:
+        reader = pa.ipc.open_file(source)
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+def delete_input_spool(path: Optional[str]) -> None:
+    """
+    Удаляет файл спула после завершения предсказания. Отсутствие файла не считается ошибкой.
+
+    Args:
+        path (Optional[str]): Путь к файлу в спуле.
+    """
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Не удалось удалить файл спула {path}: {e}")
@@ -1,10 +1,23 @@
-from celery import Celery
+import time
+from celery import Celery, chord
+from celery.exceptions import SoftTimeLimitExceeded
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
+from typing import Any, Dict, List, Optional, Union
 from db.db_prediction import DBPrediction
-from services.prediction_service import make_prediction
+from services.prediction_service import (
+    make_prediction, score_prediction_rows, count_prediction_rows, concat_results, finalize_result, is_cascade, job_metric_name,
+    pin_model_versions)
+from services.db_operations import (
+    get_model_by_id, get_user_by_id, credit_user, record_usage,
+    get_prediction_chunks, delete_prediction_chunks)
+from services.events import publish_prediction_event
+from services.spool import delete_input_spool
+from services.metrics import observe_stage, seconds_since, timed, PREDICTIONS_TOTAL, CASCADE_ESCALATION_RATE
+from services.autoscaler import record_job_size
 from database import SessionLocal
 from celery.utils.log import get_task_logger
-from celery_app import app
+from celery_app import app, select_queue, profile_rows_per_sec, combine_profiles, PREDICTION_SHARD_SIZE, PREDICTION_MAX_CONTINUATIONS, BULK_QUEUE, FAST_QUEUE
 
 # Явное логгирование:
 logger = get_task_logger(__name__)
@@ -17,14 +30,188 @@ def get_db():
     finally:
         db.close()
 
+def describe_job(db: Session, prediction: DBPrediction) -> Dict[str, Any]:
+    """
+    Описывает модели задания: имя для метрик, записи моделей, стоимость и профиль.
+
+    Для ансамбля и каскада стоимость суммарная (для каскада - списанная при запуске),
+    а профиль - как у последовательного прогона всех моделей по всем строкам (оценка
+    сверху: ансамбль предсказывает параллельно, каскад передаёт дальше часть строк).
+
+    Returns:
+        Dict[str, Any]: {"name", "models", "cost", "profile"}.
+    """
+    ensemble = prediction.ensemble
+    db_models = [m for m in (get_model_by_id(db, i) for i in (ensemble["model_ids"] if ensemble else [prediction.model_id])) if m]
+    if ensemble:
+        return {
+            "name": job_metric_name(ensemble, ""),
+            "models": db_models,
+            "cost": ensemble.get("cost", sum(m.cost for m in db_models)),
+            "profile": combine_profiles([m.profile for m in db_models]),
+        }
+    db_model = db_models[0] if db_models else None
+    return {
+        "name": db_model.name if db_model else "unknown",
+        "models": db_models,
+        "cost": db_model.cost if db_model else 1.0,
+        "profile": db_model.profile if db_model else None,
+    }
+
+def complete_prediction(
+    db: Session,
+    prediction: DBPrediction,
+    result: List[str],
+    status: str = "completed",
+    ensemble: Optional[Dict[str, Any]] = None
+):
+    """
+    Сохраняет результат предсказания вместе с агрегатами использования одним коммитом
+    и публикует событие. Агрегаты учитываются один раз (флаг usage_recorded).
+
+    Для каскада возвращает пользователю разницу между списанной суммой (все строки на
+    всех моделях) и стоимостью по фактической доле эскалаций.
+
+    Args:
+        db (Session): Сессия SQLAlchemy.
+        prediction (DBPrediction): Запись предсказания.
+        result (List[str]): Результат предсказания (для ансамбля - голосование большинства).
+        status (str): Итоговый статус ("completed" или "failed").
+        ensemble (Optional[Dict[str, Any]]): Описание ансамбля с метками моделей или отчётом каскада.
+    """
+    job = describe_job(db, prediction)
+    model_name = job["name"]
+    with timed("db_write", model_name, len(result)):
+        prediction.result = result
+        prediction.status = status
+        if ensemble is not None:
+            prediction.ensemble = ensemble
+        if status == "completed" and prediction.progress:
+            prediction.progress = {**prediction.progress, "rows_processed": len(result), "eta_seconds": 0}
+
+        # Агрегаты использования для GET /usage (ансамбль и каскад - по каждой модели, каскад -
+        # по строкам и кредитам, дошедшим до модели) пишутся тем же коммитом, что и статус,
+        # и ровно один раз: повтор задачи после ошибки коммита не учитывает их дважды
+        if status == "completed" and not prediction.usage_recorded:
+            report = prediction.ensemble or {}
+            rows_by_model = report.get("rows", {})
+            credits_by_model = report.get("credits", {})
+            for model_id, name, cost in ([(m.id, m.name, m.cost) for m in job["models"]] or [(prediction.model_id, None, 0.0)]):
+                record_usage(
+                    db,
+                    user_id=prediction.user_id,
+                    model_id=model_id,
+                    rows=rows_by_model.get(name, len(result)),
+                    credits=credits_by_model.get(name, cost),
+                    commit=False
+                )
+            prediction.usage_recorded = True
+        try:
+            db.commit()
+        except SQLAlchemyError:
+            db.rollback()
+            raise
+    PREDICTIONS_TOTAL.labels(model=model_name, status=status).inc()
+
+    if prediction.status == "completed":
+        observe_stage("end_to_end", seconds_since(prediction.created_at), model_name, len(result))
+        if is_cascade(prediction.ensemble):
+            refund_cascade(db, prediction)
+
+    # Входные данные больше не нужны
+    delete_input_spool(prediction.input_path)
+
+    logger.info(f"Предсказание {prediction.id} завершено со статусом={prediction.status}")
+    publish_prediction_event(prediction.user_id, prediction.id, prediction.status)
+
+def refund_cascade(db: Session, prediction: DBPrediction):
+    """
+    Возвращает неиспользованную часть оплаты каскада (ensemble["refund"]) одной транзакцией БД.
+
+    Новый баланс, запись о транзакции и отметка refunded сохраняются одним коммитом,
+    поэтому возврат выполняется ровно один раз: при ошибке коммита не сохраняется
+    ничего и возврат можно повторить.
+    """
+    report = prediction.ensemble
+    if report.get("refunded") or "refund" not in report:
+        return
+    prediction.ensemble = {**report, "refunded": True}
+    if report["refund"] > 0 and get_user_by_id(db, prediction.user_id):
+        credit_user(
+            db,
+            user_id=prediction.user_id,
+            amount=report["refund"],
+            description=f"Cascade refund for prediction {prediction.id}",
+            prediction_id=prediction.id
+        )
+    else:
+        db.commit()
+    CASCADE_ESCALATION_RATE.observe(report["escalation_rate"])
+    logger.info(
+        f"Каскад {prediction.id}: эскалация {report['escalation_rate']:.1%}, списано {report['billed']}, "
+        f"возврат {report['refund']}, экономия {report['seconds_saved']} с"
+    )
+
+def build_progress(
+    rows_processed: int,
+    rows_total: int,
+    started_at: float,
+    rows_at_start: int = 0,
+    expected_rows_per_sec: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Формирует запись о ходе выполнения предсказания.
+
+    Пока скорость не измерена (не готов ни один чанк), ETA считается по скорости
+    из профиля модели.
+
+    Args:
+        rows_processed (int): Количество обработанных строк.
+        rows_total (int): Общее количество строк.
+        started_at (float): Время начала обработки (Unix time).
+        rows_at_start (int): Строки, обработанные до started_at (например, взятые из чекпоинтов).
+        expected_rows_per_sec (Optional[float]): Скорость модели из профиля.
+
+    Returns:
+        Dict[str, Any]: rows_processed, rows_total, rows_per_sec, eta_seconds, started_at.
+    """
+    elapsed = time.time() - started_at
+    rate = (rows_processed - rows_at_start) / elapsed if elapsed > 0 else 0.0
+    remaining = rows_total - rows_processed
+    eta_rate = rate if rate > 0 else (expected_rows_per_sec or 0.0)
+    return {
+        "rows_processed": rows_processed,
+        "rows_total": rows_total,
+        "rows_per_sec": round(rate, 1),
+        "eta_seconds": round(remaining / eta_rate, 1) if eta_rate > 0 else None,
+        "started_at": started_at,
+    }
+
+def save_progress(db: Session, prediction: DBPrediction, progress: Dict[str, Any]):
+    """Сохраняет ход выполнения в записи предсказания и публикует событие "running"."""
+    prediction.progress = progress
+    db.commit()
+    publish_prediction_event(prediction.user_id, prediction.id, "running", progress=progress)
+
 # Задача для выполнения предсказания:
 @app.task(bind=True, max_retries=3, retry_backoff=True)
-def predict_task(self, prediction_id: int):
+def predict_task(self, prediction_id: int, shard_size: int = PREDICTION_SHARD_SIZE, continuation: int = 0):
     """
     Асинхронная задача для выполнения предсказания ML-моделью.
 
+    Если строк больше shard_size, задание делится на шарды по диапазонам строк,
+    которые параллельно обрабатываются задачами predict_shard_task (Celery chord),
+    а результат собирается по порядку задачей merge_shards_task.
+
+    После каждого чанка ход выполнения (строки, скорость, ETA) сохраняется в записи
+    предсказания и в состоянии задачи (PROGRESS). При мягком лимите времени готовые
+    чанки уже сохранены, и оставшаяся часть продолжается новой задачей
+    (до PREDICTION_MAX_CONTINUATIONS раз), если текущая попытка продвинулась вперёд.
+
     Args:
         prediction_id (int): ID записи предсказания в таблице Predictions.
+        shard_size (int): Максимальное количество строк в одном шарде.
+        continuation (int): Номер продолжения после мягкого лимита времени.
 
     Returns:
         dict: Результат предсказания и статус.
@@ -37,29 +224,186 @@ def predict_task(self, prediction_id: int):
     if not isinstance(prediction_id, int) or prediction_id <= 0:
         logger.error(f"Invalid prediction_id: {prediction_id}")
         return {"status": "failed", "result": None, "error": "Invalid prediction ID"}
-    
+
     db = next(get_db())
+    user_id = None
+    rows_done: Optional[int] = None
     try:
         # Получаем запись предсказания:
         prediction = db.query(DBPrediction).filter(DBPrediction.id == prediction_id).first()
         if not prediction:
             logger.error(f"Предсказание {prediction_id} не найдено")
             return {"status": "failed", "result": None, "error": "Prediction not found"}
-        
-        # Выполняем предсказание:
-        updated_prediction = make_prediction(db, prediction)
-        
+        user_id = prediction.user_id
+        publish_prediction_event(user_id, prediction_id, "running")
+
+        # Большое задание - раскладываем на шарды:
+        total_rows = count_prediction_rows(prediction)
+        record_job_size(total_rows)
+        job = describe_job(db, prediction)
+        expected_rate = profile_rows_per_sec(job["profile"], total_rows)
+        if continuation == 0 and self.request.retries == 0:
+            observe_stage("queue_wait", seconds_since(prediction.created_at), job["name"], total_rows)
+
+        # Версии моделей закрепляются при первом запуске: шарды, повторы и продолжения
+        # считаются ими, даже если процессы пула тем временем подменят модели
+        if prediction.model_versions is None:
+            prediction.model_versions = pin_model_versions([m.name for m in job["models"]])
+            db.commit()
+        if shard_size > 0 and total_rows > shard_size:
+            save_progress(db, prediction, build_progress(0, total_rows, time.time(), expected_rows_per_sec=expected_rate))
+            shards = [
+                predict_shard_task.s(prediction_id, start, min(start + shard_size, total_rows)).set(queue=BULK_QUEUE)
+                for start in range(0, total_rows, shard_size)
+            ]
+            callback = merge_shards_task.s(prediction_id).set(queue=FAST_QUEUE)
+            callback.link_error(mark_prediction_failed.s(prediction_id=prediction_id).set(queue=FAST_QUEUE))
+            chord(shards)(callback)
+            logger.info(f"Предсказание {prediction_id}: {total_rows} строк разбиты на {len(shards)} шардов")
+            return {"status": "sharded", "shards": len(shards)}
+
+        # Выполняем предсказание, сообщая о ходе выполнения после каждого чанка:
+        started_at = time.time()
+        rows_at_start = sum(c.end_row - c.start_row for c in get_prediction_chunks(db, prediction_id).values())
+
+        def report_progress(rows_processed: int, rows_total: int):
+            nonlocal rows_done
+            rows_done = rows_processed
+            progress = build_progress(rows_processed, rows_total, started_at, rows_at_start, expected_rate)
+            save_progress(db, prediction, progress)
+            try:
+                self.update_state(state="PROGRESS", meta=progress)
+            except Exception as e:
+                logger.warning(f"Не удалось обновить состояние задачи {self.request.id}: {e}")
+
+        updated_prediction = make_prediction(db, prediction, on_progress=report_progress)
+
         # Обновляем статус и результат:
-        prediction.result = updated_prediction.result
-        prediction.status = updated_prediction.status
-        db.commit()
-        
-        logger.info(f"Предсказание {prediction_id} завершено со статусом={prediction.status}")
+        complete_prediction(db, prediction, updated_prediction.result, updated_prediction.status)
         return {"status": prediction.status, "result": prediction.result}
-    
+
+    except SoftTimeLimitExceeded:
+        # Готовые чанки сохранены - оставшаяся часть продолжается новой задачей с чекпоинта.
+        # Если за попытку не готов ни один чанк, продолжение ничего не даст.
+        db.rollback()
+        if rows_done is None or continuation >= PREDICTION_MAX_CONTINUATIONS:
+            logger.error(f"Prediction {prediction_id} hit the soft time limit without progress or too many times")
+            complete_prediction(db, prediction, [], "failed")
+            delete_prediction_chunks(db, prediction_id)
+            return {"status": "failed", "result": None, "error": "Time limit exceeded"}
+        job = describe_job(db, prediction)
+        queue = select_queue(prediction.progress["rows_total"], job["cost"], job["profile"])
+        predict_task.apply_async(
+            args=[prediction_id],
+            kwargs={"shard_size": shard_size, "continuation": continuation + 1},
+            queue=queue
+        )
+        logger.warning(f"Prediction {prediction_id} hit the soft time limit after {rows_done} rows, continuing in queue {queue}")
+        return {"status": "continued", "rows_processed": rows_done}
+
     except Exception as exc:
         logger.error(f"Error in prediction {prediction_id}: {str(exc)}")
+        if self.request.retries >= self.max_retries and user_id is not None:
+            # Попытки исчерпаны - фиксируем неуспех, чтобы клиенты не ждали вечно
+            db.rollback()
+            prediction.status = "failed"
+            db.commit()
+            delete_prediction_chunks(db, prediction_id)
+            delete_input_spool(prediction.input_path)
+            publish_prediction_event(user_id, prediction_id, "failed")
         raise self.retry(exc=exc)  # Повторяем задачу при ошибке
-    
+
     finally:
-        db.close()  # Закрываем сессию
\ No newline at end of file
+        db.close()  # Закрываем сессию
+
+@app.task(bind=True, max_retries=3, retry_backoff=True)
+def predict_shard_task(self, prediction_id: int, start: int, end: int) -> Union[List[str], Dict[str, Any]]:
+    """
+    Выполняет предсказание для шарда [start, end) строк. Повторяется независимо от других шардов.
+
+    Строки шарда обрабатываются чанками, результат каждого чанка сохраняется как чекпоинт,
+    поэтому повтор после ошибки или мягкого лимита времени продолжает с первого
+    необработанного чанка. После мягкого лимита шард перезапускается сразу (до
+    PREDICTION_MAX_CONTINUATIONS раз сверх max_retries), если попытка продвинулась вперёд.
+
+    Args:
+        prediction_id (int): ID записи предсказания.
+        start (int): Индекс первой строки шарда.
+        end (int): Индекс строки после последней.
+
+    Returns:
+        Предсказанные классы для строк шарда (для ансамбля - {"vote", "models"}).
+    """
+    logger.info(f"Шард [{start}, {end}) предсказания {prediction_id}, попытка {self.request.retries + 1}")
+    db = next(get_db())
+    rows_done: Optional[int] = None
+    try:
+        prediction = db.query(DBPrediction).filter(DBPrediction.id == prediction_id).first()
+        if not prediction:
+            raise ValueError(f"Prediction {prediction_id} not found")
+        total_rows = count_prediction_rows(prediction)
+        started_at = (prediction.progress or {}).get("started_at") or time.time()
+
+        def report_progress(rows_end: int):
+            # Ход выполнения всего задания - по всем готовым чанкам всех шардов
+            nonlocal rows_done
+            rows_done = rows_end
+            rows_processed = sum(c.end_row - c.start_row for c in get_prediction_chunks(db, prediction_id).values())
+            save_progress(db, prediction, build_progress(rows_processed, total_rows, started_at))
+
+        return score_prediction_rows(db, prediction, start, end, on_chunk=report_progress)
+
+    except SoftTimeLimitExceeded as exc:
+        # Готовые чанки сохранены - шард продолжается с чекпоинта. Если за попытку
+        # не готов ни один чанк, перезапуск ничего не даст
+        db.rollback()
+        if rows_done is None:
+            logger.error(f"Shard [{start}, {end}) of prediction {prediction_id} hit the soft time limit without progress")
+            raise
+        logger.warning(f"Shard [{start}, {end}) of prediction {prediction_id} hit the soft time limit at row {rows_done}, continuing")
+        raise self.retry(exc=exc, countdown=0, max_retries=self.max_retries + PREDICTION_MAX_CONTINUATIONS)
+
+    except Exception as exc:
+        logger.error(f"Error in shard [{start}, {end}) of prediction {prediction_id}: {str(exc)}")
+        db.rollback()
+        raise self.retry(exc=exc)
+
+    finally:
+        db.close()
+
+@app.task
+def merge_shards_task(shard_results: List[Union[List[str], Dict[str, Any]]], prediction_id: int) -> dict:
+    """
+    Собирает результаты шардов в исходном порядке строк и завершает предсказание.
+
+    Args:
+        shard_results: Результаты шардов в порядке их диапазонов.
+        prediction_id (int): ID записи предсказания.
+
+    Returns:
+        dict: Статус и количество строк в результате.
+    """
+    db = next(get_db())
+    try:
+        prediction = db.query(DBPrediction).filter(DBPrediction.id == prediction_id).first()
+        if not prediction:
+            logger.error(f"Предсказание {prediction_id} не найдено")
+            return {"status": "failed", "result": None, "error": "Prediction not found"}
+        labels, ensemble = finalize_result(concat_results(shard_results), prediction.ensemble)
+        complete_prediction(db, prediction, labels, ensemble=ensemble)
+        delete_prediction_chunks(db, prediction_id)
+        return {"status": prediction.status, "rows": len(labels)}
+    finally:
+        db.close()
+
+@app.task
+def mark_prediction_failed(*args, prediction_id: int):
+    """Помечает предсказание как неуспешное и удаляет чекпоинты, если шард исчерпал попытки (errback chord)."""
+    db = next(get_db())
+    try:
+        prediction = db.query(DBPrediction).filter(DBPrediction.id == prediction_id).first()
+        if prediction and prediction.status != "completed":
+            complete_prediction(db, prediction, [], "failed")
+        delete_prediction_chunks(db, prediction_id)
+    finally:
+        db.close()
@@ -12,7 +12,9 @@ from telegram.ext import (
 )
 import httpx
 from typing import Dict
+import asyncio
 import io
+import json
 
 # Логирование
 logging.basicConfig(
@@ -32,6 +34,12 @@ BOT_TOKEN = "7915019188:AAGDDX6Pi0MOhGmc6Q_5Dq0l_P3IuOrR9r0"
 # Токенохранилище
 user_tokens: Dict[int, str] = {}  # {telegram_id: jwt_token}
 
+# Подписки на поток событий предсказаний (GET /predictions/events)
+event_listeners: Dict[int, asyncio.Task] = {}  # {telegram_id: задача-слушатель}
+pending_predictions: Dict[int, Dict[int, int]] = {}  # {telegram_id: {prediction_id: chat_id}}
+EVENT_STREAM_MAX_RECONNECTS = 5  # Переподключений к потоку событий до перехода на опрос
+EVENT_STREAM_RECONNECT_DELAY = 1.0  # Начальная задержка переподключения, секунды (удваивается)
+
 # Состояния для ConversationHandler
 REGISTER_USERNAME, REGISTER_PASSWORD, LOGIN_USERNAME, LOGIN_PASSWORD, PREDICT_MODEL_ID, PREDICT_FILE, PAYMENT = range(7)
 
@@ -48,6 +56,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/predict — сделать предсказание\n"
         "/balance — проверить баланс\n"
         "/transactions — история транзакций\n"
+        "/usage — расходы по моделям за текущий месяц\n"
         "/payment — пополнить баланс"
     )
 
@@ -187,20 +196,9 @@ async def predict_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard = [[InlineKeyboardButton("Проверить статус", callback_data=f"status_{prediction_id}")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
 
-            # Проверяем наличие JobQueue
-            if context.job_queue is not None:
-                context.job_queue.run_repeating(
-                    check_prediction_status,
-                    interval=10,
-                    first=10,
-                    data={"prediction_id": prediction_id, "user_id": update.effective_user.id},
-                    chat_id=update.effective_chat.id,
-                    user_id=update.effective_user.id
-                )
-                message += "Я уведомлю вас, когда предсказание будет готово, или нажмите кнопку ниже."
-            else:
-                logger.warning("JobQueue is not available, skipping status check")
-                message += "Пожалуйста, проверьте статус с помощью кнопки ниже или команды /status."
+            # Подписываемся на события о завершении вместо периодического опроса
+            watch_prediction(context, update.effective_user.id, update.effective_chat.id, prediction_id)
+            message += "Я уведомлю вас, когда предсказание будет готово, или нажмите кнопку ниже."
 
             await update.message.reply_text(message, reply_markup=reply_markup)
 
@@ -218,8 +216,107 @@ async def predict_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     return ConversationHandler.END
 
+def watch_prediction(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int, prediction_id: int):
+    """Добавляет предсказание в ожидание и запускает слушатель событий пользователя, если он ещё не запущен."""
+    pending_predictions.setdefault(user_id, {})[prediction_id] = chat_id
+    listener = event_listeners.get(user_id)
+    if listener is None or listener.done():
+        event_listeners[user_id] = context.application.create_task(
+            listen_prediction_events(context, user_id)
+        )
+
+async def notify_if_finished(context: ContextTypes.DEFAULT_TYPE, client: httpx.AsyncClient, token: str, user_id: int, prediction_id: int):
+    """Запрашивает предсказание и, если оно завершено, отправляет результат пользователю."""
+    response = await client.get(
+        f"{API_BASE_URL}/predictions/{prediction_id}",
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    response.raise_for_status()
+    prediction = response.json()
+    if prediction["status"] not in ["completed", "failed"]:
+        return
+    chat_id = pending_predictions.get(user_id, {}).pop(prediction_id, None)
+    if chat_id is None:
+        return
+    result = prediction.get("result", "Ошибка: результат отсутствует")
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=(
+            f"Предсказание {prediction_id} завершено!\n"
+            f"Статус: {prediction['status']}\n"
+            f"Результат: {result}"
+        )
+    )
+
+async def listen_prediction_events(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """
+    Слушает поток Server-Sent Events GET /predictions/events и уведомляет пользователя
+    о завершённых предсказаниях. Завершается, когда ожидающих предсказаний не осталось.
+    Если поток оборвался или был закрыт сервером, а предсказания ещё ожидают, переподключается
+    с экспоненциальной задержкой; после EVENT_STREAM_MAX_RECONNECTS попыток переключается
+    на периодический опрос статуса.
+    """
+    token = user_tokens.get(user_id)
+    if not token:
+        logger.warning(f"No token found for user {user_id}, skipping event subscription")
+        pending_predictions.pop(user_id, None)
+        return
+    reconnects = 0
+    try:
+        while pending_predictions.get(user_id):
+            try:
+                await stream_prediction_events(context, token, user_id)
+                if not pending_predictions.get(user_id):
+                    return
+                logger.warning(f"Prediction event stream for user {user_id} closed by server with pending predictions")
+            except Exception as e:
+                logger.error(f"Prediction event stream for user {user_id} failed: {str(e)}")
+            reconnects += 1
+            if reconnects > EVENT_STREAM_MAX_RECONNECTS:
+                logger.error(f"Prediction event stream for user {user_id} is unavailable, falling back to polling")
+                fall_back_to_polling(context, user_id)
+                return
+            await asyncio.sleep(EVENT_STREAM_RECONNECT_DELAY * 2 ** (reconnects - 1))
+    finally:
+        event_listeners.pop(user_id, None)
+
+async def stream_prediction_events(context: ContextTypes.DEFAULT_TYPE, token: str, user_id: int):
+    """Читает поток событий до его закрытия или до уведомления обо всех ожидающих предсказаниях."""
+    async with httpx.AsyncClient(timeout=httpx.Timeout(10.0, read=None)) as client:
+        async with client.stream(
+            "GET",
+            f"{API_BASE_URL}/predictions/events",
+            headers={"Authorization": f"Bearer {token}"}
+        ) as stream:
+            stream.raise_for_status()
+            async for line in stream.aiter_lines():
+                if line.startswith(": connected"):
+                    # Догружаем статусы, изменившиеся до подписки (или между переподключениями)
+                    for prediction_id in list(pending_predictions.get(user_id, {})):
+                        await notify_if_finished(context, client, token, user_id, prediction_id)
+                elif line.startswith("data:"):
+                    event = json.loads(line[len("data:"):])
+                    if event["status"] in ["completed", "failed"] and event["prediction_id"] in pending_predictions.get(user_id, {}):
+                        await notify_if_finished(context, client, token, user_id, event["prediction_id"])
+                if not pending_predictions.get(user_id):
+                    break
+
+def fall_back_to_polling(context: ContextTypes.DEFAULT_TYPE, user_id: int):
+    """Переводит ожидающие предсказания пользователя на периодический опрос статуса."""
+    for prediction_id, chat_id in pending_predictions.pop(user_id, {}).items():
+        if context.job_queue is None:
+            continue
+        context.job_queue.run_repeating(
+            check_prediction_status,
+            interval=10,
+            first=10,
+            data={"prediction_id": prediction_id, "user_id": user_id},
+            chat_id=chat_id,
+            user_id=user_id
+        )
+
 async def check_prediction_status(context: ContextTypes.DEFAULT_TYPE):
-    """Периодически проверяет статус предсказания."""
+    """Периодически проверяет статус предсказания (резервный путь, если поток событий недоступен)."""
     job = context.job
     prediction_id = job.data["prediction_id"]
     user_id = job.data["user_id"]
@@ -261,6 +358,16 @@ async def check_prediction_status(context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Unexpected error in status check for prediction {prediction_id}: {str(e)}")
 
+def format_progress(prediction: dict) -> str:
+    """Строка с ходом выполнения незавершённого предсказания (пустая, если данных нет)."""
+    progress = prediction.get("progress")
+    if prediction["status"] != "pending" or not progress:
+        return ""
+    text = f"Прогресс: {progress['rows_processed']}/{progress['rows_total']} строк"
+    if progress.get("eta_seconds") is not None:
+        text += f", осталось ~{int(progress['eta_seconds'])} с"
+    return text + "\n"
+
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /status: проверяет статус предсказания."""
     if update.effective_user.id not in user_tokens:
@@ -280,6 +387,7 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(
                 f"Статус предсказания {prediction_id}:\n"
                 f"Статус: {prediction['status']}\n"
+                f"{format_progress(prediction)}"
                 f"Результат: {result}"
             )
     except (IndexError, ValueError):
@@ -329,6 +437,35 @@ async def transactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except httpx.HTTPStatusError as e:
             await update.message.reply_text(f"Ошибка: {response.json().get('detail', 'Попробуйте снова')}")
 
+async def usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /usage: показывает расходы по моделям за текущий месяц."""
+    if update.effective_user.id not in user_tokens:
+        await update.message.reply_text("Пожалуйста, войдите с помощью /login.")
+        return
+    token = user_tokens[update.effective_user.id]
+    async with httpx.AsyncClient() as client:
+        try:
+            response = await client.get(
+                f"{API_BASE_URL}/usage",
+                headers={"Authorization": f"Bearer {token}"}
+            )
+            response.raise_for_status()
+            report = response.json()
+            if not report["by_model"]:
+                await update.message.reply_text("В этом месяце предсказаний пока нет.")
+                return
+            message = f"Использование с {report['start']} по {report['end']}:\n"
+            for model_id, stats in report["by_model"].items():
+                message += (
+                    f"Модель {model_id}: предсказаний {stats['predictions_count']}, "
+                    f"строк {stats['rows_scored']}, потрачено {stats['credits_spent']} токенов\n"
+                )
+            total = report["total"]
+            message += f"Итого: {total['predictions_count']} предсказаний, {total['credits_spent']} токенов"
+            await update.message.reply_text(message)
+        except httpx.HTTPStatusError as e:
+            await update.message.reply_text(f"Ошибка: {response.json().get('detail', 'Попробуйте снова')}")
+
 async def payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /payment: запрашивает сумму для пополнения."""
     if update.effective_user.id not in user_tokens:
@@ -408,6 +545,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.reply_text(
                     f"Статус предсказания {prediction_id}:\n"
                     f"Статус: {prediction['status']}\n"
+                    f"{format_progress(prediction)}"
                     f"Результат: {result}"
                 )
         except httpx.HTTPStatusError as e:
@@ -488,6 +626,7 @@ def main():
         application.add_handler(CommandHandler("status", status))
         application.add_handler(CommandHandler("balance", balance))
         application.add_handler(CommandHandler("transactions", transactions))
+        application.add_handler(CommandHandler("usage", usage))
         application.add_handler(CallbackQueryHandler(button_callback))
 
         # Запуск бота
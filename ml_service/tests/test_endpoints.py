@@ -1,8 +1,12 @@
 import pytest
 import sys
 import os
+import json
+import time
+import numpy as np
 import pandas as pd
 import io
+import zipfile
 from unittest.mock import patch, MagicMock
 from sqlalchemy.sql import text
 from sqlalchemy import inspect
@@ -13,7 +17,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from fastapi.testclient import TestClient
 from main import app
 from services.auth import create_access_token
-from services.db_operations import create_user, update_user_balance
+from services.db_operations import create_user, update_user_balance, record_usage
 from db.db_user import DBUser
 from db.db_model import DBModel
 from db.db_prediction import DBPrediction
@@ -28,7 +32,8 @@ from models.model import Model
 from models.prediction import Prediction
 
 from celery.result import AsyncResult
-from celery_app import app as celery_app
+from celery_app import app as celery_app, select_queue
+from services.autoscaler import compute_scaling
 
 # Фикстура для SQLite в памяти
 @pytest.fixture(scope="function")
@@ -62,6 +67,12 @@ def test_db():
     session.close()
     Base.metadata.drop_all(bind=engine) # Очистка базы после каждого теста
 
+# Спул входных данных предсказаний - во временной папке теста
+@pytest.fixture(autouse=True)
+def spool_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr("services.spool.SPOOL_DIR", str(tmp_path / "spool"))
+    return tmp_path / "spool"
+
 # Фикстура для клиента FastAPI
 @pytest.fixture
 def client(test_db):
@@ -85,6 +96,27 @@ def registered_user(client, test_db):
     token = token_response.json()["access_token"]
     return {"username": "testuser", "token": token}
 
+# Синтетические данные для тестов обучения: бандлы пишутся во временную папку теста
+@pytest.fixture
+def training_data(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    from sklearn.datasets import make_classification
+    import train_models
+    monkeypatch.setattr(train_models, "BUNDLE_DIR", str(tmp_path))
+
+    def frame(n_samples):
+        X, y = make_classification(n_samples, len(train_models.FEATURE_COLUMNS), random_state=0)
+        return pd.DataFrame(X, columns=train_models.FEATURE_COLUMNS), y
+
+    def preprocessing(median=0.0, values=("a",)):
+        return {
+            "medians": {col: median for col in train_models.NUMERICAL_COLUMNS},
+            "categories": {col: np.array([*values, "unknown"]) for col in train_models.CATEGORICAL_COLUMNS},
+            "class_labels": np.array(["e", "p"]),
+        }
+
+    return SimpleNamespace(frame=frame, preprocessing=preprocessing)
+
 # Тест для проверки создания таблиц
 def test_tables_created(test_db):
     # Проверяем, что таблица 'users' существует
@@ -139,12 +171,20 @@ def test_token_expired(client, test_db):
 
 
 def test_get_models(client, test_db, registered_user):
+    from services.db_operations import update_model_profile
     test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
     test_db.commit()
     response = client.get("/models", headers={"Authorization": f"Bearer {registered_user['token']}"})
     assert response.status_code == 200
     assert len(response.json()) >= 1
     assert response.json()[0]["name"] == "RandomForest"
+    assert response.json()[0]["profile"] is None
+
+    profile = {"rows_per_sec": {"1": 900.0, "10000": 150000.0}, "load_seconds": 0.4, "memory_mb": 180.0}
+    assert update_model_profile(test_db, "RandomForest", profile) is not None
+    assert update_model_profile(test_db, "Missing", profile) is None
+    response = client.get("/models", headers={"Authorization": f"Bearer {registered_user['token']}"})
+    assert response.json()[0]["profile"] == profile
 
 def test_get_models_invalid_token(client):
     response = client.get("/models", headers={"Authorization": "Bearer invalid_token"})
@@ -284,6 +324,130 @@ def test_predict_xlsx(client, test_db, registered_user, tmp_path):
     assert response.json()["status"] == "completed"
     assert response.json()["result"] == ["p"]
 
+def test_read_xlsx_streaming(tmp_path):
+    import openpyxl
+    from fastapi import HTTPException
+    from services import prediction_service
+    csv_path = os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")
+    data = pd.read_csv(csv_path)
+    expected = prediction_service.coerce_input_data(data)
+
+    # Лишний столбец, другой порядок столбцов, пустая строка и второй лист не влияют на результат;
+    # строка, где заполнен только лишний столбец, остаётся строкой из пропусков
+    columns = ["id"] + list(reversed(data.columns))
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(columns)
+    for i, row in enumerate(data.assign(id=range(len(data)))[columns].itertuples(index=False)):
+        if i == 1:
+            sheet.append([])
+        sheet.append([None if pd.isna(value) else value for value in row])
+    sheet.append([99])
+    workbook.create_sheet("other").append(["cap-diameter", 1.0])
+    xlsx_path = tmp_path / "test_data.xlsx"
+    workbook.save(xlsx_path)
+
+    frame = prediction_service.read_input_file(xlsx_path.read_bytes(), "xlsx")
+    assert list(frame.columns) == prediction_service.REQUIRED_COLUMNS
+    padded = prediction_service.coerce_input_data(pd.concat([data, pd.DataFrame({"id": [99]})], ignore_index=True))
+    pd.testing.assert_frame_equal(prediction_service.coerce_input_data(frame), padded)
+    # Книга в формате Excel: общие строки (в т.ч. форматированный текст), bool, ячейки без ссылки r
+    with zipfile.ZipFile(xlsx_path) as archive:
+        parts = {name: archive.read(name) for name in archive.namelist()}
+    header = "".join(f'<c t="s"><v>{i}</v></c>' for i in range(len(prediction_service.REQUIRED_COLUMNS)))
+    row = "".join(
+        '<c t="b"><v>1</v></c>' if col in ("does-bruise-or-bleed", "has-ring")
+        else '<c><v></v></c>' if col == "stem-height"
+        else '<c><v>2.5</v></c>' if col in prediction_service.NUMERICAL_COLUMNS
+        else f'<c t="s"><v>{len(prediction_service.REQUIRED_COLUMNS)}</v></c>'
+        for col in prediction_service.REQUIRED_COLUMNS
+    )
+    strings = "".join(f"<si><t>{col}</t></si>" for col in prediction_service.REQUIRED_COLUMNS)
+    ns = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    # Дата ISO 8601 (t="d"), строка формулы (t="str") и ошибка (t="e") остаются строками
+    typed_row = "".join(
+        '<c t="d"><v>2024-01-31T00:00:00</v></c>' if col == "cap-shape"
+        else '<c t="str"><v>white</v></c>' if col == "gill-color"
+        else '<c t="e"><v>#N/A</v></c>' if col == "stem-width"
+        else '<c></c>'
+        for col in prediction_service.REQUIRED_COLUMNS
+    )
+    parts["xl/worksheets/sheet1.xml"] = (
+        f'<worksheet {ns}><sheetData><row>{header}</row><row>{row}</row><row>{typed_row}</row></sheetData></worksheet>'
+    ).encode()
+    parts["xl/sharedStrings.xml"] = f'<sst {ns}>{strings}<si><r><t>fla</t></r><r><t>t</t></r></si></sst>'.encode()
+    with zipfile.ZipFile(xlsx_path, "w") as archive:
+        for name, content in parts.items():
+            archive.writestr(name, content)
+    frame = prediction_service.read_input_file(xlsx_path.read_bytes(), "xlsx")
+    assert frame["cap-shape"].tolist() == ["flat", "2024-01-31T00:00:00"]
+    assert frame["gill-color"].tolist()[1] == "white"
+    assert frame["has-ring"].tolist()[0] is True
+    assert frame["stem-width"].tolist() == [2.5, "#N/A"]
+    assert frame["stem-height"].isna().all()
+    with pytest.raises(HTTPException) as error:
+        prediction_service.coerce_input_data(frame)
+    assert error.value.status_code == 400 and "stem-width" in error.value.detail
+
+    # Файл без пустых строк читается так же, как прежним pd.read_excel
+    data.assign(id=range(len(data))).to_excel(xlsx_path, index=False)
+    for engine in ["stream", "pandas"]:
+        with patch.object(prediction_service, "XLSX_ENGINE", engine):
+            frame = prediction_service.read_input_file(xlsx_path.read_bytes(), "xlsx")
+        pd.testing.assert_frame_equal(prediction_service.coerce_input_data(frame), expected)
+
+def test_read_xlsx_calamine_matches_stream(tmp_path):
+    pytest.importorskip("python_calamine")
+    from services import prediction_service
+    data = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv"))
+    data = pd.concat([data.assign(id=range(len(data))), pd.DataFrame({"id": [99]})], ignore_index=True)
+    data["stem-height"] = [6, 4.5, 5, None]  # целые и дробные числа в одном столбце
+    xlsx_path = tmp_path / "test_data.xlsx"
+    data.to_excel(xlsx_path, index=False)
+    frames = {}
+    for engine in ["stream", "calamine"]:
+        with patch.object(prediction_service, "XLSX_ENGINE", engine):
+            frames[engine] = prediction_service.read_input_file(xlsx_path.read_bytes(), "xlsx")
+    assert list(frames["calamine"].columns) == prediction_service.REQUIRED_COLUMNS
+    pd.testing.assert_frame_equal(
+        prediction_service.coerce_input_data(frames["calamine"]), prediction_service.coerce_input_data(frames["stream"])
+    )
+
+def test_predict_parquet_and_arrow(client, test_db, registered_user, tmp_path):
+    import pyarrow as pa
+    from services import prediction_service
+    from services.spool import read_input_spool
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.commit()
+    csv_path = os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")
+    expected = prediction_service.coerce_input_data(pd.read_csv(csv_path))
+    data = pd.read_csv(csv_path).assign(id=[1, 2, 3])  # лишний столбец не читается
+    data["cap-color"] = data["cap-color"].astype("category")  # словарный столбец Arrow
+
+    data.to_parquet(tmp_path / "test_data.parquet", index=False)
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    with pa.ipc.new_file(str(tmp_path / "test_data.arrow"), table.schema) as writer:
+        writer.write_table(table)
+    with pa.ipc.new_stream(str(tmp_path / "test_data.ipc"), table.schema) as writer:
+        writer.write_table(table)
+    for name in ["test_data.parquet", "test_data.arrow", "test_data.ipc"]:
+        frame = prediction_service.read_input_file((tmp_path / name).read_bytes(), name.split(".")[-1])
+        assert list(frame.columns) == prediction_service.REQUIRED_COLUMNS
+        pd.testing.assert_frame_equal(prediction_service.coerce_input_data(frame), expected)
+
+    mock_task = MagicMock()
+    mock_task.id = "mock_task_id"
+    with patch("main.celery_app.send_task", return_value=mock_task):
+        with open(tmp_path / "test_data.parquet", "rb") as f:
+            response = client.post(
+                "/predict?model_id=1",
+                headers={"Authorization": f"Bearer {registered_user['token']}"},
+                files={"file": ("test_data.parquet", f, "application/octet-stream")}
+            )
+    assert response.status_code == 200
+    prediction = test_db.query(DBPrediction).filter(DBPrediction.id == response.json()["id"]).first()
+    pd.testing.assert_frame_equal(read_input_spool(prediction.input_path), expected)
+
 def test_predict_invalid_file_type(client, test_db, registered_user, tmp_path):
     test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
     test_db.commit()
@@ -298,7 +462,7 @@ def test_predict_invalid_file_type(client, test_db, registered_user, tmp_path):
         )
     
     assert response.status_code == 400
-    assert response.json()["detail"] == "Unsupported file format: txt. Use CSV or XLSX."
+    assert response.json()["detail"] == "Unsupported file format: txt. Use CSV, XLSX, Parquet or Arrow."
 
 def test_predict_missing_columns(client, test_db, registered_user, tmp_path):
     test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
@@ -462,3 +626,1088 @@ def test_get_balance(client, registered_user):
     )
     assert response.status_code == 200
     assert "balance" in response.json()
+
+def test_get_usage(client, test_db, registered_user):
+    user = test_db.query(DBUser).filter(DBUser.username == "testuser").first()
+    record_usage(test_db, user_id=user.id, model_id=1, rows=3, credits=1.0)
+    record_usage(test_db, user_id=user.id, model_id=1, rows=2, credits=1.0)
+    record_usage(test_db, user_id=user.id, model_id=3, rows=10, credits=3.0)
+    response = client.get("/usage", headers={"Authorization": f"Bearer {registered_user['token']}"})
+    assert response.status_code == 200
+    report = response.json()
+    assert report["total"] == {"predictions_count": 3, "rows_scored": 15, "credits_spent": 5.0}
+    assert report["by_model"]["1"] == {"predictions_count": 2, "rows_scored": 5, "credits_spent": 2.0}
+    assert len(report["days"]) == 2
+
+def test_complete_prediction_records_usage_once(test_db):
+    from sqlalchemy.exc import OperationalError
+    from db.db_usage import DBUsage
+    from services import tasks
+    test_db.add_all([
+        DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"),
+        DBModel(id=3, name="NeuralNetwork", cost=3.0, file_path="ml_models/trained_ml_models/NeuralNetwork.pkl"),
+    ])
+    prediction = DBPrediction(user_id=1, model_id=1, input_data=[], status="running",
+                              ensemble={"model_ids": [1, 3], "models": ["RandomForest", "NeuralNetwork"], "cost": 4.0})
+    test_db.add(prediction)
+    test_db.commit()
+
+    def failing_commit():
+        raise OperationalError("UPDATE predictions", {}, Exception("database is locked"))
+
+    with patch("services.tasks.publish_prediction_event"):
+        # Ошибка коммита: не сохраняется ни статус, ни агрегаты
+        with patch.object(test_db, "commit", side_effect=failing_commit), pytest.raises(OperationalError):
+            tasks.complete_prediction(test_db, prediction, ["e", "p"])
+        assert test_db.query(DBUsage).count() == 0
+        assert test_db.query(DBPrediction).first().status == "running"
+
+        # Повтор и повторная доставка учитывают предсказание один раз
+        tasks.complete_prediction(test_db, prediction, ["e", "p"])
+        tasks.complete_prediction(test_db, prediction, ["e", "p"])
+    usage = {u.model_id: (u.predictions_count, u.rows_scored, u.credits_spent) for u in test_db.query(DBUsage).all()}
+    assert usage == {1: (1, 2, 1.0), 3: (1, 2, 3.0)}
+    assert test_db.query(DBPrediction).first().usage_recorded is True
+
+def test_get_usage_invalid_period(client, registered_user):
+    response = client.get(
+        "/usage?start=2025-02-01&end=2025-01-01",
+        headers={"Authorization": f"Bearer {registered_user['token']}"}
+    )
+    assert response.status_code == 400
+
+def test_select_queue():
+    assert select_queue(1, 3.0) == "fast"
+    assert select_queue(10_000, 1.0) == "bulk"
+    assert select_queue(1_000_000, 2.0) == "heavy"
+
+def test_select_queue_uses_model_profile():
+    from services.tasks import build_progress
+    profile = {"rows_per_sec": {"1": 1000.0, "100": 50000.0, "10000": 100000.0}}
+    assert select_queue(10, 3.0, profile) == "fast"
+    # 1M строк со скоростью 100000 строк/с - 10 с, а не "heavy" по строкам × стоимость
+    assert select_queue(1_000_000, 1.0, profile) == "bulk"
+    assert select_queue(10_000_000, 1.0, profile) == "heavy"
+    assert select_queue(1_000_000, 1.0, {"rows_per_sec": {}}) == "heavy"
+
+    # Пока не готов ни один чанк, ETA считается по скорости из профиля
+    progress = build_progress(0, 1000, time.time(), expected_rows_per_sec=100.0)
+    assert progress["rows_per_sec"] == 0 and progress["eta_seconds"] == 10.0
+    assert build_progress(0, 1000, time.time())["eta_seconds"] is None
+
+def test_compute_scaling():
+    # Мелкие задания и очередь: максимальный prefetch и рост пула
+    assert compute_scaling([10] * 50, 2, 40, [300.0] * 2, 300.0, 1, 8) == (8, 4)
+    # Крупные задания при превышении бюджета памяти: prefetch 1 и сокращение пула
+    assert compute_scaling([200_000] * 50, 4, 10, [1900.0] * 4, 1900.0, 1, 8, max_rss_mb=4096) == (2, 1)
+    # Пустая очередь: пул уменьшается по одному процессу за шаг
+    assert compute_scaling([10] * 50, 0, 0, [300.0] * 6, 300.0, 1, 8, current=6) == (5, 4)
+
+def test_adaptive_autoscaler_scales_through_celery_interface(monkeypatch):
+    # Настоящий базовый класс Celery (версия закреплена в requirements.txt) с подставным пулом
+    from services import autoscaler
+    pool = MagicMock(num_processes=1, info={"processes": []})
+    pool.grow.side_effect = lambda n: setattr(pool, "num_processes", pool.num_processes + n)
+    pool.shrink.side_effect = lambda n: setattr(pool, "num_processes", pool.num_processes - n)
+    scaler = autoscaler.AdaptiveAutoscaler(pool, 4, 1, keepalive=30)
+    clock = [1000.0]
+    monkeypatch.setattr("celery.worker.autoscale.monotonic", lambda: clock[0])
+    monkeypatch.setattr(autoscaler, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(autoscaler, "ADAPTIVE_INTERVAL", 0)
+    monkeypatch.setattr(scaler, "_queue_depth", lambda: 0)
+    monkeypatch.setattr(scaler, "_recent_sizes", lambda: [])
+    targets = iter([3, 1, 1])
+    monkeypatch.setattr(autoscaler, "compute_scaling", lambda *args, **kwargs: (next(targets), 4))
+
+    scaler.maybe_scale()
+    assert pool.num_processes == 3
+    pool.maintain_pool.assert_called()
+    # Уменьшение ждёт keepalive с последнего увеличения
+    clock[0] += 10
+    scaler.maybe_scale()
+    assert pool.num_processes == 3
+    clock[0] += 30
+    scaler.maybe_scale()
+    assert pool.num_processes == 1
+
+def test_upgrade_schema_migrates_baseline_database(tmp_path):
+    from database import upgrade_schema
+    from services.db_operations import create_prediction
+    engine = create_engine(f"sqlite:///{tmp_path / 'baseline.db'}")
+    # Схема базы, созданной до спула, хода выполнения, ансамблей и профилей моделей
+    with engine.begin() as conn:
+        for ddl in [
+            "CREATE TABLE models (id INTEGER NOT NULL, name VARCHAR NOT NULL, cost FLOAT NOT NULL, "
+            "file_path VARCHAR NOT NULL, PRIMARY KEY (id), UNIQUE (name))",
+            "CREATE TABLE predictions (id INTEGER NOT NULL, user_id INTEGER NOT NULL, model_id INTEGER NOT NULL, "
+            "input_data JSON NOT NULL, result JSON, status VARCHAR, created_at DATETIME, PRIMARY KEY (id))",
+            "CREATE INDEX ix_predictions_id ON predictions (id)",
+            "CREATE TABLE transactions (id INTEGER NOT NULL, user_id INTEGER NOT NULL, amount FLOAT NOT NULL, "
+            "description VARCHAR NOT NULL, created_at DATETIME, prediction_id INTEGER, PRIMARY KEY (id), "
+            "FOREIGN KEY(prediction_id) REFERENCES predictions (id))",
+        ]:
+            conn.execute(text(ddl))
+        conn.execute(text("INSERT INTO predictions (id, user_id, model_id, input_data, result, status) "
+                          "VALUES (1, 1, 1, '[{\"a\": 1}]', '[\"e\"]', 'completed')"))
+        conn.execute(text("INSERT INTO transactions (user_id, amount, description, prediction_id) VALUES (1, -1.0, 'x', 1)"))
+
+    Base.metadata.create_all(bind=engine)
+    changes = upgrade_schema(engine)
+    assert upgrade_schema(engine) == []
+
+    inspector = inspect(engine)
+    columns = {c["name"]: c for c in inspector.get_columns("predictions")}
+    assert columns["input_data"]["nullable"] is True
+    assert {"input_path", "progress", "ensemble", "model_versions"} <= set(columns)
+    assert "profile" in {c["name"] for c in inspector.get_columns("models")}
+    assert [i["name"] for i in inspector.get_indexes("predictions")] == ["ix_predictions_id"]
+    assert inspector.get_foreign_keys("transactions")[0]["referred_table"] == "predictions"
+    assert any(change.startswith("predictions: пересоздана") for change in changes)
+
+    # Старые записи сохранены, новые создаются без input_data
+    session = sessionmaker(bind=engine)()
+    try:
+        old = session.query(DBPrediction).filter(DBPrediction.id == 1).one()
+        assert old.input_data == [{"a": 1}] and old.result == ["e"] and old.status == "completed"
+        new = create_prediction(session, user_id=1, model_id=1, input_path="/tmp/spool.arrow")
+        assert new.id == 2 and new.input_data is None
+    finally:
+        session.close()
+
+def test_predict_routes_small_job_to_fast_queue(client, test_db, registered_user, tmp_path):
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.commit()
+    csv_file = tmp_path / "test_data.csv"
+    csv_file.write_text(open(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).read())
+
+    mock_task = MagicMock()
+    mock_task.id = "mock_task_id"
+
+    with patch("main.celery_app.send_task", return_value=mock_task) as mock_send_task:
+        with open(csv_file, "rb") as f:
+            response = client.post(
+                "/predict?model_id=1",
+                headers={"Authorization": f"Bearer {registered_user['token']}"},
+                files={"file": ("test_data.csv", f, "text/csv")}
+            )
+
+    assert response.status_code == 200
+    assert mock_send_task.call_args.kwargs["queue"] == "fast"
+
+def test_predict_passes_input_through_spool(client, test_db, registered_user, tmp_path):
+    from services.spool import read_input_spool
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.commit()
+    csv_file = tmp_path / "test_data.csv"
+    csv_file.write_text(open(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).read())
+
+    mock_task = MagicMock()
+    mock_task.id = "mock_task_id"
+    with patch("main.celery_app.send_task", return_value=mock_task):
+        with open(csv_file, "rb") as f:
+            response = client.post(
+                "/predict?model_id=1",
+                headers={"Authorization": f"Bearer {registered_user['token']}"},
+                files={"file": ("test_data.csv", f, "text/csv")}
+            )
+
+    assert response.status_code == 200
+    prediction = test_db.query(DBPrediction).filter(DBPrediction.id == response.json()["id"]).first()
+    assert prediction.input_data is None
+    assert os.path.exists(prediction.input_path)
+    rows = read_input_spool(prediction.input_path, 1, 3)
+    assert len(rows) == 2
+    assert rows["cap-diameter"].dtype == "float64"
+    assert rows["cap-surface"].tolist() == ["smooth", "nan"]
+
+def test_predict_cleans_up_when_queueing_fails(client, test_db, registered_user):
+    from services.spool import write_input_spool
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.commit()
+    balance = test_db.query(DBUser).filter(DBUser.username == "testuser").first().balance
+    spool_files = []
+    with patch("main.celery_app.send_task", side_effect=ConnectionError("broker is down")), \
+         patch("main.write_input_spool", side_effect=lambda df: spool_files.append(write_input_spool(df)) or spool_files[-1]):
+        with open(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv"), "rb") as f:
+            response = client.post(
+                "/predict?model_id=1",
+                headers={"Authorization": f"Bearer {registered_user['token']}"},
+                files={"file": ("test_data.csv", f, "text/csv")}
+            )
+
+    # Задача не поставлена: спул удалён, предсказание помечено failed, оплата возвращена
+    assert response.status_code == 500
+    prediction = test_db.query(DBPrediction).one()
+    test_db.refresh(prediction)
+    assert prediction.status == "failed"
+    assert prediction.input_path == spool_files[0] and not os.path.exists(spool_files[0])
+    assert test_db.query(DBUser).filter(DBUser.username == "testuser").first().balance == balance
+    refunds = test_db.query(DBTransaction).filter(DBTransaction.amount > 0).all()
+    assert [(t.amount, t.prediction_id) for t in refunds] == [(1.0, prediction.id)]
+
+def test_predict_does_not_charge_when_transaction_fails(client, test_db, registered_user):
+    from sqlalchemy.exc import OperationalError
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.commit()
+    balance = test_db.query(DBUser).filter(DBUser.username == "testuser").first().balance
+    commit = test_db.commit
+
+    def failing_commit():
+        if any(isinstance(obj, DBTransaction) for obj in test_db.new):
+            raise OperationalError("INSERT INTO transactions", {}, Exception("disk I/O error"))
+        commit()
+
+    with patch.object(test_db, "commit", side_effect=failing_commit), \
+         patch("main.celery_app.send_task") as mock_send_task:
+        with open(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv"), "rb") as f, \
+                pytest.raises(OperationalError):
+            client.post(
+                "/predict?model_id=1",
+                headers={"Authorization": f"Bearer {registered_user['token']}"},
+                files={"file": ("test_data.csv", f, "text/csv")}
+            )
+
+    # Баланс и транзакция сохраняются одним коммитом: при ошибке не списано ничего
+    mock_send_task.assert_not_called()
+    test_db.expire_all()
+    assert test_db.query(DBUser).filter(DBUser.username == "testuser").first().balance == balance
+    assert test_db.query(DBTransaction).count() == 0
+    prediction = test_db.query(DBPrediction).one()
+    assert prediction.status == "failed" and not os.path.exists(prediction.input_path)
+
+def test_warm_up_models_reports_unavailable_model(test_db):
+    from services.prediction_service import warm_up_models
+    test_db.add(DBModel(id=1, name="MissingModel", cost=1.0, file_path="ml_models/trained_ml_models/MissingModel.pkl"))
+    test_db.commit()
+    report = warm_up_models(test_db)
+    assert report["MissingModel"]["ready"] is False
+    assert report["MissingModel"]["skipped"] is True
+    assert report["MissingModel"]["error"].startswith("Model file not found")
+
+def test_warm_up_worker_exports_metrics():
+    from prometheus_client import REGISTRY
+    import celery_app as celery_module
+    report = {
+        "RandomForest": {"ready": True, "skipped": False, "seconds": 0.25, "error": None},
+        "Broken": {"ready": False, "skipped": False, "seconds": 0.5, "error": "boom"},
+    }
+    with patch("services.prediction_service.warm_up_models", return_value=report), \
+         patch("celery_app.WORKER_WARMUP", True), patch("celery_app.redis.from_url"), \
+         patch("database.SessionLocal"):
+        celery_module.warm_up_worker(sender="worker-a")
+
+    assert REGISTRY.get_sample_value("ml_service_worker_warmup_seconds", {"worker": "worker-a"}) > 0
+    assert REGISTRY.get_sample_value("ml_service_worker_ready", {"worker": "worker-a"}) == 0
+    assert REGISTRY.get_sample_value("ml_service_model_warmup_seconds", {"worker": "worker-a", "model": "RandomForest"}) == 0.25
+    assert REGISTRY.get_sample_value("ml_service_model_ready", {"worker": "worker-a", "model": "RandomForest"}) == 1
+    assert REGISTRY.get_sample_value("ml_service_model_ready", {"worker": "worker-a", "model": "Broken"}) == 0
+
+def test_model_without_file_is_not_charged(client, test_db, registered_user):
+    import init_models
+    test_db.add(DBModel(id=4, name="HistGradientBoosting", cost=1.5, file_path="ml_models/bundles/HistGradientBoosting.joblib"))
+    test_db.commit()
+    with patch("services.prediction_service.bundle_path", side_effect=lambda name, directory=None: f"/nonexistent/{name}.joblib"):
+        with open(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv"), "rb") as f:
+            response = client.post(
+                "/predict?model_id=4",
+                headers={"Authorization": f"Bearer {registered_user['token']}"},
+                files={"file": ("data.csv", f, "text/csv")}
+            )
+    assert response.status_code == 500
+    assert test_db.query(DBTransaction).count() == 0
+
+    # Модели, которые есть только бандлом, регистрируются после обучения
+    session = MagicMock()
+    session.get.return_value = None
+    with patch("init_models.SessionLocal", return_value=session), \
+         patch("init_models.find_model_file", side_effect=lambda name: None if name == "RandomForestLite" else "model.pkl"):
+        init_models.init_models()
+    assert [m.name for m in session.add_all.call_args.args[0]] == [
+        "RandomForest", "GradientBoosting", "NeuralNetwork", "HistGradientBoosting"
+    ]
+
+def test_publish_prediction_event():
+    from services import events
+    mock_redis = MagicMock()
+    with patch("services.events._get_redis_client", return_value=mock_redis):
+        events.publish_prediction_event(7, 42, "completed")
+    channel, payload = mock_redis.publish.call_args.args
+    assert channel == "ml_service:predictions:7"
+    assert json.loads(payload) == {"prediction_id": 42, "status": "completed"}
+    assert events.format_sse({"prediction_id": 42, "status": "completed"}) == (
+        'event: prediction\ndata: {"prediction_id": 42, "status": "completed"}\n\n'
+    )
+
+def test_prediction_events_invalid_token(client):
+    response = client.get("/predictions/events", headers={"Authorization": "Bearer invalid_token"})
+    assert response.status_code == 401
+
+def test_predict_task_splits_large_job_into_shards(test_db):
+    from services import tasks
+    rows = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).to_dict(orient="records") * 4
+    prediction = DBPrediction(user_id=1, model_id=1, input_data=rows, status="pending")
+    test_db.add(prediction)
+    test_db.commit()
+    with patch("services.tasks.get_db", return_value=iter([test_db])), \
+         patch("services.tasks.publish_prediction_event"), \
+         patch("services.tasks.chord") as mock_chord:
+        result = tasks.predict_task.apply(args=[prediction.id], kwargs={"shard_size": 5}).get()
+    assert result == {"status": "sharded", "shards": 3}
+    shards = mock_chord.call_args.args[0]
+    assert [tuple(s.args[1:]) for s in shards] == [(0, 5), (5, 10), (10, 12)]
+
+def test_make_prediction_resumes_from_checkpoint(test_db):
+    from services.prediction_service import make_prediction
+    from services.db_operations import save_prediction_chunk
+    from db.db_prediction_chunk import DBPredictionChunk
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    rows = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).to_dict(orient="records") * 2
+    prediction = DBPrediction(user_id=1, model_id=1, input_data=rows, status="pending")
+    test_db.add(prediction)
+    test_db.commit()
+    # Первые 4 строки уже обработаны предыдущей попыткой
+    save_prediction_chunk(test_db, prediction.id, 0, 4, ["p", "p", "p", "p"])
+
+    with patch("services.prediction_service.load_pinned_artifacts", return_value={}), \
+         patch("services.prediction_service.predict_dataframe", side_effect=lambda df, a: ["e"] * len(df)) as mock_predict:
+        result = make_prediction(test_db, prediction, chunk_size=4)
+
+    assert mock_predict.call_count == 1
+    assert len(mock_predict.call_args.args[0]) == 2
+    assert result.status == "completed"
+    assert result.result == ["p", "p", "p", "p", "e", "e"]
+    assert test_db.query(DBPredictionChunk).count() == 0
+    assert test_db.query(DBPrediction).count() == 1
+
+def test_predict_task_reports_progress(test_db):
+    from services import tasks
+    from services.prediction_service import make_prediction
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    rows = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).to_dict(orient="records") * 2
+    prediction = DBPrediction(user_id=1, model_id=1, input_data=rows, status="pending")
+    test_db.add(prediction)
+    test_db.commit()
+
+    with patch("services.tasks.get_db", return_value=iter([test_db])), \
+         patch("services.tasks.publish_prediction_event") as mock_publish, \
+         patch.object(tasks.predict_task, "update_state") as mock_update_state, \
+         patch("services.tasks.make_prediction", side_effect=lambda db, p, on_progress: make_prediction(db, p, chunk_size=2, on_progress=on_progress)), \
+         patch("services.prediction_service.load_pinned_artifacts", return_value={}), \
+         patch("services.prediction_service.predict_dataframe", side_effect=lambda df, a: ["e"] * len(df)):
+        result = tasks.predict_task.apply(args=[prediction.id]).get()
+
+    assert result["status"] == "completed"
+    assert [c.kwargs["meta"]["rows_processed"] for c in mock_update_state.call_args_list] == [2, 4, 6]
+    assert all(c.kwargs["state"] == "PROGRESS" for c in mock_update_state.call_args_list)
+    assert [c.kwargs["progress"]["rows_processed"] for c in mock_publish.call_args_list if "progress" in c.kwargs] == [2, 4, 6]
+    prediction = test_db.query(DBPrediction).first()
+    assert prediction.progress["rows_total"] == 6
+    assert prediction.progress["eta_seconds"] == 0
+    # Версия модели закреплена при запуске задачи
+    from services.prediction_service import model_fingerprint
+    assert prediction.model_versions == {"RandomForest": model_fingerprint("RandomForest")}
+
+def test_predict_task_continues_after_soft_time_limit(test_db):
+    from celery.exceptions import SoftTimeLimitExceeded
+    from services import tasks
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    rows = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).to_dict(orient="records") * 2
+    prediction = DBPrediction(user_id=1, model_id=1, input_data=rows, status="pending")
+    test_db.add(prediction)
+    test_db.commit()
+
+    def interrupted(db, p, on_progress):
+        on_progress(2, 6)
+        raise SoftTimeLimitExceeded()
+
+    with patch("services.tasks.get_db", return_value=iter([test_db])), \
+         patch("services.tasks.publish_prediction_event"), \
+         patch.object(tasks.predict_task, "update_state"), \
+         patch.object(tasks.predict_task, "apply_async") as mock_apply_async, \
+         patch("services.tasks.make_prediction", side_effect=interrupted):
+        result = tasks.predict_task.apply(args=[prediction.id]).get()
+
+    assert result == {"status": "continued", "rows_processed": 2}
+    assert mock_apply_async.call_args.kwargs["kwargs"]["continuation"] == 1
+    assert mock_apply_async.call_args.kwargs["queue"] == "fast"
+    assert test_db.query(DBPrediction).first().status == "pending"
+
+def test_predict_shard_task_resumes_from_chunk_after_soft_time_limit(test_db):
+    from celery.exceptions import SoftTimeLimitExceeded
+    from db.db_prediction_chunk import DBPredictionChunk
+    from services import tasks
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    rows = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).to_dict(orient="records") * 2
+    prediction = DBPrediction(user_id=1, model_id=1, input_data=rows, status="running")
+    test_db.add(prediction)
+    test_db.commit()
+    prediction_id = prediction.id
+
+    calls = []
+
+    def predict(df, artifacts):
+        calls.append(len(df))
+        if len(calls) == 2:
+            raise SoftTimeLimitExceeded()
+        return ["e"] * len(df)
+
+    score = tasks.score_prediction_rows
+    with patch("services.tasks.get_db", side_effect=lambda: iter([test_db])), \
+         patch("services.tasks.publish_prediction_event"), \
+         patch("services.tasks.score_prediction_rows",
+               side_effect=lambda db, p, start, end, on_chunk: score(db, p, start, end, chunk_size=2, on_chunk=on_chunk)), \
+         patch("services.prediction_service.load_pinned_artifacts", return_value={}), \
+         patch("services.prediction_service.predict_dataframe", side_effect=predict):
+        result = tasks.predict_shard_task.apply(args=[prediction_id, 0, 6]).get()
+
+        # Повтор после мягкого лимита продолжает со второго чанка, первый не пересчитывается
+        assert result == ["e"] * 6
+        assert calls == [2, 2, 2, 2]
+        assert [(c.start_row, c.end_row) for c in test_db.query(DBPredictionChunk).order_by(DBPredictionChunk.start_row)] == [(0, 2), (2, 4), (4, 6)]
+        assert test_db.query(DBPrediction).first().progress["rows_processed"] == 6
+
+        # Шард исчерпал попытки: errback помечает предсказание failed и удаляет чекпоинты
+        tasks.mark_prediction_failed.apply(kwargs={"prediction_id": prediction_id})
+    assert test_db.query(DBPrediction).first().status == "failed"
+    assert test_db.query(DBPredictionChunk).count() == 0
+
+def test_metrics_endpoint_reports_api_stages(client, test_db, registered_user, tmp_path):
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.commit()
+    csv_file = tmp_path / "test_data.csv"
+    csv_file.write_text(open(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).read())
+
+    mock_task = MagicMock()
+    mock_task.id = "mock_task_id"
+    with patch("main.celery_app.send_task", return_value=mock_task):
+        with open(csv_file, "rb") as f:
+            client.post(
+                "/predict?model_id=1",
+                headers={"Authorization": f"Bearer {registered_user['token']}"},
+                files={"file": ("test_data.csv", f, "text/csv")}
+            )
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    for stage in ["parse", "validation", "db_write"]:
+        assert f'ml_service_stage_seconds_count{{model="RandomForest",size="<=100",stage="{stage}"}}' in response.text
+
+def test_train_models_parallel(tmp_path, training_data):
+    import train_models
+    from services.model_bundle import read_bundle_info, load_bundle, bundle_path
+    X, y = training_data.frame(200)
+    preprocessing = training_data.preprocessing()
+    assert train_models.default_n_jobs(cpu_count=16) == {
+        "RandomForest": 7, "GradientBoosting": 1, "NeuralNetwork": 1, "HistGradientBoosting": 7
+    }
+    n_jobs = train_models.default_n_jobs(cpu_count=6)
+    assert n_jobs == {"RandomForest": 2, "GradientBoosting": 1, "NeuralNetwork": 1, "HistGradientBoosting": 2}
+    models = train_models.build_models(n_jobs)
+    models[0][0].set_params(n_estimators=10)
+    models[1][0].set_params(n_estimators=5)
+    models[2][0].set_params(max_iter=20)
+    models[3][0].set_params(max_iter=10, categorical_features=None)
+    wide = {**preprocessing["categories"], "cap-shape": np.arange(300).astype(str)}
+    mask = dict(zip(train_models.FEATURE_COLUMNS, train_models.categorical_mask(wide)))
+    assert mask["cap-color"] and not mask["cap-shape"] and not mask["cap-diameter"]
+
+    results = train_models.train_models_parallel(models, X[:150], y[:150], X[150:], y[150:], n_jobs, preprocessing)
+
+    assert set(results) == {"RandomForest", "GradientBoosting", "NeuralNetwork", "HistGradientBoosting"}
+    assert all(r["fit_seconds"] > 0 and 0 <= r["f1"] <= 1 for r in results.values())
+    assert results["RandomForest"]["n_jobs"] == 2
+    for name, result in results.items():
+        assert (tmp_path / f"{name}.joblib").exists()
+        info = read_bundle_info(name, str(tmp_path))
+        assert info["version"] == 1 and info["content_hash"] == result["content_hash"]
+        assert info["metadata"]["train_rows"] == 150
+    assert load_bundle(bundle_path("RandomForest", str(tmp_path)))["model"].n_jobs == 1
+
+def test_load_data_uses_compact_dtypes(tmp_path):
+    import train_models
+    df = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv"))
+    df.insert(0, "id", range(len(df)))
+    df["class"] = ["e", "p", "p"]
+    df["stem-root"] = None
+    csv_path = tmp_path / "train.csv"
+    df.to_csv(csv_path, index=False)
+
+    X, y, preprocessing = train_models.load_data(str(csv_path), chunksize=2)
+
+    assert list(X.columns) == train_models.FEATURE_COLUMNS
+    assert X["cap-diameter"].dtype == "float32"
+    assert X["cap-diameter"].tolist() == pytest.approx([5.0, 3.2, 4.1])  # NaN заполнен медианой
+    assert y.tolist() == [0, 1, 1]
+    # Пропуск категориального признака кодируется как 'nan', как после astype(str)
+    assert preprocessing["categories"]["cap-surface"].tolist() == ["nan", "scaly", "smooth", "unknown"]
+    assert X["cap-surface"].tolist() == [1, 2, 0]
+    assert preprocessing["medians"]["cap-diameter"] == pytest.approx(4.1)
+    assert preprocessing["class_labels"].tolist() == ["e", "p"]
+
+def test_search_selects_model_within_budget(tmp_path, monkeypatch, training_data):
+    import train_models
+    from sklearn.ensemble import RandomForestClassifier
+    from services.model_bundle import read_bundle_info
+    monkeypatch.setattr(train_models, "SEARCH_SPACES", {
+        "RandomForest": (RandomForestClassifier(random_state=0, n_jobs=1), {"n_estimators": [2, 40], "max_depth": [2, None]}),
+    })
+    X, y = training_data.frame(400)
+    preprocessing = training_data.preprocessing()
+
+    report = train_models.run_search(X[:300], y[:300], X[300:], y[300:], preprocessing, max_latency_us=0, max_size_mb=0)
+
+    result = report["RandomForest"]
+    assert result["within_budget"] is True
+    assert all(c["latency_us"] > 0 and c["size_mb"] > 0 for c in result["candidates"])
+    assert result["selected"]["f1"] == max(c["f1"] for c in result["candidates"])
+    assert read_bundle_info("RandomForest", str(tmp_path))["metadata"]["latency_us"] == result["selected"]["latency_us"]
+
+    # Бюджет отсекает точного, но медленного кандидата
+    candidates = [
+        {"f1": 0.99, "latency_us": 20.0, "size_mb": 300.0},
+        {"f1": 0.97, "latency_us": 2.0, "size_mb": 10.0},
+        {"f1": 0.90, "latency_us": 1.0, "size_mb": 5.0},
+    ]
+    assert train_models.select_candidate(candidates) == (candidates[0], True)
+    assert train_models.select_candidate(candidates, max_latency_us=5) == (candidates[1], True)
+    assert train_models.select_candidate(candidates, max_size_mb=8) == (candidates[2], True)
+    assert train_models.select_candidate(candidates, max_latency_us=0.5) == (candidates[2], False)
+
+def test_update_models_folds_in_new_rows(tmp_path, monkeypatch, training_data):
+    import train_models
+    from services.model_bundle import load_bundle, bundle_path
+    monkeypatch.setattr(train_models, "UPDATE_RF_TREES", 3)
+    monkeypatch.setattr(train_models, "UPDATE_GB_STAGES", 2)
+    rng = np.random.default_rng(0)
+
+    def raw_rows(n, values):
+        df = pd.DataFrame({col: rng.normal(5, 2, n) for col in train_models.NUMERICAL_COLUMNS})
+        for col in train_models.CATEGORICAL_COLUMNS:
+            df[col] = rng.choice(values, n)
+        df["class"] = np.where(df["cap-diameter"] > 5, "p", "e")
+        return df
+
+    preprocessing = training_data.preprocessing(median=5.0, values=("a", "b"))
+    X, y, _, _ = train_models.encode_new_rows(raw_rows(200, ["a", "b"]), preprocessing["medians"], preprocessing["categories"],
+                                              preprocessing["class_labels"], train_models.FEATURE_COLUMNS)
+    models = train_models.build_models({"RandomForest": 1})
+    models[0][0].set_params(n_estimators=5)
+    models[1][0].set_params(n_estimators=5)
+    models[2][0].set_params(max_iter=20)
+    for model, name in models:
+        train_models.train_model(model, X[:150], y[:150], X[150:], y[150:], name, preprocessing)
+
+    new_rows = tmp_path / "new.csv"
+    raw_rows(50, ["a", "b", "c"]).to_csv(new_rows, index=False)
+    results = train_models.update_models(str(new_rows))
+
+    assert {name: r["version"] for name, r in results.items()} == {"RandomForest": 2, "GradientBoosting": 2, "NeuralNetwork": 2}
+    assert all(r["rows"] == 40 and r["new_categories"]["cap-shape"] == ["c"] for r in results.values())
+    rf = load_bundle(bundle_path("RandomForest", str(tmp_path)))
+    # Новое значение дописано в конец, прежние коды не сдвинулись
+    assert rf["categories"]["cap-shape"].tolist() == ["a", "b", "unknown", "c"]
+    assert len(rf["model"].estimators_) == 8
+    assert rf["model"].n_jobs == 1  # дообучение на всех ядрах не переносится в бандл
+    assert load_bundle(bundle_path("GradientBoosting", str(tmp_path)))["model"].estimators_.shape[0] == 7
+
+    unknown_class = raw_rows(20, ["a"])
+    unknown_class.loc[0, "class"] = "x"
+    unknown_class.to_csv(new_rows, index=False)
+    with pytest.raises(ValueError, match="Unknown class labels"):
+        train_models.update_models(str(new_rows), ["RandomForest"])
+
+def test_load_features_uses_cache(tmp_path, monkeypatch):
+    import train_models
+    monkeypatch.setattr(train_models, "FEATURE_CACHE_DIR", str(tmp_path / "cache"))
+    df = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv"))
+    df["class"] = ["e", "p", "p"]
+    csv_path = tmp_path / "train.csv"
+    df.to_csv(csv_path, index=False)
+
+    X, y, preprocessing, hit = train_models.load_features(str(csv_path))
+    assert hit is False
+    with patch("train_models.load_data", side_effect=AssertionError("cache miss")):
+        X_cached, y_cached, preprocessing_cached, hit = train_models.load_features(str(csv_path))
+    assert hit is True
+    assert X_cached.equals(X) and y_cached.equals(y)
+    assert preprocessing_cached["categories"]["cap-surface"].tolist() == preprocessing["categories"]["cap-surface"].tolist()
+
+    # Изменение датасета меняет ключ кэша
+    df.loc[0, "cap-diameter"] = 6.0
+    df.to_csv(csv_path, index=False)
+    assert train_models.load_features(str(csv_path))[3] is False
+    assert len(os.listdir(tmp_path / "cache")) == 2
+
+def test_distill_random_forest(tmp_path, monkeypatch, training_data):
+    from sklearn.ensemble import RandomForestClassifier
+    import train_models
+    from services.model_bundle import load_bundle, bundle_path
+    monkeypatch.setattr(train_models, "DISTILL_TREES", 5)
+    monkeypatch.setattr(train_models, "DISTILL_MAX_DEPTH", 4)
+    X, y = training_data.frame(400)
+    for col in train_models.CATEGORICAL_COLUMNS:
+        X[col] = (X[col] > 0).astype(int)
+    preprocessing = training_data.preprocessing()
+    teacher = RandomForestClassifier(n_estimators=30, random_state=0)
+    train_models.train_model(teacher, X[:300], y[:300], X[300:], y[300:], "RandomForest", preprocessing)
+
+    result = train_models.distill_random_forest(X[:300], X[300:], y[300:], preprocessing, n_jobs=2)
+
+    lite = load_bundle(bundle_path("RandomForestLite", str(tmp_path)))
+    assert len(lite["model"].estimators_) == 5
+    assert lite["model"].n_jobs == 1
+    assert lite["metadata"]["params"]["n_jobs"] == "1"
+    assert all(tree.get_depth() <= 4 for tree in lite["model"].estimators_)
+    assert lite["metadata"]["distilled_from"]["version"] == 1
+    assert 0 <= result["fidelity"] <= 1 and result["speedup"] > 0
+    assert result["f1_loss"] == pytest.approx(result["teacher_f1"] - result["f1"])
+
+    # Признаки, закодированные другими таблицами, учителю не подходят
+    preprocessing["categories"]["cap-shape"] = np.array(["a", "b", "unknown"])
+    with pytest.raises(ValueError, match="different category tables"):
+        train_models.distill_random_forest(X[:300], X[300:], y[300:], preprocessing)
+
+def test_model_bundle_round_trip(tmp_path, monkeypatch):
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.preprocessing import LabelEncoder
+    import joblib
+    from services import prediction_service
+    from services.model_bundle import build_bundle, save_bundle, load_bundle
+    monkeypatch.setattr("services.model_bundle.BUNDLE_DIR", str(tmp_path))
+    monkeypatch.setattr(prediction_service, "_ARTIFACTS_CACHE", {})
+    data = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv"))
+    data = prediction_service.coerce_input_data(data)
+
+    # Кодирование как у прежних SimpleImputer + LabelEncoder
+    categories = {col: np.unique(np.append(data[col].unique(), "unknown")) for col in prediction_service.CATEGORICAL_COLUMNS}
+    encoded = data.copy()
+    for col in prediction_service.NUMERICAL_COLUMNS:
+        encoded[col] = encoded[col].fillna(4.0)
+    for col, values in categories.items():
+        encoded[col] = LabelEncoder().fit(values).transform(encoded[col])
+    model = RandomForestClassifier(n_estimators=5, random_state=0).fit(encoded, [0, 1, 1])
+
+    bundle = build_bundle(
+        "TestModel", model, {col: 4.0 for col in prediction_service.NUMERICAL_COLUMNS}, categories,
+        np.array(["e", "p"]), prediction_service.REQUIRED_COLUMNS, metadata={"f1": 1.0}
+    )
+    save_bundle(bundle)
+    path = save_bundle(bundle)
+
+    artifacts = prediction_service.load_model_artifacts("TestModel")
+    assert artifacts["version"] == 2
+    assert isinstance(artifacts["categories"]["cap-shape"], np.memmap)
+    assert prediction_service.predict_dataframe(data, artifacts) == [["e", "p"][i] for i in model.predict(encoded)]
+
+    # Неизвестное значение кодируется как 'unknown'
+    unknown = data.copy()
+    unknown.loc[0, "cap-shape"] = "never-seen"
+    features = prediction_service.encode_features(unknown, artifacts)
+    assert features.loc[0, "cap-shape"] == artifacts["unknown_codes"]["cap-shape"]
+    assert features.drop(index=0).equals(prediction_service.encode_features(data, artifacts).drop(index=0))
+
+    # Загрузка между заменой {имя}.json и самого бандла получает прежнюю версию без ошибки
+    replace = os.replace
+    loaded_between = []
+
+    def replace_and_load(src, dst):
+        if dst == path:
+            loaded_between.append(load_bundle(path, verify=True)["version"])
+        replace(src, dst)
+
+    with patch("services.model_bundle.os.replace", side_effect=replace_and_load):
+        save_bundle(bundle)
+    assert loaded_between == [2]
+    assert load_bundle(path, verify=True)["version"] == 3
+
+    # Бандл, перезаписанный в обход save_bundle, не проходит проверку
+    assert load_bundle(path, verify=True)["content_hash"] == bundle["content_hash"]
+    bundle["class_labels"] = np.array(["p", "e"])
+    joblib.dump(bundle, path)
+    with pytest.raises(ValueError, match="checksum mismatch"):
+        load_bundle(path, verify=True)
+
+def test_profile_models_measures_serving_path(tmp_path, monkeypatch):
+    from sklearn.ensemble import RandomForestClassifier
+    import train_models
+    from services import prediction_service
+    from services.model_bundle import build_bundle, save_bundle
+    monkeypatch.setattr(train_models, "BUNDLE_DIR", str(tmp_path))
+    data = prediction_service.coerce_input_data(pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")))
+    categories = {col: np.unique(np.append(data[col].astype(str).unique(), "unknown")) for col in prediction_service.CATEGORICAL_COLUMNS}
+    X = pd.DataFrame(np.zeros((3, len(prediction_service.REQUIRED_COLUMNS))), columns=prediction_service.REQUIRED_COLUMNS)
+    model = RandomForestClassifier(n_estimators=3, random_state=0).fit(X, [0, 1, 1])
+    save_bundle(build_bundle(
+        "TestModel", model, {col: 4.0 for col in prediction_service.NUMERICAL_COLUMNS}, categories,
+        np.array(["e", "p"]), prediction_service.REQUIRED_COLUMNS
+    ), str(tmp_path))
+
+    profiles = train_models.profile_models(["TestModel", "Missing"], data, batch_sizes=[1, 50], repeats=1)
+
+    assert set(profiles) == {"TestModel"}
+    profile = profiles["TestModel"]
+    assert set(profile["rows_per_sec"]) == {"1", "50"} and all(rate > 0 for rate in profile["rows_per_sec"].values())
+    assert profile["load_seconds"] > 0 and profile["memory_mb"] >= 0 and profile["version"] == 1
+
+def test_majority_vote_breaks_ties_by_model_order():
+    from services.prediction_service import majority_vote
+    labels = {"A": ["p", "e", "p", "e"], "B": ["e", "e", "p", "p"], "C": ["e", "p", "p", "p"]}
+    assert majority_vote(labels) == ["e", "e", "p", "p"]
+    assert majority_vote({"A": ["p", "e"], "B": ["e", "p"]}) == ["p", "e"]
+
+def test_predict_ensemble_encodes_features_once():
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.tree import DecisionTreeClassifier
+    from services import prediction_service
+    data = prediction_service.coerce_input_data(pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")))
+    categories = {col: np.unique(np.append(data[col].astype(str).unique(), "unknown")) for col in prediction_service.CATEGORICAL_COLUMNS}
+    medians = {col: 4.0 for col in prediction_service.NUMERICAL_COLUMNS}
+    X = pd.DataFrame(np.arange(3 * len(prediction_service.REQUIRED_COLUMNS)).reshape(3, -1), columns=prediction_service.REQUIRED_COLUMNS)
+    artifacts_list = [
+        prediction_service.build_artifacts(name, model.fit(X, [0, 1, 1]), medians, categories, np.array(["e", "p"]), prediction_service.REQUIRED_COLUMNS)
+        for name, model in [("Forest", RandomForestClassifier(n_estimators=3, random_state=0)), ("Tree", DecisionTreeClassifier(random_state=0))]
+    ]
+    assert artifacts_list[0]["preprocessing_key"] == artifacts_list[1]["preprocessing_key"]
+
+    with patch("services.prediction_service.encode_features", wraps=prediction_service.encode_features) as mock_encode:
+        result = prediction_service.predict_ensemble(data, artifacts_list)
+
+    assert mock_encode.call_count == 1
+    assert result["models"] == {a["name"]: prediction_service.predict_dataframe(data, a) for a in artifacts_list}
+    assert result["vote"] == result["models"]["Forest"]  # при двух моделях ничья решается первой
+
+def test_predict_ensemble_endpoint_bills_once(client, test_db, registered_user, tmp_path):
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.add(DBModel(id=2, name="GradientBoosting", cost=2.0, file_path="ml_models/trained_ml_models/GradientBoosting.pkl"))
+    test_db.commit()
+    csv_file = tmp_path / "test_data.csv"
+    csv_file.write_text(open(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).read())
+    headers = {"Authorization": f"Bearer {registered_user['token']}"}
+
+    mock_task = MagicMock()
+    mock_task.id = "mock_task_id"
+    with patch("main.celery_app.send_task", return_value=mock_task) as mock_send_task:
+        with open(csv_file, "rb") as f:
+            response = client.post("/predict/ensemble?model_ids=1&model_ids=2", headers=headers,
+                                   files={"file": ("test_data.csv", f, "text/csv")})
+        with open(csv_file, "rb") as f:
+            duplicate = client.post("/predict/ensemble?model_ids=1&model_ids=1", headers=headers,
+                                    files={"file": ("test_data.csv", f, "text/csv")})
+
+    assert response.status_code == 200
+    assert response.json()["ensemble"] == {"model_ids": [1, 2], "models": ["RandomForest", "GradientBoosting"], "cost": 3.0}
+    assert mock_send_task.call_count == 1
+    assert duplicate.status_code == 400
+    transactions = test_db.query(DBTransaction).all()
+    assert [t.amount for t in transactions] == [-3.0]
+    assert transactions[0].description == "Ensemble prediction using models RandomForest, GradientBoosting"
+    assert test_db.query(DBUser).filter(DBUser.username == "testuser").first().balance == 7.0
+
+def test_make_prediction_stores_ensemble_results(test_db):
+    from services.prediction_service import make_prediction
+    from db.db_usage import DBUsage
+    from services import tasks
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.add(DBModel(id=2, name="GradientBoosting", cost=2.0, file_path="ml_models/trained_ml_models/GradientBoosting.pkl"))
+    rows = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).to_dict(orient="records") * 2
+    ensemble = {"model_ids": [1, 2], "models": ["RandomForest", "GradientBoosting"], "cost": 3.0}
+    prediction = DBPrediction(user_id=1, model_id=1, input_data=rows, status="pending", ensemble=ensemble)
+    test_db.add(prediction)
+    test_db.commit()
+
+    def fake_ensemble(df, artifacts_list):
+        return {"vote": ["p"] * len(df), "models": {"RandomForest": ["p"] * len(df), "GradientBoosting": ["e"] * len(df)}}
+
+    with patch("services.prediction_service.load_pinned_artifacts", return_value={}), \
+         patch("services.prediction_service.predict_ensemble", side_effect=fake_ensemble), \
+         patch("services.tasks.publish_prediction_event"):
+        result = make_prediction(test_db, prediction, chunk_size=4)
+        tasks.complete_prediction(test_db, prediction, result.result)
+
+    assert result.result == ["p"] * 6
+    assert result.ensemble["results"] == {"RandomForest": ["p"] * 6, "GradientBoosting": ["e"] * 6}
+    assert sorted((u.model_id, u.credits_spent) for u in test_db.query(DBUsage).all()) == [(1, 1.0), (2, 2.0)]
+
+def test_predict_cascade_escalates_uncertain_rows():
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.tree import DecisionTreeClassifier
+    from services import prediction_service
+    data = prediction_service.coerce_input_data(pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")))
+    data = pd.concat([data] * 20, ignore_index=True)
+    data["cap-diameter"] = np.arange(len(data), dtype="float64")
+    categories = {col: np.unique(np.append(data[col].astype(str).unique(), "unknown")) for col in prediction_service.CATEGORICAL_COLUMNS}
+    medians = {col: 4.0 for col in prediction_service.NUMERICAL_COLUMNS}
+    artifacts = [
+        prediction_service.build_artifacts("Forest", RandomForestClassifier(n_estimators=5, max_depth=3, random_state=0), medians, categories, np.array(["e", "p"]), prediction_service.REQUIRED_COLUMNS),
+        prediction_service.build_artifacts("Tree", DecisionTreeClassifier(random_state=0), medians, categories, np.array(["e", "p"]), prediction_service.REQUIRED_COLUMNS),
+    ]
+    features = prediction_service.encode_features(data, artifacts[0])
+    y = ((np.arange(len(data)) >= 30) ^ (np.arange(len(data)) % 7 == 0)).astype(int)  # граница по cap-diameter с шумом
+    for a in artifacts:
+        a["model"].fit(features, y)
+
+    with patch("services.prediction_service.encode_features", wraps=prediction_service.encode_features) as mock_encode:
+        result = prediction_service.predict_cascade(data, artifacts, threshold=0.9)
+
+    confidence = artifacts[0]["model"].predict_proba(features).max(axis=1)
+    escalated = confidence < 0.9
+    assert 0 < escalated.sum() < len(data)
+    assert mock_encode.call_count == 1
+    assert result["stages"] == escalated.astype(int).tolist()
+    forest = prediction_service.predict_dataframe(data, artifacts[0])
+    tree = prediction_service.predict_dataframe(data, artifacts[1])
+    assert result["labels"] == [t if e else f for f, t, e in zip(forest, tree, escalated)]
+
+    report = prediction_service.cascade_report(result, {"models": ["Forest", "Tree"], "costs": [1.0, 3.0], "cost": 4.0})
+    rate = escalated.sum() / len(data)
+    assert report["rows"] == {"Forest": len(data), "Tree": int(escalated.sum())}
+    assert report["escalation_rate"] == round(rate, 4)
+    assert report["billed"] == pytest.approx(1.0 + 3.0 * rate, abs=1e-3)
+    assert report["refund"] == pytest.approx(3.0 * (1 - rate), abs=1e-3)
+
+def test_cascade_refund_is_all_or_nothing(test_db, registered_user):
+    from sqlalchemy.exc import SQLAlchemyError
+    from services import tasks
+    user = test_db.query(DBUser).filter(DBUser.username == "testuser").first()
+    report = {"mode": "cascade", "refund": 2.0, "billed": 2.0, "escalation_rate": 0.5, "seconds_saved": 0.1}
+    prediction = DBPrediction(user_id=user.id, model_id=1, status="completed", ensemble=report)
+    test_db.add(prediction)
+    test_db.commit()
+
+    # Сбой коммита: не сохраняются ни баланс, ни транзакция, ни отметка - возврат можно повторить
+    with patch.object(test_db, "commit", side_effect=SQLAlchemyError("disk I/O error")):
+        with pytest.raises(SQLAlchemyError):
+            tasks.refund_cascade(test_db, prediction)
+    test_db.refresh(user)
+    assert user.balance == 10.0
+    assert test_db.query(DBTransaction).count() == 0
+    assert "refunded" not in prediction.ensemble
+
+    tasks.refund_cascade(test_db, prediction)
+    tasks.refund_cascade(test_db, prediction)
+    test_db.refresh(user)
+    assert user.balance == 12.0
+    assert [t.amount for t in test_db.query(DBTransaction).all()] == [2.0]
+    assert prediction.ensemble["refunded"] is True
+
+def test_cascade_prediction_refunds_unescalated_share(client, test_db, registered_user, tmp_path):
+    from services.prediction_service import make_prediction
+    from db.db_usage import DBUsage
+    from services import tasks
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.add(DBModel(id=3, name="NeuralNetwork", cost=3.0, file_path="ml_models/trained_ml_models/NeuralNetwork.pkl"))
+    test_db.commit()
+    csv_file = tmp_path / "test_data.csv"
+    csv_file.write_text(open(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")).read())
+    headers = {"Authorization": f"Bearer {registered_user['token']}"}
+
+    mock_task = MagicMock()
+    mock_task.id = "mock_task_id"
+    with patch("main.celery_app.send_task", return_value=mock_task):
+        with open(csv_file, "rb") as f:
+            invalid = client.post("/predict/cascade?model_ids=1&model_ids=3&threshold=1.5", headers=headers,
+                                  files={"file": ("test_data.csv", f, "text/csv")})
+        with open(csv_file, "rb") as f:
+            response = client.post("/predict/cascade?model_ids=1&model_ids=3&threshold=0.8", headers=headers,
+                                   files={"file": ("test_data.csv", f, "text/csv")})
+    assert invalid.status_code == 400
+    assert response.status_code == 200
+    assert response.json()["ensemble"]["mode"] == "cascade"
+    assert test_db.query(DBUser).filter(DBUser.username == "testuser").first().balance == 6.0
+
+    # Первая модель уверена в двух строках из трёх - одна строка уходит NeuralNetwork
+    def fake_cascade(df, artifacts_list, threshold):
+        return {"labels": ["e", "p", "p"], "stages": [0, 1, 0], "seconds": {"RandomForest": 0.01, "NeuralNetwork": 0.02}}
+
+    prediction = test_db.query(DBPrediction).filter(DBPrediction.id == response.json()["id"]).first()
+    with patch("services.prediction_service.load_pinned_artifacts", return_value={}), \
+         patch("services.prediction_service.predict_cascade", side_effect=fake_cascade), \
+         patch("services.tasks.publish_prediction_event"):
+        result = make_prediction(test_db, prediction)
+        tasks.complete_prediction(test_db, prediction, result.result)
+        tasks.refund_cascade(test_db, prediction)  # повторный вызов не возвращает дважды
+
+    report = prediction.ensemble
+    assert result.result == ["e", "p", "p"]
+    assert report["escalation_rate"] == pytest.approx(1 / 3, abs=1e-4)
+    assert report["billed"] == pytest.approx(2.0, abs=1e-3) and report["refund"] == pytest.approx(2.0, abs=1e-3)
+    assert report["seconds_saved"] == pytest.approx(0.06 - 0.03, abs=1e-3)
+    assert report["refunded"] is True
+    refunds = test_db.query(DBTransaction).filter(DBTransaction.amount > 0).all()
+    assert [(t.amount, t.prediction_id) for t in refunds] == [(report["refund"], prediction.id)]
+    assert test_db.query(DBUser).filter(DBUser.username == "testuser").first().balance == pytest.approx(8.0, abs=1e-3)
+    usage = {u.model_id: (u.rows_scored, u.credits_spent) for u in test_db.query(DBUsage).all()}
+    assert usage[1] == (3, 1.0)
+    assert usage[3][0] == 1 and usage[3][1] == pytest.approx(1.0, abs=1e-3)
+
+def test_model_version_manager_swaps_validated_versions(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    from sklearn.tree import DecisionTreeClassifier
+    from services import prediction_service
+    from services.model_bundle import build_bundle, save_bundle
+    from services.model_versions import ModelVersionManager
+    monkeypatch.setattr("services.model_bundle.BUNDLE_DIR", str(tmp_path))
+    monkeypatch.setattr(prediction_service, "_ARTIFACTS_CACHE", {})
+    monkeypatch.setattr(prediction_service, "_PREVIOUS_ARTIFACTS", {})
+    data = prediction_service.coerce_input_data(pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv")))
+    categories = {col: np.unique(np.append(data[col].astype(str).unique(), "unknown")) for col in prediction_service.CATEGORICAL_COLUMNS}
+    X = pd.DataFrame(np.arange(3 * len(prediction_service.REQUIRED_COLUMNS)).reshape(3, -1), columns=prediction_service.REQUIRED_COLUMNS)
+
+    def save_version(y, class_labels=("e", "p")):
+        model = DecisionTreeClassifier(random_state=0).fit(X, y)
+        save_bundle(build_bundle(
+            "TestModel", model, {col: 4.0 for col in prediction_service.NUMERICAL_COLUMNS}, categories,
+            np.array(class_labels), prediction_service.REQUIRED_COLUMNS
+        ))
+
+    save_version([0, 1, 1])
+    in_flight = prediction_service.load_model_artifacts("TestModel")
+    before = prediction_service.predict_dataframe(data, in_flight)
+    pinned_v1 = prediction_service.pin_model_versions(["TestModel"])["TestModel"]
+    manager = ModelVersionManager(interval=0.01)
+    assert manager.check("TestModel") is False
+
+    # Новая версия подменяется для следующих задач, начатая задача дорабатывает на старой
+    save_version([1, 0, 0])
+    assert manager.check_all() == ["TestModel"]
+    assert prediction_service.load_model_artifacts("TestModel")["version"] == 2
+    assert in_flight["version"] == 1
+    assert prediction_service.predict_dataframe(data, in_flight) == before
+
+    # Шарды задачи, отправленной до подмены, считаются закреплённой версией
+    pinned_v2 = prediction_service.pin_model_versions(["TestModel"])["TestModel"]
+    assert prediction_service.load_pinned_artifacts("TestModel", pinned_v1) is in_flight
+    assert prediction_service.load_pinned_artifacts("TestModel", pinned_v2)["version"] == 2
+    assert prediction_service.load_pinned_artifacts("TestModel", None)["version"] == 2
+    shard = SimpleNamespace(id=1, model_id=1, model_versions={"TestModel": pinned_v1}, ensemble=None, input_path=None,
+                            input_data=data.to_dict(orient="records"))
+    with patch("services.prediction_service.get_prediction_models", return_value=[SimpleNamespace(name="TestModel")]), \
+         patch("services.prediction_service.get_prediction_chunks", return_value={}), \
+         patch("services.prediction_service.save_prediction_chunk",
+               side_effect=lambda db, prediction_id, start, end, labels: SimpleNamespace(end_row=end, result=labels)):
+        assert prediction_service.score_prediction_rows(None, shard) == before
+
+    # Процесс, ещё не подменивший модель, читает закреплённую версию с диска, не трогая кэш
+    current = prediction_service._ARTIFACTS_CACHE["TestModel"]
+    prediction_service._ARTIFACTS_CACHE["TestModel"] = in_flight
+    assert prediction_service.load_pinned_artifacts("TestModel", pinned_v2)["version"] == 2
+    assert prediction_service._ARTIFACTS_CACHE["TestModel"] is in_flight
+    prediction_service._ARTIFACTS_CACHE["TestModel"] = current
+
+    # Прежняя версия освобождается через MODEL_PREVIOUS_VERSION_TTL, закреплённые за ней задачи
+    # продолжают текущей версией
+    expired_at = time.monotonic() + prediction_service.MODEL_PREVIOUS_VERSION_TTL
+    assert prediction_service.expire_previous_artifacts(expired_at) == ["TestModel"]
+    assert prediction_service.load_pinned_artifacts("TestModel", pinned_v1)["version"] == 2
+
+    # Версия с другими метками классов не проходит проверку и не перепроверяется
+    save_version([0, 1, 1], class_labels=("x", "y"))
+    assert manager.check("TestModel") is False
+    assert prediction_service.load_model_artifacts("TestModel")["version"] == 2
+    with patch("services.prediction_service.read_model_artifacts") as mock_read:
+        assert manager.check("TestModel") is False
+    mock_read.assert_not_called()
+
+    # Фоновый поток подхватывает следующую версию сам
+    save_version([1, 1, 0])
+    manager.start()
+    try:
+        deadline = time.time() + 5
+        while prediction_service.load_model_artifacts("TestModel")["version"] != 4 and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        manager.stop()
+    assert prediction_service.load_model_artifacts("TestModel")["version"] == 4
+
+def test_predict_accepts_json_and_ndjson_records(client, test_db, registered_user):
+    from fastapi import HTTPException
+    from services import prediction_service
+    from services.spool import read_input_spool
+    test_db.add(DBModel(id=1, name="RandomForest", cost=1.0, file_path="ml_models/trained_ml_models/RandomForest.pkl"))
+    test_db.commit()
+    data = pd.read_csv(os.path.join(os.path.dirname(__file__), "..", "..", "data.csv"))
+    records = json.loads(data.to_json(orient="records"))
+    headers = {"Authorization": f"Bearer {registered_user['token']}"}
+
+    mock_task = MagicMock()
+    mock_task.id = "mock_task_id"
+    with patch("main.celery_app.send_task", return_value=mock_task), \
+         patch("main.NDJSON_BATCH_ROWS", 2):
+        from_json = client.post("/predict?model_id=1", headers={**headers, "Content-Type": "application/json"},
+                                content=json.dumps(records))
+        from_ndjson = client.post("/predict?model_id=1", headers={**headers, "Content-Type": "application/x-ndjson"},
+                                  content="\n".join(json.dumps(r) for r in records) + "\n")
+        invalid = client.post("/predict?model_id=1", headers={**headers, "Content-Type": "application/x-ndjson"},
+                              content=json.dumps(records[0]) + "\n" + json.dumps({**records[1], "stem-width": "wide"}))
+        broken = client.post("/predict?model_id=1", headers={**headers, "Content-Type": "application/x-ndjson"},
+                             content=json.dumps(records[0]) + "\n" + json.dumps(records[1]) + "\n{\"cap-shape\":")
+        # Поток фрагментами по 7 байт: строки разрезаны между фрагментами
+        body = ("\n".join(json.dumps(r) for r in records)).encode()
+        from_chunks = client.post("/predict?model_id=1", headers={**headers, "Content-Type": "application/x-ndjson"},
+                                  content=(body[i:i + 7] for i in range(0, len(body), 7)))
+    with patch("main.MAX_FILE_SIZE", 100):
+        too_large = client.post("/predict?model_id=1", headers={**headers, "Content-Type": "application/json"},
+                                content=json.dumps(records))
+        too_large_stream = client.post("/predict?model_id=1", headers={**headers, "Content-Type": "application/json"},
+                                       content=(json.dumps(r).encode() for r in records))
+
+    # Записи попадают в спул так же, как строки файла с теми же значениями
+    expected = read_input_spool(
+        test_db.query(DBPrediction).filter(DBPrediction.id == from_json.json()["id"]).first().input_path, 0, 3)
+    assert expected["cap-surface"].tolist() == ["scaly", "smooth", "nan"]
+    assert expected["does-bruise-or-bleed"].tolist() == ["False", "True", "False"]
+    ndjson_path = test_db.query(DBPrediction).filter(DBPrediction.id == from_ndjson.json()["id"]).first().input_path
+    pd.testing.assert_frame_equal(read_input_spool(ndjson_path, 0, 3), expected)
+    chunks_path = test_db.query(DBPrediction).filter(DBPrediction.id == from_chunks.json()["id"]).first().input_path
+    # Версия модели закрепляется при запуске задачи, а не при отправке
+    assert test_db.query(DBPrediction).filter(DBPrediction.id == from_json.json()["id"]).first().model_versions is None
+    pd.testing.assert_frame_equal(read_input_spool(chunks_path, 0, 3), expected)
+    assert too_large.status_code == 400 and too_large.json()["detail"] == "Request body too large, max 200MB."
+    assert too_large_stream.status_code == 400 and too_large_stream.json()["detail"] == "Request body too large, max 200MB."
+    assert invalid.status_code == 400
+    assert invalid.json()["detail"].startswith("Invalid records: Record 1 field stem-width")
+    for value in [True, "5.5"]:
+        with pytest.raises(HTTPException):
+            prediction_service.read_json_records(json.dumps([{**records[0], "stem-width": value}]).encode())
+    assert prediction_service.read_json_records(json.dumps([{**records[0], "stem-width": 3}]).encode())["stem-width"].tolist() == [3.0]
+    assert broken.status_code == 400
+    assert broken.json()["detail"].startswith("Invalid records: Record 2")
+
+def test_bot_reconnects_when_event_stream_closes_with_pending_predictions():
+    """Закрытие потока событий сервером не теряет уведомления: бот переподключается, затем опрашивает."""
+    import asyncio
+    import telegram_bot
+
+    user_id = 42
+    context = MagicMock()
+    telegram_bot.user_tokens[user_id] = "token"
+    try:
+        # Поток закрывается штатно, затем при втором подключении предсказание 1 завершается
+        connects = []
+
+        async def finish_on_second_connect(ctx, token, uid):
+            connects.append(uid)
+            if len(connects) == 2:
+                telegram_bot.pending_predictions[uid].pop(1)
+
+        telegram_bot.pending_predictions[user_id] = {1: 100}
+        with patch("telegram_bot.stream_prediction_events", side_effect=finish_on_second_connect) as stream, \
+                patch("telegram_bot.asyncio.sleep") as sleep:
+            asyncio.run(telegram_bot.listen_prediction_events(context, user_id))
+        assert stream.call_count == 2
+        sleep.assert_awaited_once_with(telegram_bot.EVENT_STREAM_RECONNECT_DELAY)
+        context.job_queue.run_repeating.assert_not_called()
+
+        # Поток закрывается штатно каждый раз: после исчерпания переподключений включается опрос
+        telegram_bot.pending_predictions[user_id] = {2: 200}
+        with patch("telegram_bot.stream_prediction_events") as stream, patch("telegram_bot.asyncio.sleep"):
+            asyncio.run(telegram_bot.listen_prediction_events(context, user_id))
+        assert stream.call_count == telegram_bot.EVENT_STREAM_MAX_RECONNECTS + 1
+        context.job_queue.run_repeating.assert_called_once()
+        assert context.job_queue.run_repeating.call_args.kwargs["data"] == {"prediction_id": 2, "user_id": user_id}
+        assert user_id not in telegram_bot.pending_predictions
+        assert user_id not in telegram_bot.event_listeners
+    finally:
+        telegram_bot.user_tokens.pop(user_id, None)
+        telegram_bot.pending_predictions.pop(user_id, None)
@@ -0,0 +1,95 @@
+"""
+Локальная замена Prometheus: периодически опрашивает /metrics API и экспортеры
+процессов воркеров и печатает по каждому этапу количество наблюдений за интервал
+и оценки p50/p95 по корзинам гистограммы ml_service_stage_seconds.
+
+Работает без сети и без сервера Prometheus. Запуск из папки ml_service:
+    python tools/scrape_metrics.py [--interval 15] [--count 0] [--target URL ...]
+
+По умолчанию опрашиваются API (http://localhost:8000/metrics) и первые процессы
+воркеров fast/bulk/heavy (порты из Makefile: 9810, 9830, 9850 и следующие).
+Недоступные цели пропускаются.
+"""
+import argparse
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+STAGE_METRIC = "ml_service_stage_seconds"
+DEFAULT_TARGETS = ["http://localhost:8000/metrics"] + [
+    f"http://localhost:{base + i}/metrics" for base in (9810, 9830, 9850) for i in range(4)
+]
+
+Key = Tuple[str, str, str]  # (stage, model, size)
+
+def scrape(targets: List[str]) -> Dict[Key, Dict[float, float]]:
+    """Собирает кумулятивные счётчики корзин гистограммы этапов со всех доступных целей."""
+    buckets: Dict[Key, Dict[float, float]] = defaultdict(lambda: defaultdict(float))
+    for url in targets:
+        try:
+            response = httpx.get(url, timeout=2.0)
+            response.raise_for_status()
+        except httpx.HTTPError:
+            continue
+        for family in text_string_to_metric_families(response.text):
+            if family.name != STAGE_METRIC:
+                continue
+            for sample in family.samples:
+                if sample.name != f"{STAGE_METRIC}_bucket":
+                    continue
+                key = (sample.labels["stage"], sample.labels["model"], sample.labels["size"])
+                buckets[key][float(sample.labels["le"])] += sample.value
+    return buckets
+
+def quantile(buckets: Dict[float, float], q: float) -> Optional[float]:
+    """Оценивает квантиль по кумулятивным корзинам (линейная интерполяция, как histogram_quantile)."""
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]] if bounds else 0
+    if total <= 0:
+        return None
+    rank = q * total
+    lower_bound, lower_count = 0.0, 0.0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float("inf"):
+                return lower_bound
+            width = count - lower_count
+            return lower_bound + (bound - lower_bound) * ((rank - lower_count) / width if width else 0)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+def report(previous: Dict[Key, Dict[float, float]], current: Dict[Key, Dict[float, float]]):
+    """Печатает наблюдения за интервал между двумя опросами."""
+    print(f"{'stage':<14} {'model':<18} {'size':<8} {'count':>7} {'p50 s':>9} {'p95 s':>9}")
+    for key in sorted(current):
+        delta = {le: value - previous.get(key, {}).get(le, 0.0) for le, value in current[key].items()}
+        count = delta.get(float("inf"), 0.0)
+        if count <= 0:
+            continue
+        p50, p95 = quantile(delta, 0.5), quantile(delta, 0.95)
+        print(f"{key[0]:<14} {key[1]:<18} {key[2]:<8} {int(count):>7} {p50:>9.4f} {p95:>9.4f}")
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", action="append", help="URL /metrics (можно указать несколько раз)")
+    parser.add_argument("--interval", type=float, default=15.0, help="Интервал опроса, с")
+    parser.add_argument("--count", type=int, default=0, help="Количество интервалов (0 - бесконечно)")
+    args = parser.parse_args()
+
+    targets = args.target or DEFAULT_TARGETS
+    previous = scrape(targets)
+    iteration = 0
+    while args.count == 0 or iteration < args.count:
+        time.sleep(args.interval)
+        current = scrape(targets)
+        print(time.strftime("%H:%M:%S"))
+        report(previous, current)
+        previous = current
+        iteration += 1
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,36 @@
 import pandas as pd
-import pickle
-from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+from pandas.api.types import union_categoricals
+from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier, HistGradientBoostingClassifier
 from sklearn.neural_network import MLPClassifier
 from sklearn.preprocessing import LabelEncoder
+from sklearn.base import clone
 from sklearn.model_selection import train_test_split
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401 - включает HalvingGridSearchCV
+from sklearn.model_selection import HalvingGridSearchCV
 from sklearn.metrics import f1_score
-from sklearn.impute import SimpleImputer
+from threadpoolctl import threadpool_limits
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import argparse
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import pickle
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
 import numpy as np
+from sqlalchemy.exc import SQLAlchemyError
+from database import SessionLocal
+from services.db_operations import update_model_profile
+from init_models import init_models
+from services.model_bundle import (
+    BUNDLE_DIR, build_bundle, save_bundle, file_sha256, bundle_path, load_bundle, read_bundle_info,
+    category_lookup, encode_categorical
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,14 +38,19 @@ logger = logging.getLogger(__name__)
 # Пути к датасету и моделям относительно папки ml_service
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_PATH = os.path.join(BASE_DIR, "..", "data", "train.csv")
-MODEL_DIR = os.path.join(BASE_DIR, "ml_models", "trained_ml_models")
-IMPUTER_DIR = os.path.join(BASE_DIR, "ml_models", "imputers")
-ENCODER_DIR = os.path.join(BASE_DIR, "ml_models", "label_encoders")
+TRAINING_REPORT_PATH = os.path.join(BASE_DIR, "ml_models", "training_report.json")
 
-# Создаём директории для моделей, имьютеров и энкодеров
-os.makedirs(MODEL_DIR, exist_ok=True)
-os.makedirs(IMPUTER_DIR, exist_ok=True)
-os.makedirs(ENCODER_DIR, exist_ok=True)
+# Кэш подготовленных признаков: папка на каждый ключ (хэш датасета и настроек
+# предобработки), хранится FEATURE_CACHE_KEEP последних ключей.
+# PREPROCESSING_VERSION нужно увеличивать при изменении логики load_data.
+FEATURE_CACHE_DIR = os.getenv("FEATURE_CACHE_DIR", os.path.join(BASE_DIR, "ml_models", "feature_cache"))
+FEATURE_CACHE_KEEP = int(os.getenv("FEATURE_CACHE_KEEP", "2"))
+PREPROCESSING_VERSION = 1
+
+# Ход обучения: RandomForest наращивается примерно за PROGRESS_STEPS порций,
+# прогресс опрашивается каждые PROGRESS_POLL_SECONDS секунд
+PROGRESS_STEPS = 20
+PROGRESS_POLL_SECONDS = 0.5
 
 # Список всех категориальных и числовых признаков
 CATEGORICAL_COLUMNS = [
@@ -34,22 +60,143 @@ CATEGORICAL_COLUMNS = [
 ]
 NUMERICAL_COLUMNS = ["cap-diameter", "stem-height", "stem-width"]
 
-# Столбцы, которые удаляем из-за высокого процента NaN
+# Столбцы, которые не используем из-за высокого процента NaN (при чтении пропускаются)
 DROP_COLUMNS = ["veil-type", "veil-color", "stem-root", "spore-print-color"]
 
-def load_data():
+# Порядок признаков модели (как в prediction_service.REQUIRED_COLUMNS)
+FEATURE_COLUMNS = [
+    "cap-diameter", "cap-shape", "cap-surface", "cap-color", "does-bruise-or-bleed",
+    "gill-attachment", "gill-spacing", "gill-color", "stem-height", "stem-width",
+    "stem-surface", "stem-color", "has-ring", "ring-type", "habitat", "season"
+]
+
+# HistGradientBoosting разбивает категориальные признаки по самим категориям (коды
+# используются как метки, а не как порядковые значения), если их не больше max_bins
+HIST_MAX_CATEGORIES = 255
+
+# Размер чанка при чтении датасета
+LOAD_CHUNK_ROWS = int(os.getenv("LOAD_CHUNK_ROWS", "500000"))
+
+# Поиск гиперпараметров (--search): последовательное деление пополам на подвыборках
+# до SEARCH_MAX_ROWS строк, SEARCH_TOP_K лучших кандидатов дообучаются на всей
+# обучающей выборке и измеряются. Бюджет инференса: задержка на строку (мкс) и
+# размер модели (МБ), 0 - без ограничения.
+SEARCH_CV = int(os.getenv("SEARCH_CV", "3"))
+SEARCH_MAX_ROWS = int(os.getenv("SEARCH_MAX_ROWS", "200000"))
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "4"))
+SEARCH_MAX_LATENCY_US = float(os.getenv("SEARCH_MAX_LATENCY_US", "0"))
+SEARCH_MAX_MODEL_MB = float(os.getenv("SEARCH_MAX_MODEL_MB", "0"))
+# Процессы пула воркера предсказывают в один поток: n_jobs, с которым модель обучалась,
+# в бандл не сохраняется
+SERVING_N_JOBS = 1
+
+# Задержка измеряется на батче LATENCY_ROWS строк (медиана LATENCY_REPEATS замеров)
+# в один поток, как в процессе пула воркера
+LATENCY_ROWS = 1000
+LATENCY_REPEATS = 5
+
+# Дообучение на новых размеченных строках (--update): RandomForest добавляет
+# UPDATE_RF_TREES деревьев (старейшие удаляются сверх UPDATE_RF_MAX_TREES),
+# GradientBoosting - UPDATE_GB_STAGES стадий, MLP делает UPDATE_MLP_EPOCHS эпох
+# partial_fit. Все они обучаются только на новых строках; UPDATE_HOLDOUT новых
+# строк откладывается для оценки F1 до и после обновления.
+UPDATE_RF_TREES = int(os.getenv("UPDATE_RF_TREES", "20"))
+UPDATE_RF_MAX_TREES = int(os.getenv("UPDATE_RF_MAX_TREES", "300"))
+UPDATE_GB_STAGES = int(os.getenv("UPDATE_GB_STAGES", "20"))
+UPDATE_MLP_EPOCHS = int(os.getenv("UPDATE_MLP_EPOCHS", "5"))
+UPDATE_HOLDOUT = 0.2
+# HistGradientBoosting заново строит бины по данным каждого fit, поэтому дообучение
+# только на новых строках для него не поддерживается
+UPDATABLE_MODELS = (RandomForestClassifier, GradientBoostingClassifier, MLPClassifier)
+
+# Дистилляция: RandomForest (учитель) сжимается в RandomForestLite - не больше
+# DISTILL_TREES деревьев глубиной до DISTILL_MAX_DEPTH, обученных на предсказаниях
+# полного леса, а не на исходных метках, чтобы повторять его решения.
+DISTILL_TEACHER = "RandomForest"
+DISTILLED_MODEL = "RandomForestLite"
+DISTILL_TREES = int(os.getenv("DISTILL_TREES", "20"))
+DISTILL_MAX_DEPTH = int(os.getenv("DISTILL_MAX_DEPTH", "12"))
+
+# Профиль производительности модели (models.profile) измеряется после обучения в
+# отдельном процессе по пути сервиса (load_model_artifacts + predict_dataframe):
+# время загрузки бандла, прирост памяти процесса и скорость на пакетах PROFILE_BATCH_SIZES
+# строк (медиана PROFILE_REPEATS замеров). По профилю выбираются очередь и ETA.
+PROFILE_BATCH_SIZES = [int(size) for size in os.getenv("PROFILE_BATCH_SIZES", "1,100,10000").split(",")]
+PROFILE_REPEATS = int(os.getenv("PROFILE_REPEATS", "5"))
+
+# Пространства поиска. GradientBoosting и MLP останавливаются раньше по
+# отложенной выборке (n_iter_no_change / early_stopping)
+SEARCH_SPACES = {
+    "RandomForest": (
+        RandomForestClassifier(random_state=42, n_jobs=1),
+        {"n_estimators": [50, 100, 200], "max_depth": [None, 24, 12], "min_samples_leaf": [1, 5]},
+    ),
+    "GradientBoosting": (
+        GradientBoostingClassifier(random_state=42, n_iter_no_change=5, validation_fraction=0.1),
+        {"n_estimators": [100, 300], "max_depth": [3, 5], "learning_rate": [0.1, 0.3]},
+    ),
+    "NeuralNetwork": (
+        MLPClassifier(max_iter=500, random_state=42, early_stopping=True),
+        {"hidden_layer_sizes": [(50,), (100,), (100, 50)], "alpha": [1e-4, 1e-3]},
+    ),
+    "HistGradientBoosting": (
+        HistGradientBoostingClassifier(categorical_features=None, early_stopping=True, random_state=42),
+        {"max_iter": [100, 300], "learning_rate": [0.1, 0.3], "max_leaf_nodes": [31, 63]},
+    ),
+}
+
+def read_dataset(path=None, chunksize=None):
+    """
+    Читает датасет с заранее объявленными типами: только нужные столбцы, категориальные
+    признаки и класс - category, числовые - float32. Файл читается чанками, категории
+    чанков объединяются, поэтому пик памяти не зависит от строковых объектов всего файла.
+
+    Args:
+        path (str, optional): Путь к CSV (по умолчанию DATA_PATH).
+        chunksize (int, optional): Количество строк в чанке (по умолчанию LOAD_CHUNK_ROWS).
+
+    Returns:
+        pd.DataFrame: Датасет со столбцами NUMERICAL_COLUMNS, CATEGORICAL_COLUMNS и class.
+    """
+    columns = NUMERICAL_COLUMNS + CATEGORICAL_COLUMNS + ["class"]
+    dtypes = {col: "float32" for col in NUMERICAL_COLUMNS}
+    dtypes.update({col: "category" for col in CATEGORICAL_COLUMNS + ["class"]})
+    chunks = list(pd.read_csv(
+        path or DATA_PATH,
+        usecols=lambda col: col in columns,
+        dtype=dtypes,
+        chunksize=chunksize or LOAD_CHUNK_ROWS
+    ))
+    df = pd.DataFrame({
+        col: union_categoricals([chunk[col] for chunk in chunks]) if dtypes[col] == "category"
+        else np.concatenate([chunk[col].to_numpy() for chunk in chunks])
+        for col in columns if col in chunks[0].columns
+    })
+    return df
+
+def load_data(path=None, chunksize=None):
     """
     Загружает и подготавливает датасет грибов, кодируя категориальные признаки и обрабатывая NaN.
 
+    Таблицы предобработки совпадают с прежними импутерами и энкодерами: пропуски
+    числовых признаков заполняются медианой, пропуски категориальных кодируются как
+    'nan', как после astype(str), в список категорий добавляется 'unknown'. Кодирование
+    выполняется через коды категорий, без преобразования столбцов в строки.
+
+    Args:
+        path (str, optional): Путь к CSV (по умолчанию DATA_PATH).
+        chunksize (int, optional): Количество строк в чанке при чтении.
+
     Returns:
-        tuple: (X, y, encoders) - признаки, целевая переменная, словарь энкодеров.
+        tuple: (X, y, preprocessing) - признаки, целевая переменная и таблицы предобработки
+            ({"medians": {...}, "categories": {...}, "class_labels": ...}) для бандла модели.
     
     Raises:
         Exception: Если не удалось загрузить или обработать данные.
     """
     try:
-        df = pd.read_csv(DATA_PATH)
-        logger.info(f"Загружен датасет с {len(df)} строками")
+        df = read_dataset(path, chunksize)
+        logger.info(f"Загружен датасет с {len(df)} строками ({df.memory_usage(deep=True).sum() / 2**20:.1f} МБ)")
         
         # Проверяем наличие NaN
         nan_counts = df.isna().sum()
@@ -57,101 +204,956 @@ def load_data():
             if count > 0:
                 logger.warning(f"Column {col} has {count} NaN values")
         
-        # Удаляем столбец id и столбцы с высоким процентом NaN
-        columns_to_drop = ['id'] if 'id' in df.columns else []
-        columns_to_drop.extend([col for col in DROP_COLUMNS if col in df.columns])
-        df = df.drop(columns=columns_to_drop)
-        logger.info(f"Удалены столбцы: {columns_to_drop}")
-        
         # Обработка NaN
         # Числовые столбцы: заполняем медианой
-        num_imputer = SimpleImputer(strategy='median')
+        medians = {}
         for col in NUMERICAL_COLUMNS:
             if col in df.columns:
-                df[col] = num_imputer.fit_transform(df[[col]]).ravel()
-                with open(os.path.join(IMPUTER_DIR, f'imputer_{col}.pkl'), 'wb') as f:
-                    pickle.dump(num_imputer, f)
-                logger.info(f"Сохранён imputer для {col}")
-        
-        # Категориальные столбцы: заполняем 'unknown'
-        cat_imputer = SimpleImputer(strategy='constant', fill_value='unknown')
-        for col in CATEGORICAL_COLUMNS:
-            if col in df.columns:
-                df[col] = cat_imputer.fit_transform(df[[col]].astype(str)).ravel()
-                with open(os.path.join(IMPUTER_DIR, f'imputer_{col}.pkl'), 'wb') as f:
-                    pickle.dump(cat_imputer, f)
-                logger.info(f"Сохранён imputer для {col}")
+                medians[col] = float(df[col].astype("float64").median())
+                df[col] = df[col].fillna(np.float32(medians[col]))
         
-        # Кодирование категориальных признаков
-        encoders = {}
+        # Категориальные столбцы: NaN становится категорией 'nan' (как после astype(str)),
+        # 'unknown' добавляется в категории, чтобы не возникало ошибки с новыми значениями;
+        # коды категорий pandas переводятся в номера в отсортированном списке категорий
+        categories = {}
         for col in CATEGORICAL_COLUMNS:
             if col in df.columns:
-                le = LabelEncoder()
-                # Гарантируем, что 'unknown' включён в категории, 
-                # чтобы не возникало ошибки с новыми значениями
-                unique_values = np.append(df[col].unique(), 'unknown')
-                le.fit(unique_values)
-                df[col] = le.transform(df[col].astype(str))
-                encoders[col] = le
-                with open(os.path.join(ENCODER_DIR, f'le_{col}.pkl'), 'wb') as f:
-                    pickle.dump(le, f)
-                logger.info(f"Сохранён encoder для {col}")
+                values = df[col]
+                if values.isna().any():
+                    values = values.cat.add_categories(['nan']).fillna('nan')
+                values = values.cat.remove_unused_categories()
+                known = values.cat.categories.astype(str).to_numpy(dtype=str)
+                categories[col] = np.unique(np.append(known, 'unknown'))
+                mapping = np.searchsorted(categories[col], known).astype(np.int16)
+                df[col] = mapping[values.cat.codes.to_numpy()]
         
         # Кодирование целевой переменной
-        le_class = LabelEncoder()
-        df['class'] = le_class.fit_transform(df['class'])
-        with open(os.path.join(ENCODER_DIR, 'le_class.pkl'), 'wb') as f:
-            pickle.dump(le_class, f)
-        logger.info("Сохранён encoder для class")
+        class_labels = np.unique(df['class'].cat.categories.astype(str).to_numpy(dtype=str))
+        y = pd.Series(
+            np.searchsorted(class_labels, df['class'].cat.categories.astype(str))[df['class'].cat.codes.to_numpy()],
+            name='class'
+        )
         
-        # Разделяем признаки и целевую переменную
-        X = df.drop(columns=['class'])
-        y = df['class']
-        return X, y, encoders
+        # Признаки в порядке, который ожидает prediction_service
+        X = df[[col for col in FEATURE_COLUMNS if col in df.columns]]
+        preprocessing = {"medians": medians, "categories": categories, "class_labels": class_labels}
+        return X, y, preprocessing
     except Exception as e:
         logger.error(f"Возникла ошибка при загрузке данных: {str(e)}")
         raise
 
-def train_model(model, X_train, y_train, model_name):
+def feature_cache_key(path=None):
     """
-    Обучает модель и сохраняет её в .pkl файл.
+    Возвращает ключ кэша признаков: sha256 содержимого датасета и настроек предобработки.
 
     Args:
-        model: Модель машинного обучения (например, RandomForestClassifier).
+        path (str, optional): Путь к CSV (по умолчанию DATA_PATH).
+
+    Returns:
+        str: Ключ кэша.
+    """
+    config = {
+        "preprocessing_version": PREPROCESSING_VERSION,
+        "numerical": NUMERICAL_COLUMNS,
+        "categorical": CATEGORICAL_COLUMNS,
+        "features": FEATURE_COLUMNS,
+    }
+    digest = hashlib.sha256(file_sha256(path or DATA_PATH).encode())
+    digest.update(json.dumps(config, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def save_feature_cache(key, X, y, preprocessing):
+    """
+    Сохраняет признаки (Parquet, с типами столбцов) и таблицы предобработки (JSON) в кэш.
+
+    Папка записывается целиком во временную и затем переименовывается, поэтому
+    прерванная запись не оставляет неполного кэша. Старые ключи удаляются.
+    """
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+    cache_dir = os.path.join(FEATURE_CACHE_DIR, key)
+    tmp_dir = f"{cache_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    X.assign(**{y.name: y.to_numpy()}).to_parquet(os.path.join(tmp_dir, "features.parquet"), index=False)
+    tables = {
+        "medians": preprocessing["medians"],
+        "categories": {col: values.tolist() for col, values in preprocessing["categories"].items()},
+        "class_labels": preprocessing["class_labels"].tolist(),
+    }
+    with open(os.path.join(tmp_dir, "preprocessing.json"), 'w') as f:
+        json.dump(tables, f)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+    logger.info(f"Признаки сохранены в кэш {cache_dir}")
+
+    entries = [os.path.join(FEATURE_CACHE_DIR, name) for name in os.listdir(FEATURE_CACHE_DIR) if not name.endswith(".tmp")]
+    for old_dir in sorted(entries, key=os.path.getmtime, reverse=True)[FEATURE_CACHE_KEEP:]:
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+def read_feature_cache(key):
+    """
+    Читает признаки и таблицы предобработки из кэша.
+
+    Returns:
+        tuple: (X, y, preprocessing) как у load_data или None, если ключа нет в кэше.
+    """
+    cache_dir = os.path.join(FEATURE_CACHE_DIR, key)
+    try:
+        features = pd.read_parquet(os.path.join(cache_dir, "features.parquet"))
+        with open(os.path.join(cache_dir, "preprocessing.json")) as f:
+            tables = json.load(f)
+    except (OSError, ValueError):
+        return None
+    preprocessing = {
+        "medians": tables["medians"],
+        "categories": {col: np.array(values, dtype=str) for col, values in tables["categories"].items()},
+        "class_labels": np.array(tables["class_labels"], dtype=str),
+    }
+    return features.drop(columns=['class']), features['class'], preprocessing
+
+def load_features(path=None, chunksize=None, use_cache=True):
+    """
+    Возвращает подготовленные признаки: из кэша, если датасет и настройки предобработки
+    не менялись, иначе через load_data с сохранением результата в кэш.
+
+    Args:
+        path (str, optional): Путь к CSV (по умолчанию DATA_PATH).
+        chunksize (int, optional): Количество строк в чанке при чтении.
+        use_cache (bool): Читать и записывать кэш признаков.
+
+    Returns:
+        tuple: (X, y, preprocessing, cache_hit).
+    """
+    if not use_cache:
+        return (*load_data(path, chunksize), False)
+    key = feature_cache_key(path)
+    cached = read_feature_cache(key)
+    if cached is not None:
+        logger.info(f"Признаки загружены из кэша {key[:12]} ({len(cached[0])} строк)")
+        return (*cached, True)
+    X, y, preprocessing = load_data(path, chunksize)
+    save_feature_cache(key, X, y, preprocessing)
+    return X, y, preprocessing, False
+
+def fit_with_progress(model, X_train, y_train, report):
+    """
+    Обучает модель, сообщая о реальном ходе обучения.
+
+    RandomForest наращивает деревья порциями через warm_start (результат совпадает с
+    обучением за один вызов fit), GradientBoosting сообщает о каждой стадии через monitor,
+    для MLP отдельный поток следит за числом пройденных эпох (loss_curve_).
+
+    Args:
+        model: Модель машинного обучения.
         X_train: Обучающие признаки.
         y_train: Обучающие метки.
-        model_name (str): Имя модели для сохранения.
+        report (Callable[[int, int], None]): Вызывается с числом выполненных и общим числом шагов.
 
     Returns:
         object: Обученная модель.
     """
-    logger.info(f"Training {model_name}")
-    with tqdm(total=100, desc=f"Training {model_name}", unit="%") as pbar:
+    if isinstance(model, RandomForestClassifier):
+        total = model.n_estimators
+        step = max(model.n_jobs or 1, total // PROGRESS_STEPS, 1)
+        model.set_params(warm_start=True)
+        for n_estimators in range(step, total + step, step):
+            model.set_params(n_estimators=min(n_estimators, total))
+            model.fit(X_train, y_train)
+            report(len(model.estimators_), total)
+        model.set_params(warm_start=False)
+    elif isinstance(model, GradientBoostingClassifier):
+        total = model.n_estimators
+        model.fit(X_train, y_train, monitor=lambda i, est, local_vars: report(i + 1, total) or False)
+    elif isinstance(model, MLPClassifier):
+        total = model.max_iter
+        finished = threading.Event()
+
+        def watch_epochs():
+            while not finished.wait(PROGRESS_POLL_SECONDS):
+                report(len(getattr(model, "loss_curve_", None) or []), total)
+
+        watcher = threading.Thread(target=watch_epochs, daemon=True)
+        watcher.start()
+        try:
+            model.fit(X_train, y_train)
+        finally:
+            finished.set()
+            watcher.join()
+        # Обучение могло остановиться раньше max_iter (сходимость)
+        report(total, total)
+    else:
         model.fit(X_train, y_train)
-        pbar.update(100)
-    
-    model_path = os.path.join(MODEL_DIR, f"{model_name}.pkl")
-    with open(model_path, 'wb') as f:
-        pickle.dump(model, f)
-    logger.info(f"Saved model to {model_path}")
+        report(1, 1)
     return model
 
-def main():
-    """Основная функция для обучения и оценки моделей."""
-    X, y, encoders = load_data()
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    
-    models = [
-        (RandomForestClassifier(n_estimators=100, random_state=42), "RandomForest"),
+def train_model(model, X_train, y_train, X_test, y_test, model_name, preprocessing, n_jobs=1, progress_queue=None):
+    """
+    Обучает модель, оценивает её на тестовой выборке и сохраняет бандл модели
+    (модель, таблицы предобработки, порядок признаков, метаданные обучения).
+
+    Выполняется в отдельном процессе пула: число потоков BLAS/OpenMP ограничивается
+    n_jobs, чтобы параллельно обучаемые модели не конкурировали за ядра.
+
+    Args:
+        model: Модель машинного обучения (например, RandomForestClassifier).
+        X_train: Обучающие признаки.
+        y_train: Обучающие метки.
+        X_test: Тестовые признаки.
+        y_test: Тестовые метки.
+        model_name (str): Имя модели для сохранения.
+        preprocessing (dict): Таблицы предобработки из load_data.
+        n_jobs (int): Количество ядер, выделенных модели.
+        progress_queue: Очередь для сообщений о ходе обучения (model_name, выполнено, всего).
+
+    Returns:
+        dict: Имя модели, F1-score, время обучения (с), n_jobs, версия и хэш бандла.
+    """
+    logger.info(f"Training {model_name} (n_jobs={n_jobs})")
+
+    def report(done, total):
+        if progress_queue is not None:
+            progress_queue.put((model_name, done, total))
+
+    started = time.perf_counter()
+    with threadpool_limits(limits=n_jobs):
+        fit_with_progress(model, X_train, y_train, report)
+        fit_seconds = time.perf_counter() - started
+        y_pred = model.predict(X_test)
+    f1 = float(f1_score(y_test, y_pred, average='weighted'))
+
+    bundle = build_bundle(
+        model_name, set_serving_n_jobs(model), preprocessing["medians"], preprocessing["categories"],
+        preprocessing["class_labels"], list(X_train.columns),
+        metadata={
+            "f1": f1,
+            "fit_seconds": fit_seconds,
+            "train_rows": len(X_train),
+            "test_rows": len(X_test),
+            "params": {key: repr(value) for key, value in model.get_params().items()},
+        }
+    )
+    bundle_path = save_bundle(bundle, BUNDLE_DIR)
+    return {
+        "model": model_name, "f1": f1, "fit_seconds": fit_seconds, "n_jobs": n_jobs,
+        "version": bundle["version"], "content_hash": bundle["content_hash"], "bundle_path": bundle_path
+    }
+
+def default_n_jobs(cpu_count=None):
+    """
+    Распределяет ядра между моделями: GradientBoosting и MLP обучаются в один поток
+    (у GradientBoosting нет параллельного fit, MLP упирается в BLAS), остальные ядра
+    поровну делят RandomForest и HistGradientBoosting (потоки OpenMP при биннинге
+    и построении гистограмм).
+
+    Returns:
+        dict: {имя модели: n_jobs}.
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    hist_jobs = max(1, (cpu_count - 2) // 2)
+    return {
+        "RandomForest": max(1, cpu_count - 2 - hist_jobs),
+        "GradientBoosting": 1,
+        "NeuralNetwork": 1,
+        "HistGradientBoosting": hist_jobs,
+    }
+
+def categorical_mask(categories=None):
+    """
+    Возвращает маску признаков, которые HistGradientBoosting обрабатывает как категории.
+
+    Признаки, у которых категорий больше HIST_MAX_CATEGORIES, остаются порядковыми кодами.
+
+    Args:
+        categories (dict, optional): Категории признаков из таблиц предобработки.
+
+    Returns:
+        list: Маска в порядке FEATURE_COLUMNS.
+    """
+    return [
+        col in CATEGORICAL_COLUMNS and (categories is None or len(categories[col]) <= HIST_MAX_CATEGORIES)
+        for col in FEATURE_COLUMNS
+    ]
+
+def build_models(n_jobs, categories=None):
+    """Возвращает список (модель, имя) для обучения с заданным n_jobs (категории - для маски HistGradientBoosting)."""
+    return [
+        (RandomForestClassifier(n_estimators=100, random_state=42, n_jobs=n_jobs["RandomForest"]), "RandomForest"),
         (GradientBoostingClassifier(n_estimators=100, random_state=42), "GradientBoosting"),
-        (MLPClassifier(hidden_layer_sizes=(100,), max_iter=500, random_state=42), "NeuralNetwork")
+        (MLPClassifier(hidden_layer_sizes=(100,), max_iter=500, random_state=42), "NeuralNetwork"),
+        (HistGradientBoostingClassifier(
+            max_iter=200, categorical_features=categorical_mask(categories), early_stopping=True, random_state=42
+        ), "HistGradientBoosting")
     ]
-    
-    for model, name in models:
-        trained_model = train_model(model, X_train, y_train, name)
-        y_pred = trained_model.predict(X_test)
-        f1 = f1_score(y_test, y_pred, average='weighted')
-        logger.info(f"{name} F1-score: {f1:.4f}")
+
+def train_models_parallel(models, X_train, y_train, X_test, y_test, n_jobs, preprocessing):
+    """
+    Обучает модели одновременно в пуле процессов и показывает реальный прогресс каждой.
+
+    Args:
+        models (list): Список (модель, имя).
+        X_train, y_train, X_test, y_test: Обучающая и тестовая выборки.
+        n_jobs (dict): {имя модели: n_jobs}.
+        preprocessing (dict): Таблицы предобработки из load_data.
+
+    Returns:
+        dict: {имя модели: результат train_model}.
+    """
+    results = {}
+    max_workers = min(len(models), os.cpu_count() or 1)
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=max_workers) as executor:
+        progress_queue = manager.Queue()
+        bars = {name: tqdm(total=1, desc=f"Training {name}", position=i) for i, (_, name) in enumerate(models)}
+        futures = {
+            executor.submit(
+                train_model, model, X_train, y_train, X_test, y_test, name, preprocessing, n_jobs.get(name, 1), progress_queue
+            ): name
+            for model, name in models
+        }
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=PROGRESS_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            while not progress_queue.empty():
+                name, steps_done, steps_total = progress_queue.get()
+                bars[name].total = steps_total
+                bars[name].n = steps_done
+                bars[name].refresh()
+            for future in done:
+                result = future.result()
+                results[result["model"]] = result
+                logger.info(f"{result['model']} F1-score: {result['f1']:.4f}, fit time: {result['fit_seconds']:.1f}s")
+        for bar in bars.values():
+            bar.close()
+    return results
+
+def set_serving_n_jobs(model):
+    """Возвращает модель с n_jobs для предсказаний (SERVING_N_JOBS), перед сохранением в бандл."""
+    if "n_jobs" in model.get_params():
+        model.set_params(n_jobs=SERVING_N_JOBS)
+    return model
+
+def measure_inference(model, X_sample):
+    """
+    Измеряет задержку предсказания на строку и размер сериализованной модели.
+
+    Модель предсказывает в один поток (n_jobs=1, один поток BLAS), как процесс пула воркера.
+
+    Args:
+        model: Обученная модель.
+        X_sample: Строки для замера (LATENCY_ROWS строк).
+
+    Returns:
+        dict: {"latency_us": мкс на строку, "size_mb": размер модели в МБ}.
+    """
+    if "n_jobs" in model.get_params():
+        model.set_params(n_jobs=1)
+    timings = []
+    with threadpool_limits(limits=1):
+        model.predict(X_sample)
+        for _ in range(LATENCY_REPEATS):
+            started = time.perf_counter()
+            model.predict(X_sample)
+            timings.append(time.perf_counter() - started)
+    return {
+        "latency_us": float(np.median(timings)) / len(X_sample) * 1e6,
+        "size_mb": len(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)) / 2**20,
+    }
+
+def search_model(name, estimator, grid, X_train, y_train, X_test, y_test, top_k=None):
+    """
+    Ищет гиперпараметры модели и измеряет лучших кандидатов.
+
+    HalvingGridSearchCV оценивает все комбинации на небольшой подвыборке и на каждом
+    шаге оставляет треть лучших, увеличивая подвыборку (раннее отсечение слабых
+    кандидатов); фолды и кандидаты обучаются параллельно на всех ядрах. top_k лучших
+    по кросс-валидации дообучаются на всей обучающей выборке, для них считаются F1 на
+    тестовой выборке, задержка и размер.
+
+    Args:
+        name (str): Имя модели.
+        estimator: Базовая модель.
+        grid (dict): Сетка гиперпараметров.
+        X_train, y_train, X_test, y_test: Обучающая и тестовая выборки.
+        top_k (int, optional): Сколько кандидатов измерять (по умолчанию SEARCH_TOP_K).
+
+    Returns:
+        list: Кандидаты ({"params", "cv_f1", "f1", "fit_seconds", "latency_us", "size_mb", "model"})
+            в порядке убывания cv_f1.
+    """
+    search = HalvingGridSearchCV(
+        estimator, grid, cv=SEARCH_CV, scoring="f1_weighted", factor=3,
+        max_resources=min(len(X_train), SEARCH_MAX_ROWS), refit=False, n_jobs=-1, random_state=42
+    )
+    started = time.perf_counter()
+    search.fit(X_train, y_train)
+    logger.info(f"{name}: search over {len(search.cv_results_['params'])} fits took {time.perf_counter() - started:.1f}s")
+
+    # Кандидаты последней итерации выше, внутри итерации - по среднему F1
+    results = search.cv_results_
+    order = sorted(range(len(results["params"])), key=lambda i: (-results["iter"][i], -results["mean_test_score"][i]))
+    candidates, seen = [], set()
+    for i in order:
+        key = repr(sorted(results["params"][i].items()))
+        if key in seen:
+            continue
+        seen.add(key)
+        candidates.append({"params": results["params"][i], "cv_f1": float(results["mean_test_score"][i])})
+        if len(candidates) >= (top_k or SEARCH_TOP_K):
+            break
+
+    sample = X_test.iloc[:LATENCY_ROWS]
+    for candidate in candidates:
+        model = clone(estimator).set_params(**candidate["params"])
+        if "n_jobs" in model.get_params():
+            model.set_params(n_jobs=-1)
+        started = time.perf_counter()
+        model.fit(X_train, y_train)
+        candidate["fit_seconds"] = time.perf_counter() - started
+        candidate["f1"] = float(f1_score(y_test, model.predict(X_test), average='weighted'))
+        candidate.update(measure_inference(model, sample))
+        candidate["model"] = model
+        logger.info(
+            f"{name} {candidate['params']}: F1={candidate['f1']:.4f}, "
+            f"latency={candidate['latency_us']:.2f}us/row, size={candidate['size_mb']:.1f}MB"
+        )
+    return candidates
+
+def select_candidate(candidates, max_latency_us=0.0, max_size_mb=0.0):
+    """
+    Выбирает самого точного кандидата, укладывающегося в бюджет инференса.
+
+    Если в бюджет не укладывается никто, выбирается самый быстрый кандидат.
+
+    Args:
+        candidates (list): Кандидаты из search_model.
+        max_latency_us (float): Предельная задержка на строку, мкс (0 - без ограничения).
+        max_size_mb (float): Предельный размер модели, МБ (0 - без ограничения).
+
+    Returns:
+        tuple: (кандидат, уложился ли он в бюджет).
+    """
+    fitting = [
+        c for c in candidates
+        if (not max_latency_us or c["latency_us"] <= max_latency_us) and (not max_size_mb or c["size_mb"] <= max_size_mb)
+    ]
+    if fitting:
+        return max(fitting, key=lambda c: (c["f1"], -c["latency_us"])), True
+    return min(candidates, key=lambda c: (c["latency_us"], c["size_mb"])), False
+
+def run_search(X_train, y_train, X_test, y_test, preprocessing, max_latency_us=None, max_size_mb=None, names=None):
+    """
+    Выполняет поиск гиперпараметров для моделей и сохраняет бандлы выбранных кандидатов.
+
+    Args:
+        X_train, y_train, X_test, y_test: Обучающая и тестовая выборки.
+        preprocessing (dict): Таблицы предобработки из load_data.
+        max_latency_us (float, optional): Бюджет задержки на строку (по умолчанию SEARCH_MAX_LATENCY_US).
+        max_size_mb (float, optional): Бюджет размера модели (по умолчанию SEARCH_MAX_MODEL_MB).
+        names (list, optional): Модели для поиска (по умолчанию все из SEARCH_SPACES).
+
+    Returns:
+        dict: {имя модели: {"selected", "within_budget", "candidates", "version", "content_hash"}}.
+    """
+    budget = {
+        "max_latency_us": SEARCH_MAX_LATENCY_US if max_latency_us is None else max_latency_us,
+        "max_size_mb": SEARCH_MAX_MODEL_MB if max_size_mb is None else max_size_mb,
+    }
+    report = {}
+    for name in names or SEARCH_SPACES:
+        estimator, grid = SEARCH_SPACES[name]
+        if isinstance(estimator, HistGradientBoostingClassifier):
+            estimator = clone(estimator).set_params(categorical_features=categorical_mask(preprocessing["categories"]))
+        candidates = search_model(name, estimator, grid, X_train, y_train, X_test, y_test)
+        selected, within_budget = select_candidate(candidates, **budget)
+        if not within_budget:
+            logger.warning(f"{name}: no candidate fits the budget {budget}, using the fastest one")
+        summary = [{key: value for key, value in c.items() if key != "model"} for c in candidates]
+        bundle = build_bundle(
+            name, selected["model"], preprocessing["medians"], preprocessing["categories"],
+            preprocessing["class_labels"], list(X_train.columns),
+            metadata={
+                "f1": selected["f1"],
+                "fit_seconds": selected["fit_seconds"],
+                "train_rows": len(X_train),
+                "test_rows": len(X_test),
+                "params": {key: repr(value) for key, value in selected["model"].get_params().items()},
+                "latency_us": selected["latency_us"],
+                "size_mb": selected["size_mb"],
+                "budget": budget,
+            }
+        )
+        save_bundle(bundle, BUNDLE_DIR)
+        report[name] = {
+            "selected": {key: value for key, value in selected.items() if key != "model"},
+            "within_budget": within_budget,
+            "candidates": summary,
+            "version": bundle["version"],
+            "content_hash": bundle["content_hash"],
+        }
+        logger.info(f"{name}: selected {selected['params']} (F1={selected['f1']:.4f}, {selected['latency_us']:.2f}us/row)")
+    return report
+
+def distill_model(teacher, X_train, X_test, y_test, n_jobs=1):
+    """
+    Обучает компактный лес на предсказаниях учителя и сравнивает их на тестовой выборке.
+
+    Args:
+        teacher: Обученный RandomForest.
+        X_train: Обучающие признаки (метки для ученика - предсказания учителя на них).
+        X_test, y_test: Тестовая выборка.
+        n_jobs (int): Количество ядер для обучения.
+
+    Returns:
+        tuple: (модель-ученик, метрики: F1 обеих моделей, потеря F1, доля совпадений с
+            учителем, задержка на строку, ускорение, размеры, время обучения).
+    """
+    student = RandomForestClassifier(
+        n_estimators=DISTILL_TREES, max_depth=DISTILL_MAX_DEPTH, random_state=42, n_jobs=n_jobs
+    )
+    teacher.set_params(n_jobs=n_jobs)
+    started = time.perf_counter()
+    with threadpool_limits(limits=n_jobs):
+        student.fit(X_train, teacher.predict(X_train))
+        fit_seconds = time.perf_counter() - started
+        teacher_pred = teacher.predict(X_test)
+        student_pred = student.predict(X_test)
+
+    teacher_f1 = float(f1_score(y_test, teacher_pred, average='weighted'))
+    f1 = float(f1_score(y_test, student_pred, average='weighted'))
+    sample = X_test.iloc[:LATENCY_ROWS]
+    teacher_inference = measure_inference(teacher, sample)
+    inference = measure_inference(student, sample)
+    return student, {
+        "f1": f1,
+        "teacher_f1": teacher_f1,
+        "f1_loss": teacher_f1 - f1,
+        "fidelity": float(np.mean(student_pred == teacher_pred)),
+        "latency_us": inference["latency_us"],
+        "teacher_latency_us": teacher_inference["latency_us"],
+        "speedup": teacher_inference["latency_us"] / inference["latency_us"],
+        "size_mb": inference["size_mb"],
+        "teacher_size_mb": teacher_inference["size_mb"],
+        "fit_seconds": fit_seconds,
+    }
+
+def distill_random_forest(X_train, X_test, y_test, preprocessing, n_jobs=None):
+    """
+    Дистиллирует сохранённый бандл RandomForest в RandomForestLite и сохраняет его бандл.
+
+    Признаки должны быть закодированы теми же таблицами предобработки, что и у учителя
+    (после дообучения с новыми категориями учителя нужно сначала переобучить).
+
+    Args:
+        X_train: Обучающие признаки.
+        X_test, y_test: Тестовая выборка.
+        preprocessing (dict): Таблицы предобработки, которыми закодированы признаки.
+        n_jobs (int, optional): Количество ядер (по умолчанию все).
+
+    Returns:
+        dict: Метрики дистилляции, версия, хэш и путь бандла.
+
+    Raises:
+        ValueError: Если таблицы предобработки учителя не совпадают с переданными.
+    """
+    teacher_bundle = load_bundle(bundle_path(DISTILL_TEACHER, BUNDLE_DIR), mmap_mode=None, verify=True)
+    same_tables = all(
+        np.array_equal(teacher_bundle["categories"][col], np.asarray(values, dtype=str))
+        for col, values in preprocessing["categories"].items()
+    )
+    if not same_tables:
+        raise ValueError(f"{DISTILL_TEACHER} bundle was encoded with different category tables, retrain it first")
+
+    student, metrics = distill_model(teacher_bundle["model"], X_train, X_test, y_test, n_jobs or os.cpu_count() or 1)
+    # Обучение шло на всех ядрах, предсказывать ученик должен в один поток, как процесс пула воркера
+    set_serving_n_jobs(teacher_bundle["model"])
+    bundle = build_bundle(
+        DISTILLED_MODEL, set_serving_n_jobs(student), teacher_bundle["medians"], teacher_bundle["categories"],
+        teacher_bundle["class_labels"], teacher_bundle["feature_order"],
+        metadata={
+            **metrics,
+            "train_rows": len(X_train),
+            "test_rows": len(X_test),
+            "params": {key: repr(value) for key, value in student.get_params().items()},
+            "distilled_from": {
+                "model": DISTILL_TEACHER,
+                "version": teacher_bundle["version"],
+                "content_hash": teacher_bundle["content_hash"],
+            },
+        }
+    )
+    path = save_bundle(bundle, BUNDLE_DIR)
+    logger.info(
+        f"{DISTILLED_MODEL}: F1 {metrics['f1']:.4f} (teacher {metrics['teacher_f1']:.4f}), "
+        f"fidelity {metrics['fidelity']:.4f}, {metrics['speedup']:.1f}x faster, "
+        f"{metrics['size_mb']:.1f} MB vs {metrics['teacher_size_mb']:.1f} MB"
+    )
+    return {
+        "model": DISTILLED_MODEL, **metrics,
+        "version": bundle["version"], "content_hash": bundle["content_hash"], "bundle_path": path
+    }
+
+def encode_new_rows(df, medians, categories, class_labels, feature_order):
+    """
+    Кодирует новые размеченные строки по таблицам предобработки существующего бандла.
+
+    Пропуски числовых признаков заполняются прежними медианами. Новые значения
+    категориальных признаков дописываются в конец списка категорий (в алфавитном
+    порядке), поэтому коды, на которых обучена модель, не меняются, а одинаковые
+    исходные таблицы расширяются одинаково для всех моделей.
+
+    Args:
+        df (pd.DataFrame): Новые строки (read_dataset: признаки и class).
+        medians (dict): Медианы числовых признаков.
+        categories (dict): Категории в порядке кодов.
+        class_labels (np.ndarray): Метки классов в порядке кодов.
+        feature_order (list): Порядок признаков модели.
+
+    Returns:
+        tuple: (X, y, categories, added) - признаки, метки, расширенные категории и
+            добавленные значения по столбцам.
+
+    Raises:
+        ValueError: Если в новых строках есть неизвестная метка класса.
+    """
+    categories = dict(categories)
+    added = {}
+    features = {}
+    for col in feature_order:
+        if col in medians:
+            features[col] = df[col].astype("float32").fillna(np.float32(medians[col])).to_numpy()
+            continue
+        values = df[col].astype(str).to_numpy(dtype=str)
+        new_values = np.setdiff1d(np.unique(values), categories[col])
+        if len(new_values):
+            categories[col] = np.append(categories[col], new_values)
+            added[col] = new_values.tolist()
+        sorted_classes, codes = category_lookup(categories[col])
+        unknown_code = int(np.flatnonzero(categories[col] == "unknown")[0])
+        features[col] = encode_categorical(values, sorted_classes, codes, unknown_code).astype(np.int16)
+
+    labels = df['class'].astype(str).to_numpy(dtype=str)
+    unknown_labels = np.setdiff1d(np.unique(labels), class_labels)
+    if len(unknown_labels):
+        raise ValueError(f"Unknown class labels in new data: {unknown_labels.tolist()}")
+    sorted_labels, label_codes = category_lookup(class_labels)
+    y = pd.Series(encode_categorical(labels, sorted_labels, label_codes, -1), name='class')
+    return pd.DataFrame(features, columns=feature_order), y, categories, added
+
+def update_model(model, X, y):
+    """
+    Дообучает модель на новых строках, не возвращаясь к прежним данным.
+
+    Args:
+        model: Модель из бандла (RandomForest, GradientBoosting или MLP).
+        X: Признаки новых строк.
+        y: Метки новых строк.
+
+    Returns:
+        object: Обновлённая модель.
+
+    Raises:
+        ValueError: Если модель не поддерживает дообучение или в новых строках
+            не хватает классов для деревьев.
+    """
+    if isinstance(model, (RandomForestClassifier, GradientBoostingClassifier)):
+        # fit с warm_start заново определяет classes_ по y, поэтому нужны все классы
+        missing = np.setdiff1d(model.classes_, np.unique(y))
+        if len(missing):
+            raise ValueError(f"New data must contain all classes to update {type(model).__name__}, missing: {missing.tolist()}")
+
+    if isinstance(model, RandomForestClassifier):
+        model.set_params(warm_start=True, n_jobs=-1, n_estimators=len(model.estimators_) + UPDATE_RF_TREES)
+        model.fit(X, y)
+        if len(model.estimators_) > UPDATE_RF_MAX_TREES:
+            model.estimators_ = model.estimators_[-UPDATE_RF_MAX_TREES:]
+        model.set_params(warm_start=False, n_estimators=len(model.estimators_))
+        set_serving_n_jobs(model)
+    elif isinstance(model, GradientBoostingClassifier):
+        # Новые стадии обучаются на остатках текущего ансамбля по новым строкам
+        model.set_params(warm_start=True, n_estimators=model.estimators_.shape[0] + UPDATE_GB_STAGES)
+        model.fit(X, y)
+        model.set_params(warm_start=False)
+    elif isinstance(model, MLPClassifier):
+        for _ in range(UPDATE_MLP_EPOCHS):
+            model.partial_fit(X, y)
+    else:
+        raise ValueError(f"Incremental update is not supported for {type(model).__name__}")
+    return model
+
+def update_models(path, names=None):
+    """
+    Дообучает сохранённые модели на новых размеченных строках и сохраняет новые версии бандлов.
+
+    Время обновления зависит от числа новых строк, а не от размера прежнего датасета:
+    читаются только новые строки, модели дообучаются только на них.
+
+    Args:
+        path (str): CSV с новыми размеченными строками (формат train.csv).
+        names (list, optional): Имена моделей (по умолчанию все модели с бандлами).
+
+    Returns:
+        dict: {имя модели: {"version", "rows", "f1_before", "f1_after", "update_seconds", "new_categories"}}.
+            По умолчанию дообучаются модели из UPDATABLE_MODELS.
+    """
+    df = read_dataset(path)
+    logger.info(f"Загружено {len(df)} новых строк из {path}")
+    names = names or [
+        name for model, name in build_models(default_n_jobs())
+        if isinstance(model, UPDATABLE_MODELS) and os.path.exists(bundle_path(name, BUNDLE_DIR))
+    ]
+    results = {}
+    for name in names:
+        started = time.perf_counter()
+        bundle = load_bundle(bundle_path(name, BUNDLE_DIR), mmap_mode=None, verify=True)
+        X, y, categories, added = encode_new_rows(
+            df, bundle["medians"], bundle["categories"], bundle["class_labels"], bundle["feature_order"]
+        )
+        if len(X) >= 10:
+            X_fit, X_holdout, y_fit, y_holdout = train_test_split(X, y, test_size=UPDATE_HOLDOUT, random_state=42)
+        else:
+            X_fit, X_holdout, y_fit, y_holdout = X, X.iloc[:0], y, y.iloc[:0]
+        model = bundle["model"]
+        f1_before = float(f1_score(y_holdout, model.predict(X_holdout), average='weighted')) if len(X_holdout) else None
+        update_model(model, X_fit, y_fit)
+        f1_after = float(f1_score(y_holdout, model.predict(X_holdout), average='weighted')) if len(X_holdout) else None
+        update_seconds = time.perf_counter() - started
+
+        metadata = {
+            key: value for key, value in bundle["metadata"].items()
+            if key not in ("trained_at", "sklearn_version", "numpy_version", "joblib_version")
+        }
+        metadata.update({
+            "train_rows": metadata.get("train_rows", 0) + len(X_fit),
+            "updated_from_version": bundle["version"],
+            "update_rows": len(X_fit),
+            "update_f1_before": f1_before,
+            "update_f1_after": f1_after,
+            "update_seconds": update_seconds,
+            "new_categories": added,
+        })
+        new_bundle = build_bundle(
+            name, model, bundle["medians"], categories, bundle["class_labels"], bundle["feature_order"], metadata
+        )
+        save_bundle(new_bundle, BUNDLE_DIR)
+        results[name] = {
+            "version": new_bundle["version"],
+            "rows": len(X_fit),
+            "f1_before": f1_before,
+            "f1_after": f1_after,
+            "update_seconds": update_seconds,
+            "new_categories": added,
+        }
+        logger.info(f"{name} updated to version {new_bundle['version']} in {update_seconds:.1f}s (F1 {f1_before} -> {f1_after})")
+    return results
+
+def decode_features(X, categories):
+    """Восстанавливает входные строки сервиса (категории - строками) из закодированных признаков."""
+    return pd.DataFrame({
+        col: categories[col][X[col].to_numpy()] if col in categories else X[col].to_numpy(dtype="float64")
+        for col in X.columns
+    })
+
+def measure_serving_profile(model_name, bundle_dir, sample, batch_sizes, repeats):
+    """
+    Измеряет профиль модели так, как её использует воркер. Выполняется в новом процессе.
+
+    Args:
+        model_name (str): Имя модели.
+        bundle_dir (str): Папка бандлов.
+        sample (pd.DataFrame): Входные строки в формате сервиса.
+        batch_sizes (list): Размеры пакетов для замера скорости.
+        repeats (int): Количество замеров на каждый размер.
+
+    Returns:
+        dict: rows_per_sec {размер пакета: строк/с}, load_seconds, memory_mb, peak_memory_mb.
+    """
+    import resource
+    from services import model_bundle
+    from services import prediction_service
+
+    model_bundle.BUNDLE_DIR = bundle_dir
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    artifacts = prediction_service.load_model_artifacts(model_name)
+    prediction_service.predict_dataframe(sample.iloc[:1], artifacts)
+    load_seconds = time.perf_counter() - started
+    loaded_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    rows_per_sec = {}
+    for batch in batch_sizes:
+        frame = sample.iloc[np.resize(np.arange(len(sample)), batch)]
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            prediction_service.predict_dataframe(frame, artifacts)
+            timings.append(time.perf_counter() - started)
+        rows_per_sec[str(batch)] = batch / float(np.median(timings))
+    # ru_maxrss - пик RSS процесса в КБ (Linux)
+    return {
+        "rows_per_sec": rows_per_sec,
+        "load_seconds": load_seconds,
+        "memory_mb": (loaded_rss - base_rss) / 1024,
+        "peak_memory_mb": (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024,
+    }
+
+def profile_models(names, sample, batch_sizes=None, repeats=None):
+    """
+    Измеряет профили сохранённых моделей, каждую в новом процессе (spawn), как после старта воркера.
+
+    Args:
+        names (list): Имена моделей с бандлами.
+        sample (pd.DataFrame): Входные строки в формате сервиса.
+        batch_sizes (list, optional): Размеры пакетов (по умолчанию PROFILE_BATCH_SIZES).
+        repeats (int, optional): Количество замеров (по умолчанию PROFILE_REPEATS).
+
+    Returns:
+        dict: {имя модели: профиль}; модели, которые не удалось измерить, пропускаются.
+    """
+    profiles = {}
+    context = multiprocessing.get_context("spawn")
+    for name in names:
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                profile = executor.submit(
+                    measure_serving_profile, name, BUNDLE_DIR, sample,
+                    batch_sizes or PROFILE_BATCH_SIZES, repeats or PROFILE_REPEATS
+                ).result()
+        except Exception as e:
+            logger.warning(f"Failed to profile {name}: {e}")
+            continue
+        info = read_bundle_info(name, BUNDLE_DIR) or {}
+        profile.update({
+            "bundle_mb": os.path.getsize(bundle_path(name, BUNDLE_DIR)) / 2**20,
+            "version": info.get("version"),
+            "cpu_count": os.cpu_count(),
+            "measured_at": datetime.now(timezone.utc).isoformat(),
+        })
+        profiles[name] = profile
+        rates = ", ".join(f"{batch}: {rate:.0f}" for batch, rate in profile["rows_per_sec"].items())
+        logger.info(f"{name} profile: load {profile['load_seconds']:.2f}s, memory {profile['memory_mb']:.0f} MB, rows/s {rates}")
+    return profiles
+
+def save_model_profiles(profiles):
+    """Сохраняет профили в записи моделей (models.profile); незарегистрированные модели пропускаются."""
+    db = SessionLocal()
+    try:
+        for name, profile in profiles.items():
+            if update_model_profile(db, name, profile) is None:
+                logger.warning(f"Model {name} is not registered in the database, profile saved only to the report")
+    except SQLAlchemyError as e:
+        logger.warning(f"Failed to save model profiles: {e}")
+    finally:
+        db.close()
+
+def main(
+    n_jobs=None, use_cache=True, search=False, max_latency_us=None, max_size_mb=None,
+    update_path=None, names=None, profile=True, distill=True, distill_only=False
+):
+    """
+    Основная функция для обучения и оценки моделей.
+
+    Args:
+        n_jobs (dict, optional): {имя модели: n_jobs}, по умолчанию default_n_jobs().
+        use_cache (bool): Использовать кэш подготовленных признаков.
+        search (bool): Подобрать гиперпараметры под бюджет инференса вместо фиксированных.
+        max_latency_us (float, optional): Бюджет задержки на строку для поиска, мкс.
+        max_size_mb (float, optional): Бюджет размера модели для поиска, МБ.
+        update_path (str, optional): CSV с новыми строками: дообучить сохранённые модели вместо обучения с нуля.
+        names (list, optional): Модели для дообучения (по умолчанию все с бандлами).
+        profile (bool): Измерить профили сохранённых моделей и записать их в таблицу models.
+        distill (bool): После обучения дистиллировать RandomForest в RandomForestLite.
+        distill_only (bool): Только дистиллировать сохранённый RandomForest, без обучения.
+    """
+    distill = distill or distill_only
+    started = time.perf_counter()
+    if update_path:
+        results = update_models(update_path, names)
+        profiles = profile_models(list(results), read_dataset(update_path)[FEATURE_COLUMNS]) if profile else {}
+        save_model_profiles(profiles)
+        report = {
+            "total_seconds": time.perf_counter() - started, "update": update_path, "models": results, "profiles": profiles
+        }
+        with open(TRAINING_REPORT_PATH, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Update finished in {report['total_seconds']:.1f}s, report saved to {TRAINING_REPORT_PATH}")
+        return
+
+    X, y, preprocessing, cache_hit = load_features(use_cache=use_cache)
+    preprocessing_seconds = time.perf_counter() - started
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+    if distill_only:
+        results = {}
+    elif search:
+        results = run_search(X_train, y_train, X_test, y_test, preprocessing, max_latency_us, max_size_mb)
+    else:
+        n_jobs = {**default_n_jobs(), **(n_jobs or {})}
+        results = train_models_parallel(build_models(n_jobs, preprocessing["categories"]), X_train, y_train, X_test, y_test, n_jobs, preprocessing)
+    if distill:
+        results[DISTILLED_MODEL] = distill_random_forest(X_train, X_test, y_test, preprocessing)
+
+    # Модели регистрируются в БД только после сохранения их бандлов
+    init_models()
+
+    profiles = {}
+    if profile:
+        sample = decode_features(X_test.iloc[:max(PROFILE_BATCH_SIZES)], preprocessing["categories"])
+        profiles = profile_models(list(results), sample)
+        save_model_profiles(profiles)
+
+    report = {
+        "total_seconds": time.perf_counter() - started,
+        "preprocessing_seconds": preprocessing_seconds,
+        "feature_cache_hit": cache_hit,
+        "search": search,
+        "models": results,
+        "profiles": profiles,
+    }
+    with open(TRAINING_REPORT_PATH, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Training finished in {report['total_seconds']:.1f}s, report saved to {TRAINING_REPORT_PATH}")
+
+def parse_n_jobs(values):
+    """Разбирает аргументы вида RandomForest=4 в словарь {имя модели: n_jobs}."""
+    n_jobs = {}
+    for value in values or []:
+        name, _, jobs = value.partition("=")
+        n_jobs[name] = int(jobs)
+    return n_jobs
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Обучение моделей классификации грибов")
+    parser.add_argument(
+        "--n-jobs", action="append", metavar="MODEL=N",
+        help="Количество ядер для модели, например --n-jobs RandomForest=6 (можно указать несколько раз)"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="Заново подготовить признаки из CSV, не читая и не обновляя кэш"
+    )
+    parser.add_argument(
+        "--search", action="store_true",
+        help="Подобрать гиперпараметры (кросс-валидация на всех ядрах) и выбрать самую точную модель в бюджете инференса"
+    )
+    parser.add_argument("--max-latency-us", type=float, help="Бюджет задержки предсказания на строку, мкс")
+    parser.add_argument("--max-size-mb", type=float, help="Бюджет размера модели, МБ")
+    parser.add_argument(
+        "--update", metavar="CSV",
+        help="Дообучить сохранённые модели на новых размеченных строках (формат train.csv) без полного переобучения"
+    )
+    parser.add_argument("--model", action="append", help="Модель для --update (можно указать несколько раз)")
+    parser.add_argument(
+        "--distill", action="store_true",
+        help="Только дистиллировать сохранённый RandomForest в RandomForestLite (без переобучения моделей)"
+    )
+    parser.add_argument("--no-distill", action="store_true", help="Не дистиллировать RandomForest после обучения")
+    parser.add_argument(
+        "--no-profile", action="store_true",
+        help="Не измерять профили производительности моделей (скорость, загрузка, память)"
+    )
+    args = parser.parse_args()
+    main(
+        parse_n_jobs(args.n_jobs), use_cache=not args.no_cache,
+        search=args.search, max_latency_us=args.max_latency_us, max_size_mb=args.max_size_mb,
+        update_path=args.update, names=args.model, profile=not args.no_profile,
+        distill=not args.no_distill, distill_only=args.distill
+    )